@@ -0,0 +1,226 @@
+"""
+Microbenchmarks of the valuation services and endpoints on synthetic ledgers.
+
+    python -m benchmarks.run --output baseline.json
+    python -m benchmarks.run --compare baseline.json --max-slowdown 1.3
+
+Everything runs against a throwaway SQLite database with offline prices.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+# (transactions, tickers, years)
+SCALES = {
+    "tiny": (10, 1, 1),
+    "small": (1_000, 10, 5),
+    "medium": (10_000, 50, 10),
+    "large": (100_000, 200, 20),
+}
+DEFAULT_SCALES = ["tiny", "small", "medium"]
+
+ENDPOINTS = [
+    "/api/transaction/price/total_history?period=5y",
+    "/api/transaction/ticker/daily-quantity/",
+    "/api/transaction/price/total",
+    "/api/transaction/price/total_invest",
+    "/api/transaction/?page_size=100",
+    "/api/transaction/analytics/performance?period=10a",
+    "/api/transaction/analytics/contribution?period=10a",
+    "/api/transaction/dashboard?period=5y",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default=",".join(DEFAULT_SCALES),
+                        help=f"Comma separated scales among {', '.join(SCALES)}, or 'all'")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per benchmark")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON file to compare against")
+    parser.add_argument("--max-slowdown", type=float, default=1.25,
+                        help="Fail when a median is more than this factor slower than the baseline")
+    parser.add_argument("--min-delta", type=float, default=0.002,
+                        help="Ignore slowdowns smaller than this many seconds (timer noise)")
+    return parser.parse_args()
+
+
+def configure_environment(workdir: str):
+    # Doit précéder l'import de db : l'engine est créé à l'import
+    os.environ["DATABASE_URL"] = f"sqlite:///{workdir}/bench.db"
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ["PRICE_PROVIDER"] = "fixture"
+    os.environ.pop("PRICE_FIXTURES_DIR", None)
+
+
+async def timed(func, repeat: int) -> dict:
+    await func()  # échauffement
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await func()
+        durations.append(time.perf_counter() - started)
+    return {"median": statistics.median(durations), "min": min(durations)}
+
+
+async def bench_scale(name: str, repeat: int) -> dict:
+    import httpx
+    from sqlmodel import select
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    import main
+    from db import engine
+    from routes.auth import create_access_token
+    from services import analytics, transactions as services
+    from services.jobs import job_queue
+    from services.nav import build_daily_nav
+    from services.response_cache import response_cache
+    from services.valuation import load_ledger_matrix
+    from models import Transaction
+    from benchmarks.synthetic import create_portfolio
+
+    transactions, tickers, years = SCALES[name]
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        started = time.perf_counter()
+        user = await create_portfolio(session, f"bench_{name}", transactions, tickers, years)
+        print(f"[{name}] {transactions} transactions, {tickers} tickers, {years}y generated in {time.perf_counter() - started:.1f}s")
+
+    results = {}
+
+    async def build_nav():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            await build_daily_nav(session, [user.id], full=True)
+    # Le job quotidien tourne avant les lectures, comme en production
+    results[f"{name}/job/build_daily_nav"] = await timed(build_nav, repeat)
+
+    async def service(func, *args):
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            await func(*args, session, user)
+
+    async def orm_ledger(session, current_user):
+        (await session.exec(select(Transaction).where(Transaction.user_id == current_user.id))).all()
+
+    async def columnar_ledger(session, current_user):
+        await load_ledger_matrix(session, current_user.id)
+
+    service_calls = {
+        # Référence : hydratation ORM complète contre chargement en colonnes
+        "ledger_orm": lambda: service(orm_ledger),
+        "ledger_columns": lambda: service(columnar_ledger),
+        "get_user_pea_history": lambda: service(services.get_user_pea_history, "5y"),
+        "get_user_daily_quantity_by_ticker": lambda: service(
+            lambda session, current_user: services.get_user_daily_quantity_by_ticker(session, current_user)
+        ),
+        "get_user_daily_quantity_columns": lambda: service(
+            lambda session, current_user: services.get_user_daily_quantity_columns(session, current_user)
+        ),
+        "get_user_total_price_by_date": lambda: service(services.get_user_total_price_by_date, date.today()),
+        "get_user_total_invest_price": lambda: service(services.get_user_total_invest_price),
+        "get_user_performance": lambda: service(analytics.get_user_performance, "10a"),
+    }
+    for label, call in service_calls.items():
+        results[f"{name}/service/{label}"] = await timed(call, repeat)
+
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': str(user.id)})}"}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", headers=headers) as client:
+        for path in ENDPOINTS:
+            async def call(path=path):
+                # Ni réponse en cache ni résultat de job partagé : chaque appel recalcule
+                response_cache.clear()
+                job_queue.clear()
+                response = await client.get(path)
+                response.raise_for_status()
+            results[f"{name}/endpoint/{path}"] = await timed(call, repeat)
+
+            async def cached(path=path):
+                response = await client.get(path)
+                response.raise_for_status()
+            results[f"{name}/endpoint-cached/{path}"] = await timed(cached, repeat)
+
+            etag = (await client.get(path)).headers["ETag"]
+
+            async def not_modified(path=path, etag=etag):
+                response = await client.get(path, headers={"If-None-Match": etag})
+                assert response.status_code == 304
+            results[f"{name}/endpoint-304/{path}"] = await timed(not_modified, repeat)
+
+    print(f"[{name}] job_queue {job_queue.stats()}")
+    for key, value in results.items():
+        if key.startswith(f"{name}/"):
+            print(f"  {key:<70} median {value['median'] * 1000:9.2f} ms   min {value['min'] * 1000:9.2f} ms")
+    return results
+
+
+def compare(results: dict, baseline: dict, max_slowdown: float, min_delta: float) -> list:
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get("results", {}).get(key)
+        if previous is None:
+            continue
+        ratio = current["median"] / previous["median"] if previous["median"] else float("inf")
+        if ratio > max_slowdown and current["median"] - previous["median"] > min_delta:
+            regressions.append(
+                f"{key}: {previous['median'] * 1000:.2f} ms -> {current['median'] * 1000:.2f} ms (x{ratio:.2f})"
+            )
+    return regressions
+
+
+async def run(scales, repeat):
+    from db import engine, init_db
+
+    await init_db()
+    results = {}
+    try:
+        for name in scales:
+            results.update(await bench_scale(name, repeat))
+    finally:
+        await engine.dispose()
+    return results
+
+
+def main():
+    args = parse_args()
+    scales = list(SCALES) if args.scales == "all" else [s.strip() for s in args.scales.split(",") if s.strip()]
+    unknown = [s for s in scales if s not in SCALES]
+    if unknown:
+        sys.exit(f"Unknown scales: {', '.join(unknown)}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        configure_environment(workdir)
+        results = asyncio.run(run(scales, args.repeat))
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_slowdown, args.min_delta)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regression above x{args.max_slowdown}")
+
+
+if __name__ == "__main__":
+    main()
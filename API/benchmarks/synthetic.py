@@ -0,0 +1,102 @@
+import random
+from datetime import date, timedelta
+from typing import Dict, List
+
+from sqlalchemy import insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import Transaction, TransactionType, User
+from services.positions import rebuild_positions
+from services.prices import Bar, FixturePriceProvider, sync_price_ranges
+
+
+def ticker_names(count: int) -> List[str]:
+    return [f"T{i:03d}.PA" for i in range(count)]
+
+
+# Toutes les séries partent de la même date : un ticker a les mêmes cours quelle que soit l'échelle
+PRICE_EPOCH = date.today() - timedelta(days=365 * 20 + 5)
+
+
+def price_bars(ticker: str, start: date, end: date) -> List[Bar]:
+    """
+    Deterministic random walk on business days, seeded by the ticker name.
+    """
+    rng = random.Random(ticker)
+    price = rng.uniform(20, 500)
+    bars = []
+    day = PRICE_EPOCH
+    while day <= end:
+        if day.weekday() < 5:
+            price = max(1.0, price * (1 + rng.gauss(0.0003, 0.015)))
+            if day >= start:
+                bars.append((day, round(price, 4)))
+        day += timedelta(days=1)
+    return bars
+
+
+def fixture_provider(tickers: List[str], start: date, end: date) -> FixturePriceProvider:
+    return FixturePriceProvider(bars={ticker: price_bars(ticker, start, end) for ticker in tickers})
+
+
+def ledger_rows(user_id: int, transactions: int, tickers: List[str], start: date, end: date, seed: int = 0) -> List[dict]:
+    """
+    Random but valid ledger: sales never exceed the quantity held.
+    """
+    rng = random.Random(seed)
+    span = (end - start).days
+    days = sorted(start + timedelta(days=rng.randrange(span + 1)) for _ in range(transactions))
+    held: Dict[str, int] = {}
+    rows = []
+    for day in days:
+        ticker = rng.choice(tickers)
+        if held.get(ticker, 0) > 0 and rng.random() < 0.3:
+            tx_type, quantity = TransactionType.vente, rng.randint(1, held[ticker])
+            held[ticker] -= quantity
+        else:
+            tx_type, quantity = TransactionType.achat, rng.randint(1, 50)
+            held[ticker] = held.get(ticker, 0) + quantity
+        rows.append({
+            "type": tx_type,
+            "ticker": ticker,
+            "quantity": quantity,
+            "price": round(rng.uniform(10, 500), 2),
+            "date_of": day,
+            "user_id": user_id,
+        })
+    return rows
+
+
+async def create_portfolio(
+    session: AsyncSession,
+    username: str,
+    transactions: int,
+    tickers: int,
+    years: int,
+    seed: int = 0
+) -> User:
+    """
+    Insert a user with a synthetic ledger, its positions, and offline prices
+    for every ticker it trades.
+    """
+    end = date.today()
+    start = end - timedelta(days=365 * years)
+    names = ticker_names(tickers)
+
+    user = User(username=username, email=f"{username}@bench.local", hashed_password="!")
+    session.add(user)
+    await session.commit()
+    await session.refresh(user)
+
+    rows = ledger_rows(user.id, transactions, names, start, end, seed)
+    for i in range(0, len(rows), 5000):
+        await session.exec(insert(Transaction), params=rows[i:i + 5000])
+    await rebuild_positions(session, user.id)
+
+    await sync_price_ranges(
+        session,
+        {ticker: start for ticker in names},
+        end,
+        provider=fixture_provider(names, start, end)
+    )
+    return user
@@ -1,17 +1,204 @@
-from sqlmodel import SQLModel, create_engine
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from fastapi import Request
+from fastapi.security.utils import get_authorization_scheme_param
 from dotenv import load_dotenv
+from instrumentation import instrument_engine
+from contextvars import ContextVar
+from itertools import cycle
+from typing import Dict, List, Optional
+import math
 import os
+import time
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Réplicas en lecture, séparés par des virgules ; sans réplica tout passe par le primaire
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
 
-engine = create_engine(DATABASE_URL, echo=True)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+# Après une écriture, les lectures de l'utilisateur restent sur le primaire le temps que les réplicas rattrapent
+DB_READ_YOUR_WRITES_SECONDS = float(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "5"))
+# Cookie portant la fin de cette fenêtre, pour les lectures servies par un autre worker
+READ_YOUR_WRITES_COOKIE = "primary_until"
 
-def init_db():
-    SQLModel.metadata.create_all(engine)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": "5000",
+    "temp_store": "MEMORY",
+    "cache_size": "-20000",
+}
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+
+def to_async_url(url: str) -> str:
+    """
+    Map a plain DATABASE_URL (sqlite:///..., postgresql://...) to its async driver.
+    URLs that already name a driver are left untouched.
+    """
+    scheme, sep, rest = url.partition("://")
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}{sep}{rest}"
+
+
+# SQL_ECHO=1 : affiche chaque requête (debug uniquement)
+SQL_ECHO = os.getenv("SQL_ECHO", "0") == "1"
+# DB_AUTO_MIGRATE=1 : le serveur applique lui-même le schéma au démarrage (dev uniquement)
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "0") == "1"
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL : les lecteurs ne bloquent plus l'écrivain (et inversement)
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def create_engine(url: str) -> AsyncEngine:
+    """
+    Async engine with the pool settings of the environment. SQLite engines
+    get WAL mode and the tuned pragmas on every new connection.
+    """
+    options = {"echo": SQL_ECHO, "pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+    sqlite = url.startswith("sqlite")
+    if not sqlite or ":memory:" not in url:
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+
+    new_engine = create_async_engine(to_async_url(url), **options)
+    if sqlite:
+        event.listen(new_engine.sync_engine, "connect", _apply_sqlite_pragmas)
+    instrument_engine(new_engine.sync_engine)
+    return new_engine
+
+
+engine = create_engine(DATABASE_URL)
+replica_engines: List[AsyncEngine] = [create_engine(url) for url in DATABASE_REPLICA_URLS]
+_replicas = cycle(replica_engines)
+_last_writes: Dict[int, float] = {}
+# Fin de fenêtre posée par record_write, lue par le middleware pour le cookie
+_primary_until: ContextVar[Optional[list]] = ContextVar("primary_until", default=None)
+
+
+def record_write(user_id: int):
+    """
+    Send the user's reads to the primary for DB_READ_YOUR_WRITES_SECONDS.
+    Call it after committing a write on behalf of the user.
+
+    The window is remembered by this process, and also returned to the
+    client in a cookie (see `read_your_writes_middleware`): the user's next
+    reads may be served by another worker or host, which only sees the
+    cookie. Clients that send no cookies get the guarantee only from the
+    worker that took the write.
+    """
+    if replica_engines:
+        _last_writes[user_id] = time.monotonic()
+        holder = _primary_until.get()
+        if holder is not None:
+            holder.append(time.time() + DB_READ_YOUR_WRITES_SECONDS)
+
+
+def _request_user_id(request: Request):
+    from routes.auth import decode_token
+
+    scheme, token = get_authorization_scheme_param(request.headers.get("Authorization"))
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return int(decode_token(token)["sub"])
+    except Exception:
+        return None
+
+
+def read_engine(request: Request) -> AsyncEngine:
+    """
+    Engine for a read-only request: the next replica in turn, or the primary
+    when there is none or when the caller wrote recently. Chosen once per
+    request, so its ETag check, its session and its job read the same database.
+    """
+    chosen = getattr(request.state, "read_engine", None)
+    if chosen is None:
+        chosen = request.state.read_engine = _choose_read_engine(request)
+    return chosen
+
+
+def _choose_read_engine(request: Request) -> AsyncEngine:
+    if not replica_engines:
+        return engine
+    try:
+        # Horloge murale : la fenêtre peut avoir été ouverte par un autre hôte
+        if float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0)) > time.time():
+            return engine
+    except ValueError:
+        pass
+    user_id = _request_user_id(request)
+    written_at = _last_writes.get(user_id) if user_id is not None else None
+    if written_at is not None:
+        if time.monotonic() - written_at < DB_READ_YOUR_WRITES_SECONDS:
+            return engine
+        _last_writes.pop(user_id, None)
+    return next(_replicas)
+
+async def read_your_writes_middleware(request: Request, call_next):
+    """
+    Set the read-your-writes cookie on responses to requests that wrote.
+    """
+    holder = []
+    token = _primary_until.set(holder)
+    try:
+        response = await call_next(request)
+    finally:
+        _primary_until.reset(token)
+    if holder:
+        response.set_cookie(
+            READ_YOUR_WRITES_COOKIE, str(math.ceil(max(holder))), max_age=math.ceil(DB_READ_YOUR_WRITES_SECONDS),
+            path="/api", httponly=True, samesite="lax"
+        )
+    return response
+
+
+async def init_db():
+    from migrations import migrate
+
+    await migrate(engine)
+
+async def check_db():
+    """
+    Serving startup: refuse to start on an outdated schema instead of running
+    DDL from every worker. Schema changes go through `python manage.py migrate`.
+    """
+    from migrations import pending_changes
+
+    if DB_AUTO_MIGRATE:
+        await init_db()
+        return
+    pending = await pending_changes(engine)
+    if pending:
+        raise RuntimeError(
+            f"Database schema is not up to date ({', '.join(pending)}): run `python manage.py migrate`"
+        )
 
 async def get_session():
-    with Session(engine) as session:
-        yield session
\ No newline at end of file
+    """
+    Session on the primary, for writes and for reads that must see them.
+    """
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        yield session
+
+async def get_read_session(request: Request):
+    """
+    Session for read-only routes, routed by `read_engine`.
+    """
+    async with AsyncSession(read_engine(request), expire_on_commit=False) as session:
+        yield session
@@ -0,0 +1,208 @@
+import logging
+import os
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+logger = logging.getLogger("api.log")
+
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", "25"))
+# Même requête SQL répétée au moins N fois dans une requête HTTP => N+1 probable
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+LabelValues = Tuple[str, ...]
+
+
+# -------------------------- Metrics --------------------------
+
+class MetricCounter:
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.values: Dict[LabelValues, float] = defaultdict(float)
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self.values[label_values] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class MetricHistogram:
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, tuple(labels), tuple(buckets)
+        self.counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = defaultdict(float)
+
+    def observe(self, value: float, *label_values: str):
+        counts = self.counts.setdefault(label_values, [0] * (len(self.buckets) + 1))
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[label_values] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, counts in sorted(self.counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), label_values + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {self.sums[label_values]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+class MetricGauges:
+    """
+    Values read at scrape time from a callback returning {name: value}.
+    """
+
+    def __init__(self, prefix: str, help_text: str, collect: Callable[[], dict]):
+        self.prefix, self.help, self.collect = prefix, help_text, collect
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, value in sorted(self.collect().items()):
+            if isinstance(value, (int, float)):
+                name = f"{self.prefix}_{key}"
+                lines += [f"# HELP {name} {self.help}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return lines
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+REQUEST_LATENCY = MetricHistogram("http_request_duration_seconds", "Handler latency", ("method", "route", "status"))
+REQUEST_QUERIES = MetricHistogram("http_request_sql_queries", "SQL statements per request", ("route",), COUNT_BUCKETS)
+REQUEST_SQL_TIME = MetricHistogram("http_request_sql_seconds", "Time spent in SQL per request", ("route",))
+REQUEST_PRICE_FETCHES = MetricHistogram("http_request_price_fetches", "External price fetches per request", ("route",), COUNT_BUCKETS)
+REQUEST_PRICE_TIME = MetricHistogram("http_request_price_fetch_seconds", "Time spent fetching prices per request", ("route",))
+PRICE_FETCHES = MetricCounter("price_fetches_total", "External price fetches, in or out of requests")
+PRICE_FETCH_TIME = MetricHistogram("price_fetch_batch_seconds", "Duration of price fetch batches")
+OVER_BUDGET = MetricCounter("http_requests_over_query_budget_total", "Requests exceeding QUERY_BUDGET statements", ("route",))
+N_PLUS_ONE = MetricCounter("http_requests_n_plus_one_total", "Requests repeating one statement N_PLUS_ONE_THRESHOLD times or more", ("route",))
+
+REGISTRY: List = [
+    REQUEST_LATENCY, REQUEST_QUERIES, REQUEST_SQL_TIME, REQUEST_PRICE_FETCHES, REQUEST_PRICE_TIME,
+    PRICE_FETCHES, PRICE_FETCH_TIME, OVER_BUDGET, N_PLUS_ONE,
+]
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+# -------------------------- Per-request stats --------------------------
+
+class RequestStats:
+    __slots__ = ("queries", "sql_seconds", "price_fetches", "price_seconds", "statements", "timings")
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.price_fetches = 0
+        self.price_seconds = 0.0
+        self.statements: Counter = Counter()
+        self.timings: List[Tuple[str, float]] = []
+
+
+_current_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def current_stats() -> Optional[RequestStats]:
+    return _current_stats.get()
+
+
+def record_price_fetch(count: int, seconds: float):
+    PRICE_FETCHES.inc(amount=count)
+    PRICE_FETCH_TIME.observe(seconds)
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.price_fetches += count
+        stats.price_seconds += seconds
+
+
+def record_timing(name: str, seconds: float):
+    """
+    Add a named step of the current request to its Server-Timing header.
+    """
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.timings.append((name, seconds))
+
+
+def instrument_engine(sync_engine):
+    """
+    Count statements and SQL time of the current request through engine events.
+    """
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.sql_seconds += elapsed
+            stats.statements[statement] += 1
+
+
+def _route_template(request) -> str:
+    route = request.scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+async def instrumentation_middleware(request, call_next):
+    stats = RequestStats()
+    token = _current_stats.set(stats)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        _current_stats.reset(token)
+    elapsed = time.perf_counter() - started
+
+    route = _route_template(request)
+    REQUEST_LATENCY.observe(elapsed, request.method, route, str(response.status_code))
+    REQUEST_QUERIES.observe(stats.queries, route)
+    REQUEST_SQL_TIME.observe(stats.sql_seconds, route)
+    REQUEST_PRICE_FETCHES.observe(stats.price_fetches, route)
+    REQUEST_PRICE_TIME.observe(stats.price_seconds, route)
+
+    if stats.queries > QUERY_BUDGET:
+        OVER_BUDGET.inc(route)
+        logger.warning("%s %s ran %d SQL statements (budget %d)", request.method, route, stats.queries, QUERY_BUDGET)
+    if stats.statements:
+        statement, repeats = stats.statements.most_common(1)[0]
+        if repeats >= N_PLUS_ONE_THRESHOLD:
+            N_PLUS_ONE.inc(route)
+            logger.warning("%s %s: possible N+1, statement run %d times: %s", request.method, route, repeats, statement[:200])
+
+    response.headers["Server-Timing"] = (
+        f'sql;dur={stats.sql_seconds * 1000:.1f};desc="{stats.queries} queries", '
+        f'prices;dur={stats.price_seconds * 1000:.1f};desc="{stats.price_fetches} fetches", '
+        + "".join(f"{name};dur={seconds * 1000:.1f}, " for name, seconds in stats.timings)
+        + f"total;dur={elapsed * 1000:.1f}"
+    )
+    return response
@@ -1,6 +1,19 @@
-from fastapi import FastAPI
-from routes import auth, transaction, user
-from db import init_db
+import asyncio
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import FileResponse, PlainTextResponse
+from routes import auth, jobs, transaction, user
+from db import check_db, read_your_writes_middleware
+from utils import password_pool
+from instrumentation import MetricGauges, instrumentation_middleware, register, render_metrics
+from profiling import PROFILE_TOKEN, PROFILING, is_authorized, profiler, profiling_middleware
+from services.jobs import job_queue
+from services.leases import run_with_lease
+from services.live import LIVE_POLL_INTERVAL, live_hub
+from services.nav import NAV_SCHEDULER, nav_scheduler
+from services.price_scheduler import PRICE_SCHEDULER, price_scheduler
+from services.prices import price_cache
+from services.response_cache import response_cache
+from services.user_cache import user_cache
 from fastapi.middleware.cors import CORSMiddleware
 
 
@@ -25,13 +38,78 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing", "ETag", "X-Stale-Prices", "Location", "Retry-After", "X-Profile-Id"],
 )
+# Ajouté avant l'instrumentation pour s'exécuter à l'intérieur : le profil lit ses statistiques
+if PROFILING:
+    profiler.install()
+    app.middleware("http")(profiling_middleware)
+app.middleware("http")(instrumentation_middleware)
+app.middleware("http")(read_your_writes_middleware)
+
+price_scheduler.add_listener(live_hub.prices_changed)
+
+register(MetricGauges("password_pool", "bcrypt process pool state", password_pool.stats))
+register(MetricGauges("user_cache", "Authenticated user cache state", user_cache.stats))
+register(MetricGauges("price_cache", "Per-ticker price column cache state", price_cache.stats))
+register(MetricGauges("price_scheduler", "Shared price refresh scheduler state", price_scheduler.stats))
+register(MetricGauges("job_queue", "Background job pool state", job_queue.stats))
+register(MetricGauges("live_hub", "Live valuation subscriptions", live_hub.stats))
+register(MetricGauges("response_cache", "Ledger-keyed response cache state", response_cache.stats))
 
 @app.on_event("startup")
-def on_startup():
-    init_db()
+async def on_startup():
+    await check_db()
+    # Chaque worker démarre les planificateurs, mais seul le détenteur du bail les exécute
+    if NAV_SCHEDULER:
+        app.state.nav_task = asyncio.create_task(run_with_lease("nav_scheduler", nav_scheduler))
+    if PRICE_SCHEDULER:
+        app.state.price_task = asyncio.create_task(run_with_lease("price_scheduler", price_scheduler.run))
+    if LIVE_POLL_INTERVAL > 0:
+        app.state.live_task = asyncio.create_task(live_hub.run())
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    for name in ("nav_task", "price_task", "live_task"):
+        if getattr(app.state, name, None) is not None:
+            getattr(app.state, name).cancel()
+    job_queue.shutdown()
+    password_pool.shutdown()
 
 
 app.include_router(auth.router, prefix="/api/auth", tags=["Auth"])
 app.include_router(transaction.router, prefix="/api/transaction")
-app.include_router(user.router, prefix="/api/user", tags=['User'])
\ No newline at end of file
+app.include_router(jobs.router, prefix="/api/jobs", tags=["Jobs"])
+app.include_router(user.router, prefix="/api/user", tags=['User'])
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def metrics():
+    return render_metrics()
+
+
+# Sans jeton, les profils échantillonnés restent dans PROFILE_DIR sans être servis
+if PROFILE_TOKEN:
+    def check_profile_token(token):
+        if not is_authorized(token):
+            raise HTTPException(status_code=403, detail="Invalid profile token")
+
+    @app.get("/profiles", include_in_schema=False)
+    def list_profiles(x_profile: str = Header(default=None)):
+        """
+        Summaries of the latest request profiles, newest first.
+        """
+        check_profile_token(x_profile)
+        return profiler.summaries()
+
+    @app.get("/profiles/{profile_id}", include_in_schema=False)
+    def read_profile(profile_id: str, x_profile: str = Header(default=None)):
+        """
+        Speedscope file of one profile, to open on https://www.speedscope.app.
+        """
+        check_profile_token(x_profile)
+        path = profiler.path_of(profile_id)
+        if path is None:
+            raise HTTPException(status_code=404, detail="Profile not found")
+        return FileResponse(path, media_type="application/json", filename=f"{profile_id}.speedscope.json")
@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from sqlmodel.ext.asyncio.session import AsyncSession
+from db import engine, init_db
+from migrations import migrate
+from services.nav import build_daily_nav
+from services.positions import rebuild_positions, user_ids_with_transactions, verify_positions
+from services.prices import FixturePriceProvider, sync_held_prices
+
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "3.0"))
+
+# Démarrage à froid mesuré dans un processus neuf : import de l'app puis hooks de startup
+STARTUP_PROBE = """
+import asyncio, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+asyncio.run(main.app.router.startup())
+print(imported - started, time.perf_counter() - imported)
+"""
+
+
+async def sync_prices_command(args):
+    provider = FixturePriceProvider(args.fixtures) if args.fixtures else None
+    async with AsyncSession(engine) as session:
+        report = await sync_held_prices(session, provider)
+    for ticker, count in sorted(report.stored.items()):
+        print(f"{ticker}: {count} new bars")
+    for ticker, message in sorted(report.errors.items()):
+        print(f"{ticker}: FAILED ({message})")
+
+
+async def rebuild_positions_command(args):
+    async with AsyncSession(engine) as session:
+        for user_id in await user_ids_with_transactions(session, args.user):
+            await rebuild_positions(session, user_id)
+            print(f"user {user_id}: positions rebuilt")
+
+
+async def verify_positions_command(args):
+    failed = False
+    async with AsyncSession(engine) as session:
+        for user_id in await user_ids_with_transactions(session, args.user):
+            errors = await verify_positions(session, user_id)
+            for error in errors:
+                print(f"user {user_id}: {error}")
+            failed = failed or bool(errors)
+    if failed:
+        return 1
+    print("positions consistent with the ledger")
+
+
+async def build_nav_command(args):
+    async with AsyncSession(engine) as session:
+        written = await build_daily_nav(session, [args.user] if args.user else None, full=args.full)
+    for user_id, count in sorted(written.items()):
+        print(f"user {user_id}: {count} NAV rows written")
+    print("daily NAV up to date")
+
+
+async def migrate_command(args):
+    for name in await migrate(engine):
+        print(f"applied {name}")
+    print("schema up to date")
+
+
+def parse_importtime(output: str) -> dict:
+    """
+    Self time per top-level package, in seconds, from `-X importtime` output.
+    """
+    packages = defaultdict(float)
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, module = line[len("import time:"):].split("|")
+        packages[module.strip().split(".")[0]] += int(self_us) / 1e6
+    return packages
+
+
+async def profile_startup_command(args):
+    env = {**os.environ, "NAV_SCHEDULER": "0", "PRICE_SCHEDULER": "0"}
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", STARTUP_PROBE],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True
+    )
+    if process.returncode != 0:
+        print(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "startup failed")
+        return 1
+
+    import_seconds, startup_seconds = map(float, process.stdout.split())
+    total = import_seconds + startup_seconds
+    print(f"cold start {total:.2f}s (imports {import_seconds:.2f}s, startup hooks {startup_seconds:.2f}s), budget {args.budget:.2f}s")
+    packages = sorted(parse_importtime(process.stderr).items(), key=lambda item: item[1], reverse=True)
+    for package, seconds in packages[:args.top]:
+        print(f"  {package:<30} {seconds * 1000:8.1f} ms")
+    if total > args.budget:
+        print("over budget")
+        return 1
+
+
+async def run(args):
+    if args.func not in (migrate_command, profile_startup_command):
+        await init_db()
+    try:
+        return await args.func(args)
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peasy Money maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="Create missing tables and apply pending migrations")
+    migrate_parser.set_defaults(func=migrate_command)
+
+    sync_parser = subparsers.add_parser("sync-prices", help="Fill the local price store for every traded ticker")
+    sync_parser.add_argument("--fixtures", help="Read prices from a fixture directory instead of the network")
+    sync_parser.set_defaults(func=sync_prices_command)
+
+    rebuild_parser = subparsers.add_parser("rebuild-positions", help="Replay the ledger into the positions tables")
+    rebuild_parser.add_argument("--user", type=int, help="Only this user id")
+    rebuild_parser.set_defaults(func=rebuild_positions_command)
+
+    verify_parser = subparsers.add_parser("verify-positions", help="Check the positions tables against the ledger")
+    verify_parser.add_argument("--user", type=int, help="Only this user id")
+    verify_parser.set_defaults(func=verify_positions_command)
+
+    nav_parser = subparsers.add_parser("build-nav", help="Extend the precomputed daily NAV series (run after market close)")
+    nav_parser.add_argument("--user", type=int, help="Only this user id")
+    nav_parser.add_argument("--full", action="store_true", help="Recompute the whole series instead of the stale suffix")
+    nav_parser.set_defaults(func=build_nav_command)
+
+    profile_parser = subparsers.add_parser("profile-startup", help="Measure the API cold start and fail above a budget")
+    profile_parser.add_argument("--budget", type=float, default=STARTUP_BUDGET, help="Seconds (default STARTUP_BUDGET)")
+    profile_parser.add_argument("--top", type=int, default=15, help="Number of packages listed by import time")
+    profile_parser.set_defaults(func=profile_startup_command)
+
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
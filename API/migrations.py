@@ -0,0 +1,100 @@
+from typing import List
+
+from sqlalchemy import bindparam, inspect, text
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from models import Position, SchemaMigration, Transaction
+from services.positions import CostBasis
+
+
+def create_transaction_indexes(conn):
+    # create_all ne crée les index que pour les nouvelles tables
+    for index in Transaction.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def add_cache_watermarks(conn):
+    # Colonnes ajoutées après coup : create_all ne modifie pas les tables existantes
+    inspector = inspect(conn)
+    if "ledger_version" not in {c["name"] for c in inspector.get_columns("user")}:
+        conn.execute(text('ALTER TABLE "user" ADD COLUMN ledger_version INTEGER NOT NULL DEFAULT 0'))
+    if "synced_at" not in {c["name"] for c in inspector.get_columns("pricecoverage")}:
+        conn.execute(text("ALTER TABLE pricecoverage ADD COLUMN synced_at TIMESTAMP"))
+
+
+def add_position_cost_basis(conn):
+    columns = {c["name"] for c in inspect(conn).get_columns("position")}
+    for name, ddl in (("cost_basis", "FLOAT NOT NULL DEFAULT 0"), ("realized_pnl", "FLOAT NOT NULL DEFAULT 0"), ("last_date", "DATE")):
+        if name not in columns:
+            conn.execute(text(f"ALTER TABLE position ADD COLUMN {name} {ddl}"))
+
+    # Rejoue le registre une fois pour remplir le PRU des positions existantes
+    transactions = Transaction.__table__
+    rows = conn.execute(
+        select(transactions.c.user_id, transactions.c.ticker, transactions.c.type, transactions.c.quantity,
+               transactions.c.price, transactions.c.date_of)
+        .order_by(transactions.c.user_id, transactions.c.ticker, transactions.c.date_of, transactions.c.id)
+    )
+    states, last_dates = {}, {}
+    for user_id, ticker, tx_type, quantity, price, date_of in rows:
+        states.setdefault((user_id, ticker), CostBasis()).apply(tx_type, quantity, price)
+        last_dates[(user_id, ticker)] = date_of
+    if states:
+        positions = Position.__table__
+        conn.execute(
+            positions.update()
+            .where(positions.c.user_id == bindparam("p_user"), positions.c.ticker == bindparam("p_ticker"))
+            .values(cost_basis=bindparam("p_cost"), realized_pnl=bindparam("p_realized"), last_date=bindparam("p_last")),
+            [
+                {"p_user": user_id, "p_ticker": ticker, "p_cost": state.cost, "p_realized": state.realized,
+                 "p_last": last_dates[(user_id, ticker)]}
+                for (user_id, ticker), state in states.items()
+            ]
+        )
+
+
+# Appliquées dans l'ordre, une seule fois par base
+MIGRATIONS = [
+    ("0001_transaction_indexes", create_transaction_indexes),
+    ("0002_cache_watermarks", add_cache_watermarks),
+    ("0003_position_cost_basis", add_position_cost_basis),
+]
+
+
+async def migrate(engine):
+    """
+    Create missing tables, then apply pending migrations. Returns the names applied.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+
+    async with AsyncSession(engine) as session:
+        applied = set((await session.exec(select(SchemaMigration.name))).all())
+
+    done = []
+    for name, step in MIGRATIONS:
+        if name in applied:
+            continue
+        async with engine.begin() as conn:
+            await conn.run_sync(step)
+            await conn.run_sync(
+                lambda sync_conn: sync_conn.execute(SchemaMigration.__table__.insert().values(name=name))
+            )
+        done.append(name)
+    return done
+
+
+async def pending_changes(engine) -> List[str]:
+    """
+    Missing tables and unapplied migrations, without changing anything:
+    what `migrate` would do.
+    """
+    async with engine.connect() as conn:
+        existing = set(await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_table_names()))
+    missing = [table.name for table in SQLModel.metadata.sorted_tables if table.name not in existing]
+    if SchemaMigration.__tablename__ in missing:
+        return [f"table {name}" for name in missing] + [name for name, _ in MIGRATIONS]
+
+    async with AsyncSession(engine) as session:
+        applied = set((await session.exec(select(SchemaMigration.name))).all())
+    return [f"table {name}" for name in missing] + [name for name, _ in MIGRATIONS if name not in applied]
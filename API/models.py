@@ -1,6 +1,7 @@
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import Index
 from enum import Enum
-from typing import Dict, Optional
+from typing import Any, Dict, List, Optional
 from datetime import date, datetime
 
 class TransactionType(str, Enum):
@@ -8,6 +9,11 @@ class TransactionType(str, Enum):
     vente = "vente"
 
 class Transaction(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_transaction_user_date_id", "user_id", "date_of", "id"),
+        Index("ix_transaction_user_ticker_date", "user_id", "ticker", "date_of"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     type: TransactionType
     ticker: str
@@ -18,6 +24,23 @@ class Transaction(SQLModel, table=True):
 
     user: "User" = Relationship(back_populates="transactions")
 
+class Position(SQLModel, table=True):
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    ticker: str = Field(primary_key=True)
+    quantity: float = 0
+    invested: float = 0
+    # Coût des titres détenus au PRU, et plus-values réalisées par les ventes
+    cost_basis: float = 0
+    realized_pnl: float = 0
+    last_date: Optional[date] = None
+
+class PositionChange(SQLModel, table=True):
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    ticker: str = Field(primary_key=True)
+    date_of: date = Field(primary_key=True)
+    quantity: float
+    invested: float
+
 class TransactionCreate(SQLModel):
     type: TransactionType
     ticker: str
@@ -31,6 +54,8 @@ class User(SQLModel, table=True):
     email: str = Field(index=True, unique=True)
     hashed_password: str
     created_at: datetime = Field(default_factory=datetime.now)
+    # Incrémentée à chaque écriture dans le registre : invalide les réponses en cache
+    ledger_version: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
     # subscription: str = Field(default="free")
 
     transactions: list[Transaction] = Relationship(back_populates="user")
@@ -39,10 +64,122 @@ class DailyQuantity(SQLModel):
     date: date
     tickers: Dict[str, int]
 
+class DailyQuantityColumns(SQLModel):
+    dates: List[date]
+    tickers: List[str]
+    quantities: List[List[int]]
+
 class DailyQuantityByTicker(SQLModel):
     date: date
     quantity: int
 
 class PEAHistoryPoint(SQLModel):
     date: date
-    value: float
\ No newline at end of file
+    value: float
+
+class DashboardBundle(SQLModel):
+    total_price: Optional[float] = None
+    total_invest: Optional[float] = None
+    tickers: Optional[List[str]] = None
+    total_transactions: Optional[int] = None
+    daily_quantity: Optional[List[DailyQuantity]] = None
+    total_history: Optional[List[PEAHistoryPoint]] = None
+    timings: Dict[str, float] = {}
+
+class PerformanceSummary(SQLModel):
+    start: date
+    end: date
+    start_value: float
+    end_value: float
+    net_flows: float
+    twr: float
+    twr_annualized: Optional[float] = None
+    xirr: Optional[float] = None
+    volatility: Optional[float] = None
+    max_drawdown: float
+    drawdown_peak: Optional[date] = None
+    drawdown_trough: Optional[date] = None
+
+class AnalyticsPoint(SQLModel):
+    date: date
+    value: float
+
+class TickerContribution(SQLModel):
+    ticker: str
+    pnl: float
+    contribution: float
+
+class TickerPnL(SQLModel):
+    ticker: str
+    quantity: float
+    average_cost: float
+    cost_basis: float
+    last_close: Optional[float] = None
+    market_value: float
+    unrealized_pnl: float
+    realized_pnl: float
+    stale: bool = False
+
+class PortfolioPnL(SQLModel):
+    cost_basis: float
+    market_value: float
+    unrealized_pnl: float
+    realized_pnl: float
+    total_pnl: float
+
+class ImportRowError(SQLModel):
+    row: int
+    error: str
+
+class ImportReport(SQLModel):
+    inserted: int
+    rejected: int
+    errors: List[ImportRowError]
+
+class PriceRefreshReport(SQLModel):
+    stored: Dict[str, int]
+    errors: Dict[str, str]
+
+class JobStatus(SQLModel):
+    id: str
+    path: str
+    status: str
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    result: Optional[Any] = None
+    error: Optional[str] = None
+
+class PriceBar(SQLModel, table=True):
+    ticker: str = Field(primary_key=True)
+    date_of: date = Field(primary_key=True)
+    close: float
+
+class PriceCoverage(SQLModel, table=True):
+    ticker: str = Field(primary_key=True)
+    first_date: date
+    last_date: date
+    synced_at: Optional[datetime] = None
+
+class DailyNav(SQLModel, table=True):
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    date_of: date = Field(primary_key=True)
+    value: float
+    invested: float
+
+class NavStatus(SQLModel, table=True):
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    # Dernière date calculée ; les lignes à partir de dirty_from sont à recalculer
+    last_date: Optional[date] = None
+    dirty_from: Optional[date] = None
+
+class SchedulerLease(SQLModel, table=True):
+    # Une tâche planifiée ne tourne que dans le worker qui détient son bail
+    name: str = Field(primary_key=True)
+    owner: str
+    expires_at: datetime
+
+
+class SchemaMigration(SQLModel, table=True):
+    name: str = Field(primary_key=True)
+    applied_at: datetime = Field(default_factory=datetime.now)
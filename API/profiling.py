@@ -0,0 +1,301 @@
+"""
+Opt-in sampling profiler: requests sent with `X-Profile: <PROFILE_TOKEN>`, or
+picked at PROFILE_SAMPLE_RATE, are written as speedscope files to PROFILE_DIR.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import signal
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from instrumentation import _route_template, current_stats
+
+try:
+    from greenlet import getcurrent
+except ImportError:
+    getcurrent = None
+
+logger = logging.getLogger("api.log")
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.002"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "100"))
+PROFILING = bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+PROFILE_SUFFIX = ".speedscope.json"
+SUMMARY_SUFFIX = ".summary.json"
+# Identifiant horodaté : l'ordre alphabétique des fichiers est l'ordre chronologique
+_PROFILE_ID = re.compile(r"^\d{8}-\d{6}-\d{6}-[0-9a-f]{8}$")
+
+# Frames de la boucle d'événements et des middlewares, communs à tous les échantillons
+_SKIPPED_MODULES = (
+    os.path.dirname(asyncio.__file__) + os.sep, "/starlette/", "/anyio/", "/uvicorn/",
+    # Amorce des threads de jobs
+    threading.__file__, "/concurrent/futures/",
+)
+_SQL_MODULES = ("/sqlalchemy/", "/sqlmodel/", "/aiosqlite/", "/asyncpg/")
+_PRICE_MODULES = ("services/prices.py", "services/price_scheduler.py", "/yfinance/")
+
+Frame = Tuple[str, str, int]
+
+
+def _in_modules(filename: str, modules: Tuple[str, ...]) -> bool:
+    return any(module in filename for module in modules)
+
+
+def _category(filenames: List[str]) -> str:
+    if any(_in_modules(filename, _SQL_MODULES) for filename in filenames):
+        return "sql"
+    if any(_in_modules(filename, _PRICE_MODULES) for filename in filenames):
+        return "prices"
+    return "compute"
+
+
+class RequestProfile:
+    """
+    Stack samples of one request, stored as indexes into a frame table.
+    """
+    __slots__ = ("id", "method", "path", "started_at", "frames", "frame_index", "samples")
+
+    def __init__(self, method: str, path: str):
+        self.id = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{uuid.uuid4().hex[:8]}"
+        self.method = method
+        self.path = path
+        self.started_at = datetime.now()
+        self.frames: List[Frame] = []
+        self.frame_index: Dict[Frame, int] = {}
+        self.samples: List[List[int]] = []
+
+    def _index(self, frame: Frame) -> int:
+        index = self.frame_index.get(frame)
+        if index is None:
+            index = self.frame_index[frame] = len(self.frames)
+            self.frames.append(frame)
+        return index
+
+    def add(self, frame, main_thread: bool = True):
+        stack = []
+        # Les greenlets d'un autre thread ne sont pas accessibles d'ici
+        current = getcurrent() if getcurrent is not None and main_thread else None
+        while frame is not None:
+            code = frame.f_code
+            if not _in_modules(code.co_filename, _SKIPPED_MODULES):
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+            # Le SQL asynchrone de SQLAlchemy tourne dans un greenlet : la pile continue dans son parent
+            if frame is None and current is not None and current.parent is not None:
+                current = current.parent
+                frame = current.gr_frame
+        stack.reverse()
+        # Catégorie en racine : le flamegraph sépare SQL, cours et calcul
+        category = _category([filename for _, filename, _ in stack])
+        self.samples.append([self._index((f"[{category}]", "", 0))] + [self._index(entry) for entry in stack])
+
+    def categories(self) -> Dict[str, float]:
+        totals = {"sql": 0.0, "prices": 0.0, "compute": 0.0}
+        for sample in self.samples:
+            totals[self.frames[sample[0]][0].strip("[]")] += PROFILE_INTERVAL
+        return totals
+
+    def to_speedscope(self, elapsed: float) -> dict:
+        return {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": f"{self.method} {self.path}",
+            "exporter": "peasy-money",
+            "shared": {"frames": [
+                {"name": name, "file": filename, "line": line} if filename else {"name": name}
+                for name, filename, line in self.frames
+            ]},
+            "profiles": [{
+                "type": "sampled",
+                "name": f"{self.method} {self.path} ({elapsed * 1000:.0f} ms)",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": len(self.samples) * PROFILE_INTERVAL,
+                "samples": self.samples,
+                "weights": [PROFILE_INTERVAL] * len(self.samples),
+            }],
+        }
+
+
+_active_profile: ContextVar[Optional[RequestProfile]] = ContextVar("active_profile", default=None)
+# Threads de travail (jobs) échantillonnés pour le compte d'une requête profilée. Seuls ceux-ci et
+# la boucle le sont : les endpoints `def` du threadpool de Starlette n'apparaissent que comme une attente
+_thread_profiles: Dict[int, RequestProfile] = {}
+
+
+@contextmanager
+def profile_thread():
+    """
+    While the block runs, sample the current worker thread into the profile
+    of the request it works for, if that request is profiled.
+    """
+    profile = _active_profile.get()
+    if profile is None:
+        yield
+        return
+    thread_id = threading.get_ident()
+    _thread_profiles[thread_id] = profile
+    try:
+        yield
+    finally:
+        _thread_profiles.pop(thread_id, None)
+
+
+class Profiler:
+    """
+    Arms the SIGPROF timer while profiled requests are in flight, and
+    writes each profile with its summary to `directory`, keeping the last
+    `keep` of them.
+    """
+
+    def __init__(self, directory: str = PROFILE_DIR, interval: float = PROFILE_INTERVAL, keep: int = PROFILE_KEEP):
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self.in_flight = 0
+        self.installed = False
+
+    def install(self):
+        """
+        Set the signal handler. Must run in the main thread, which is also
+        where the event loop runs under uvicorn.
+        """
+        try:
+            signal.signal(signal.SIGPROF, self._on_signal)
+            self.installed = True
+        except (AttributeError, ValueError) as e:
+            logger.warning("Request profiling unavailable: %s", e)
+
+    @staticmethod
+    def _on_signal(signum, frame):
+        profile = _active_profile.get()
+        if profile is not None:
+            profile.add(frame)
+        if _thread_profiles:
+            frames = sys._current_frames()
+            for thread_id, thread_profile in list(_thread_profiles.items()):
+                if thread_id in frames:
+                    thread_profile.add(frames[thread_id], main_thread=False)
+
+    def start(self):
+        self.in_flight += 1
+        if self.in_flight == 1 and self.installed:
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        self.in_flight -= 1
+        if self.in_flight == 0 and self.installed:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+
+    def save(self, profile: RequestProfile, elapsed: float, status_code: int) -> dict:
+        os.makedirs(self.directory, exist_ok=True)
+        filename = f"{profile.id}{PROFILE_SUFFIX}"
+        with open(os.path.join(self.directory, filename), "w") as f:
+            json.dump(profile.to_speedscope(elapsed), f)
+
+        stats = current_stats()
+        wall = {
+            "sql": stats.sql_seconds if stats else 0.0,
+            "prices": stats.price_seconds if stats else 0.0,
+        }
+        wall["compute"] = max(0.0, elapsed - wall["sql"] - wall["prices"])
+        summary = {
+            "id": profile.id,
+            "file": filename,
+            "method": profile.method,
+            "path": profile.path,
+            "status": status_code,
+            "started_at": profile.started_at.isoformat(timespec="milliseconds"),
+            "duration_ms": round(elapsed * 1000, 1),
+            "samples": len(profile.samples),
+            "wall_ms": {name: round(seconds * 1000, 1) for name, seconds in wall.items()},
+            "sampled_ms": {name: round(seconds * 1000, 1) for name, seconds in profile.categories().items()},
+        }
+        with open(os.path.join(self.directory, f"{profile.id}{SUMMARY_SUFFIX}"), "w") as f:
+            json.dump(summary, f)
+        self._prune()
+        return summary
+
+    def _ids(self) -> List[str]:
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(name[:-len(SUMMARY_SUFFIX)] for name in names if name.endswith(SUMMARY_SUFFIX))
+
+    def _prune(self):
+        for profile_id in self._ids()[:-self.keep]:
+            for suffix in (PROFILE_SUFFIX, SUMMARY_SUFFIX):
+                try:
+                    os.remove(os.path.join(self.directory, profile_id + suffix))
+                except OSError:
+                    # Déjà supprimé par un autre worker
+                    pass
+
+    def summaries(self) -> List[dict]:
+        """
+        Summaries of the profiles in the directory, newest first.
+        """
+        # Lues sur disque et non en mémoire : les workers partageant PROFILE_DIR servent les profils de tous
+        summaries = []
+        for profile_id in reversed(self._ids()):
+            try:
+                with open(os.path.join(self.directory, profile_id + SUMMARY_SUFFIX)) as f:
+                    summaries.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return summaries
+
+    def path_of(self, profile_id: str) -> Optional[str]:
+        if not _PROFILE_ID.match(profile_id):
+            return None
+        path = os.path.join(self.directory, profile_id + PROFILE_SUFFIX)
+        return path if os.path.exists(path) else None
+
+
+profiler = Profiler()
+
+
+def is_authorized(token: Optional[str]) -> bool:
+    return bool(PROFILE_TOKEN) and token is not None and hmac.compare_digest(token, PROFILE_TOKEN)
+
+
+async def profiling_middleware(request, call_next):
+    if request.url.path.startswith("/profiles") or not is_authorized(request.headers.get("X-Profile")) and not (
+        PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+    ):
+        return await call_next(request)
+
+    profile = RequestProfile(request.method, request.url.path)
+    token = _active_profile.set(profile)
+    profiler.start()
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        profiler.stop()
+        _active_profile.reset(token)
+    elapsed = time.perf_counter() - started
+
+    profile.path = _route_template(request) if request.scope.get("route") else request.url.path
+    try:
+        profiler.save(profile, elapsed, response.status_code)
+        response.headers["X-Profile-Id"] = profile.id
+    except OSError:
+        logger.exception("Could not write profile %s", profile.id)
+    return response
@@ -1,11 +1,14 @@
-from fastapi import APIRouter, HTTPException, Depends, Response, status
-from sqlmodel import Session, select
+from fastapi import APIRouter, HTTPException, Depends, Query, Response, status
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from models import User
-from db import get_session
-from utils import hash_password, verify_password
+from db import get_session, record_write
+from utils import PasswordPoolBusy, password_pool
+from services.user_cache import user_cache
 from pydantic import BaseModel
 from jose import jwt
 from datetime import datetime, timedelta
+from typing import Optional
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from dotenv import load_dotenv
 import os 
@@ -17,8 +20,13 @@ router = APIRouter()
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+TRUST_TOKEN_CLAIMS = os.getenv("TRUST_TOKEN_CLAIMS", "0") == "1"
+# Jeton des flux SSE : EventSource ne peut pas envoyer d'en-tête, il passe dans l'URL, donc bref
+STREAM_TOKEN_EXPIRE_SECONDS = int(os.getenv("STREAM_TOKEN_EXPIRE_SECONDS", "60"))
+STREAM_SCOPE = "stream"
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login", auto_error=False)
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
@@ -38,66 +46,165 @@ class Token(BaseModel):
     token_type: str
 
 
+class StreamToken(BaseModel):
+    stream_token: str
+    expires_in: int
+
+
+def password_pool_busy():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Service momentanément surchargé, réessayez",
+        headers={"Retry-After": "1"},
+    )
+
+
 @router.post("/register", status_code=status.HTTP_201_CREATED)
-def register(data: RegisterRequest, session: Session = Depends(get_session)):
-    user_exists = session.exec(select(User).where(User.username == data.username)).first()
+async def register(data: RegisterRequest, session: AsyncSession = Depends(get_session)):
+    user_exists = (await session.exec(select(User).where(User.username == data.username))).first()
     if user_exists:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Nom d'utilisateur déjà pris")
 
+    try:
+        hashed_password = await password_pool.hash(data.password)
+    except PasswordPoolBusy:
+        raise password_pool_busy()
+
     user = User(
         username=data.username,
         email=data.email,
-        hashed_password=hash_password(data.password),
+        hashed_password=hashed_password,
     )
     session.add(user)
-    session.commit()
-    session.refresh(user)
+    await session.commit()
+    record_write(user.id)
+    await session.refresh(user)
     return {"message": "Utilisateur créé", "id": user.id}
 
 
 @router.post("/login", response_model=Token)
-def login(
+async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
-    user = session.exec(
+    user = (await session.exec(
         select(User).where(
             (User.username == form_data.username) | (User.email == form_data.username)
         )
-    ).first()
+    )).first()
+
+    valid, new_hash = False, None
+    if user:
+        try:
+            valid, new_hash = await password_pool.verify_and_update(form_data.password, user.hashed_password)
+        except PasswordPoolBusy:
+            raise password_pool_busy()
 
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Identifiants invalides",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    access_token = create_access_token({"sub": str(user.id)})
+    if new_hash:
+        # Coût bcrypt modifié depuis la création du hash
+        user.hashed_password = new_hash
+        session.add(user)
+        await session.commit()
+        user_cache.invalidate(user.id)
+
+    access_token = create_access_token({"sub": str(user.id), "username": user.username, "email": user.email})
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), session: Session = Depends(get_session)):
+class TokenIdentity(BaseModel):
+    """
+    Identity rebuilt from the signed JWT claims alone, without touching the database.
+    """
+    id: int
+    username: str
+    email: str
+
+
+def credentials_exception():
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+def decode_token(token: str, scope: Optional[str] = None) -> dict:
+    """
+    Claims of a valid token. Tokens carry a scope only when restricted
+    (stream tokens): one is accepted only where that scope is expected.
+    """
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Could not validate credentials",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-    except jwt.JWTError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    user = session.get(User, user_id)
+        int(payload["sub"])
+    except (jwt.JWTError, KeyError, TypeError, ValueError):
+        raise credentials_exception()
+    if payload.get("scope") != scope:
+        raise credentials_exception()
+    return payload
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), session: AsyncSession = Depends(get_session)):
+    return await load_user(int(decode_token(token)["sub"]), session)
+
+
+async def load_user(user_id: int, session: AsyncSession) -> User:
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
+    user = await session.get(User, user_id)
     if user is None:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    return user
+        raise credentials_exception()
+    return user_cache.put(user)
+
+
+async def get_current_identity(token: str = Depends(oauth2_scheme), session: AsyncSession = Depends(get_session)):
+    """
+    Authentication for read-only endpoints. With TRUST_TOKEN_CLAIMS enabled the
+    identity comes from the token claims; a deleted user then keeps access
+    until the token expires.
+    """
+    if TRUST_TOKEN_CLAIMS:
+        payload = decode_token(token)
+        if "username" in payload and "email" in payload:
+            return TokenIdentity(id=int(payload["sub"]), username=payload["username"], email=payload["email"])
+    return await get_current_user(token, session)
+
+
+async def get_stream_identity(
+    token: Optional[str] = Query(default=None, description="Stream token from POST /api/auth/stream-token"),
+    bearer: Optional[str] = Depends(optional_oauth2_scheme),
+    session: AsyncSession = Depends(get_session)
+):
+    """
+    Authentication for server-sent event endpoints: the usual Bearer header,
+    or, for browsers' EventSource which cannot set headers, a stream token
+    in the `token` query parameter. Only the opening of the stream is
+    checked; it stays open after the token expires.
+    """
+    if bearer:
+        return await get_current_identity(bearer, session)
+    if not token:
+        raise credentials_exception()
+    return await load_user(int(decode_token(token, scope=STREAM_SCOPE)["sub"]), session)
+
+
+@router.post("/stream-token", response_model=StreamToken)
+async def create_stream_token(current_user: User = Depends(get_current_identity)):
+    """
+    Short-lived token to open a server-sent event stream with EventSource
+    (`?token=...`). It is only accepted by stream endpoints and expires
+    after STREAM_TOKEN_EXPIRE_SECONDS, so one leaked through an access log
+    cannot be used as an access token.
+    """
+    token = create_access_token(
+        {"sub": str(current_user.id), "scope": STREAM_SCOPE}, timedelta(seconds=STREAM_TOKEN_EXPIRE_SECONDS)
+    )
+    return {"stream_token": token, "expires_in": STREAM_TOKEN_EXPIRE_SECONDS}
@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+
+from models import JobStatus, User
+from routes.auth import get_current_identity, get_stream_identity
+from services.jobs import Job, job_queue
+from services.live import LIVE_HEARTBEAT
+
+router = APIRouter()
+
+
+def get_user_job(job_id: str, current_user: User) -> Job:
+    job = job_queue.get(job_id, current_user.id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.get("/{job_id}", response_model=JobStatus)
+async def read_job(
+    job_id: str,
+    wait: float = Query(default=0, ge=0, le=30),
+    current_user: User = Depends(get_current_identity)
+):
+    """
+    Status of a job, with its result once done. `wait` holds the request up
+    to that many seconds for the job to finish (long polling).
+    """
+    job = get_user_job(job_id, current_user)
+    if wait and not job.done.is_set():
+        try:
+            await asyncio.wait_for(job.done.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+    return job.to_status()
+
+
+@router.get("/{job_id}/stream")
+async def stream_job(job_id: str, current_user: User = Depends(get_stream_identity)):
+    """
+    Server-sent events: the job status now, then again when it finishes.
+    EventSource clients authenticate with `?token=` from POST
+    /api/auth/stream-token.
+    """
+    job = get_user_job(job_id, current_user)
+
+    async def events():
+        yield f"event: status\ndata: {json.dumps(jsonable_encoder(job.to_status()))}\n\n"
+        while not job.done.is_set():
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout=LIVE_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+        yield f"event: status\ndata: {json.dumps(jsonable_encoder(job.to_status()))}\n\n"
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,161 +1,434 @@
-from collections import defaultdict
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlmodel import select, Session
-from sqlalchemy import func, cast, Date, case
-from typing import List, Dict, Optional
-from db import get_session
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import APIRouter, BackgroundTasks, Depends, File, HTTPException, Query, Request, Response, UploadFile
+from sqlmodel.ext.asyncio.session import AsyncSession
+from typing import List, Dict, Optional, Union
+from db import get_read_session, get_session, read_engine, record_write
 import logging
-from models import PEAHistoryPoint, Transaction, TransactionCreate, DailyQuantity, DailyQuantityByTicker, User
-from routes.auth import get_current_user
+from models import AnalyticsPoint, DashboardBundle, ImportReport, PEAHistoryPoint, PerformanceSummary, PortfolioPnL, TickerContribution, TickerPnL, PriceRefreshReport, Transaction, TransactionCreate, DailyQuantity, DailyQuantityByTicker, DailyQuantityColumns, User
+from routes.auth import get_current_identity, get_current_user, get_stream_identity
 from services.transactions import *
+from services.dashboard import WIDGETS, get_user_dashboard
+from services.analytics import get_user_contributions, get_user_performance, get_user_rolling_volatility
+from services.exports import EXPORT_MEDIA_TYPES, HISTORY_COLUMNS, TRANSACTION_COLUMNS, encode_rows, iterate_chunks, parquet_available, stream_transaction_rows
+from services.imports import BROKER_MAPPINGS, import_transactions
+from services.jobs import JobRejected, job_queue
+from services.live import LiveSubscriptionLimit, live_hub
+from services.nav import mark_nav_dirty, refresh_nav_task
+from services.positions import apply_transaction
+from services.price_scheduler import get_stale_tickers, price_scheduler
+from services.response_cache import LedgerCachedRoute, bump_ledger_version
 from datetime import date, timedelta
-import yfinance as yf
 
-router = APIRouter()
+router = APIRouter(route_class=LedgerCachedRoute)
 logger = logging.getLogger("api.log")
 
 
+def export_response(body, file_format: str, name: str) -> StreamingResponse:
+    if file_format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=501, detail="Parquet export requires pyarrow")
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_MEDIA_TYPES[file_format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{file_format}"'},
+    )
+
+
+async def flag_stale_prices(response: Response, session: AsyncSession, current_user: User):
+    """
+    List in `X-Stale-Prices` the held tickers valued with prices the
+    refresh scheduler has not updated recently.
+    """
+    stale = await get_stale_tickers(session, current_user.id)
+    if stale:
+        response.headers["X-Stale-Prices"] = ",".join(stale)
+
+
+async def run_as_job(request: Request, session: AsyncSession, current_user: User, compute):
+    """
+    Run an expensive read through the job queue, which bounds how many run
+    at once and shares identical ones. With `Prefer: respond-async` the
+    client gets 202 and polls `/api/jobs/{id}` instead of waiting.
+    """
+    try:
+        job = await job_queue.submit(session, request, current_user.id, compute, read_engine(request))
+    except JobRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    if "respond-async" in request.headers.get("Prefer", "") and not job.done.is_set():
+        return JSONResponse(
+            jsonable_encoder(job.to_status()),
+            status_code=202,
+            headers={"Location": f"/api/jobs/{job.id}", "Preference-Applied": "respond-async"}
+        )
+    return await job_queue.result(job)
+
+
 # -------------------------- GET --------------------------
 
 @router.get("/", response_model=List[Transaction], tags=["Transactions"])
 async def get_transactions(
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user),
+    response: Response,
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity),
     limit: int = Query(None, le=100, alias="page_size"),
-    offset: int = Query(0, ge=0, alias="page")
+    offset: int = Query(0, ge=0, alias="page"),
+    cursor: Optional[str] = Query(default=None)
 ):
     """
-    Get transactions for the authenticated user, with optional pagination.
+    Get transactions for the authenticated user ordered by date, with optional pagination.
+    When `page_size` is set and more rows exist, the `X-Next-Cursor` header holds an opaque
+    cursor to pass back as `cursor` for the next page.
     """
-    return get_user_transactions(session, current_user, limit, offset)
+    if cursor is not None and limit is None:
+        limit = 100
+
+    if limit is None:
+        return await get_user_transactions(session, current_user, None, offset, cursor)
+
+    transactions = await get_user_transactions(session, current_user, limit + 1, offset, cursor)
+    if len(transactions) > limit:
+        transactions = transactions[:limit]
+        last = transactions[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.date_of, last.id)
+    return transactions
 
 
 @router.get("/total", response_model=int, tags=["Transactions"])
 async def get_total_transactions(
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
 ):
     """
     Get the total number of transactions for the authenticated user.
     """
-    return get_user_total_transactions(session, current_user)
+    return await get_user_total_transactions(session, current_user)
+
+
+@router.get("/export", tags=["Transactions"])
+async def export_transactions(
+    request: Request,
+    file_format: str = Query(default="csv", alias="format", pattern="^(csv|ndjson|parquet)$"),
+    current_user: User = Depends(get_current_identity)
+):
+    """
+    Stream every transaction of the authenticated user as CSV, NDJSON or Parquet.
+    Rows are read in chunks from a server-side cursor, so memory stays constant.
+    Parquet needs the optional pyarrow package and answers 501 without it.
+    """
+    return export_response(
+        encode_rows(stream_transaction_rows(read_engine(request), current_user.id), TRANSACTION_COLUMNS, file_format),
+        file_format,
+        "transactions"
+    )
+
+
+@router.get("/dashboard", response_model=DashboardBundle, response_model_exclude_none=True, tags=["Transactions"])
+async def get_dashboard(
+    request: Request,
+    response: Response,
+    widgets: List[str] = Query(default=list(WIDGETS)),
+    period: str = Query(default="5a"),
+    date_param: Optional[date] = Query(default=None),
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
+):
+    """
+    Several dashboard widgets in one round trip, computed from a single read
+    of the ledger and of its prices. `widgets` selects among total_price,
+    total_invest, tickers, total_transactions, daily_quantity and total_history
+    (all by default); `period` applies to total_history and `date_param` to
+    total_price. `timings` gives the milliseconds spent on each widget and on
+    the shared loads (load_ledger, load_prices). Runs through the job queue
+    like the other heavy reads.
+    """
+    if {"total_price", "total_history"} & set(widgets):
+        await flag_stale_prices(response, session, current_user)
+    return await run_as_job(
+        request, session, current_user,
+        lambda job_session: get_user_dashboard(widgets, period, date_param, job_session, current_user)
+    )
 
 
 @router.get("/{transaction_id}", response_model=Transaction, tags=["Transactions"])
 async def get_transaction(
     transaction_id: int,
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
 ):
     """
     Get a specific transaction for the authenticated user.
     """
-    return get_user_transaction_by_id(transaction_id, session, current_user)
+    return await get_user_transaction_by_id(transaction_id, session, current_user)
 
 
 @router.get("/tickers/", response_model=List[str], tags=["Transactions"])
 async def get_all_tickers(
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
 ):
     """
     Get all tickers for the authenticated user.
     """
-    return get_user_all_tickers(session, current_user)
+    return await get_user_all_tickers(session, current_user)
 
 
-@router.get("/ticker/daily-quantity/", response_model=List[DailyQuantity], tags=["Transactions"])
+@router.get("/ticker/daily-quantity/", response_model=Union[List[DailyQuantity], DailyQuantityColumns], tags=["Transactions"])
 async def get_daily_quantity_by_ticker(
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    start: Optional[date] = Query(default=None),
+    end: Optional[date] = Query(default=None),
+    tickers: Optional[List[str]] = Query(default=None),
+    layout: str = Query(default="rows", pattern="^(rows|columns)$"),
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
 ):
     """
-    Get the daily quantity of each ticker for the authenticated user.
+    Get the quantity of each ticker at every date it changed for the authenticated user,
+    optionally restricted to a date range and a set of tickers.
+    With `layout=columns`, quantities are returned as one list per ticker aligned with `dates`.
     """
-    return get_user_daily_quantity_by_ticker(session, current_user)
+    if layout == "columns":
+        return await get_user_daily_quantity_columns(session, current_user, start, end, tickers)
+    return await get_user_daily_quantity_by_ticker(session, current_user, start, end, tickers)
 
 
 @router.get("/ticker/daily-quantity/{transaction_ticker}", response_model=List[DailyQuantityByTicker], tags=["Transactions"])
 async def get_daily_quantity_by_ticker(
     transaction_ticker: str,
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    start: Optional[date] = Query(default=None),
+    end: Optional[date] = Query(default=None),
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
 ):
-    daily_changes_subquery = (
-        select(
-            Transaction.date_of.label("date"),
-            func.sum(
-                case(
-                    (Transaction.type == "achat", Transaction.quantity),
-                    else_=-Transaction.quantity,
-                )
-            ).label("daily_change"),
-        )
-        .where(
-            Transaction.ticker == transaction_ticker,
-            Transaction.user_id == current_user.id
-        )
-        .group_by("date")
-        .subquery()
-    )
-
-    daily_quantity_query = (
-        select(
-            daily_changes_subquery.c.date,
-            func.sum(daily_changes_subquery.c.daily_change)
-            .over(order_by=daily_changes_subquery.c.date)
-            .label("cumulative_quantity"),
-        )
-        .order_by(daily_changes_subquery.c.date)
-    )
-
-    results = session.exec(daily_quantity_query).all()
+    results = await get_user_quantity_changes(session, current_user, [transaction_ticker], end)
 
     formatted_results = [
-        {"date": date, "quantity": quantity} for date, quantity in results
+        {"date": date, "quantity": quantity}
+        for _, date, quantity in results
+        if start is None or date >= start
     ]
 
     return formatted_results
 
 
 @router.get("/price/total_invest", response_model=float, tags=["Transactions"])
-def get_total_invest_price(
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+async def get_total_invest_price(
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
+):
+    """
+    Cost of the shares currently held, at their weighted-average unit cost (PRU).
+    """
+    return await get_user_total_invest_price(session, current_user)
+
+
+@router.get("/price/pnl", response_model=List[TickerPnL], tags=["Transactions"])
+async def get_pnl_by_ticker(
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
 ):
-    return get_user_total_invest_price(session, current_user)
+    """
+    PRU, cost basis, realized and unrealized P&L of each ticker of the authenticated user.
+    Rows valued with stale prices have `stale` set.
+    """
+    return await get_user_pnl_by_ticker(session, current_user)
+
+
+@router.get("/price/pnl/total", response_model=PortfolioPnL, tags=["Transactions"])
+async def get_pnl_total(
+    response: Response,
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
+):
+    """
+    Portfolio-level cost basis, market value, realized and unrealized P&L.
+    """
+    await flag_stale_prices(response, session, current_user)
+    return await get_user_pnl_total(session, current_user)
 
 
 @router.get("/price/total", response_model=float, tags=["Transactions"])
-def get_total_price_by_date(
+async def get_total_price_by_date(
+    response: Response,
     date_param: Optional[date] = Query(default=None),
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
 ):
-    return get_user_total_price_by_date(date_param, session, current_user)
+    await flag_stale_prices(response, session, current_user)
+    return await get_user_total_price_by_date(date_param, session, current_user)
+
+@router.get("/price/total/stream", tags=["Transactions"])
+async def stream_total_price(current_user: User = Depends(get_stream_identity)):
+    """
+    Server-sent events with the current portfolio value, pushed again only
+    when the price of a held ticker or the ledger changes. EventSource
+    clients authenticate with `?token=` from POST /api/auth/stream-token.
+    """
+    try:
+        live_hub.check_capacity()
+    except LiveSubscriptionLimit:
+        raise HTTPException(status_code=503, detail="Too many live subscriptions")
+    return StreamingResponse(
+        live_hub.events(current_user.id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @router.get("/price/total_history", response_model=List[PEAHistoryPoint], tags=["Transactions"])
-def get_pea_history(
+async def get_pea_history(
+    request: Request,
+    response: Response,
     period: str = Query(default="5a"),
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
 ):
-    return get_user_pea_history(period, session, current_user)
+    await flag_stale_prices(response, session, current_user)
+    return await run_as_job(
+        request, session, current_user, lambda job_session: get_user_pea_history(period, job_session, current_user)
+    )
+
+@router.get("/price/total_history/export", tags=["Transactions"])
+async def export_pea_history(
+    period: str = Query(default="5a"),
+    file_format: str = Query(default="csv", alias="format", pattern="^(csv|ndjson|parquet)$"),
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
+):
+    """
+    Stream the portfolio value history as CSV, NDJSON or Parquet (Parquet
+    needs the optional pyarrow package and answers 501 without it).
+    """
+    points = await get_user_pea_history(period, session, current_user)
+    return export_response(
+        encode_rows(iterate_chunks(points), HISTORY_COLUMNS, file_format),
+        file_format,
+        f"pea_history_{period}"
+    )
+
+@router.get("/analytics/performance", response_model=PerformanceSummary, tags=["Transactions"])
+async def get_performance(
+    request: Request,
+    period: str = Query(default="1a"),
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
+):
+    """
+    Time-weighted return, money-weighted return (XIRR on purchases and sales),
+    volatility and max drawdown of the portfolio over the period.
+    """
+    return await run_as_job(
+        request, session, current_user, lambda job_session: get_user_performance(period, job_session, current_user)
+    )
+
+
+@router.get("/analytics/volatility", response_model=List[AnalyticsPoint], tags=["Transactions"])
+async def get_rolling_volatility(
+    request: Request,
+    period: str = Query(default="1a"),
+    window: int = Query(default=21, ge=2, le=252),
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
+):
+    """
+    Annualized volatility of daily returns over a trailing window of business days.
+    """
+    return await run_as_job(
+        request, session, current_user,
+        lambda job_session: get_user_rolling_volatility(period, window, job_session, current_user)
+    )
+
+
+@router.get("/analytics/contribution", response_model=List[TickerContribution], tags=["Transactions"])
+async def get_contributions(
+    request: Request,
+    period: str = Query(default="1a"),
+    session: AsyncSession = Depends(get_read_session),
+    current_user: User = Depends(get_current_identity)
+):
+    """
+    Profit and return contribution of each ticker over the period, best first.
+    """
+    return await run_as_job(
+        request, session, current_user, lambda job_session: get_user_contributions(period, job_session, current_user)
+    )
+
 
 # -------------------------- POST --------------------------
 
+@router.post("/price/refresh", response_model=PriceRefreshReport, tags=["Transactions"])
+async def refresh_prices(
+    session: AsyncSession = Depends(get_session),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Refresh the prices of every ticker held by the authenticated user through
+    the shared scheduler: a ticker already being fetched for someone else is
+    not fetched twice. Tickers that could not be fetched are listed in `errors`.
+    """
+    results = await price_scheduler.refresh_held(current_user.id)
+    record_write(current_user.id)
+    return PriceRefreshReport(
+        stored={ticker: stored for ticker, (stored, _) in results.items()},
+        errors={ticker: error for ticker, (_, error) in results.items() if error}
+    )
+
+
 @router.post("/", response_model=Transaction, tags=["Transactions"])
-def create_transaction(
+async def create_transaction(
     transaction_in: TransactionCreate,
-    session: Session = Depends(get_session),
+    background_tasks: BackgroundTasks,
+    session: AsyncSession = Depends(get_session),
     current_user: User = Depends(get_current_user)
 ):
     try:
         transaction = Transaction(**transaction_in.model_dump(), user_id=current_user.id)
         session.add(transaction)
-        session.commit()
-        session.refresh(transaction)
+        await apply_transaction(session, transaction)
+        await bump_ledger_version(session, current_user.id)
+        await mark_nav_dirty(session, current_user.id, transaction.date_of)
+        await session.commit()
+        record_write(current_user.id)
+        await session.refresh(transaction)
+        background_tasks.add_task(price_scheduler.refresh_many, {transaction.ticker: transaction.date_of})
+        background_tasks.add_task(refresh_nav_task, current_user.id)
+        background_tasks.add_task(live_hub.ledger_changed, current_user.id)
         return transaction
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/import", response_model=ImportReport, tags=["Transactions"])
+async def import_transactions_file(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    file_format: Optional[str] = Query(default=None, alias="format", pattern="^(csv|ndjson)$"),
+    mapping: str = Query(default="default"),
+    session: AsyncSession = Depends(get_session),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Import transactions from a CSV or NDJSON file in a single database transaction.
+    `mapping` selects how broker export columns map to transaction fields.
+    Invalid rows are skipped and listed in the report with their row number.
+    """
+    if mapping not in BROKER_MAPPINGS:
+        raise HTTPException(status_code=400, detail=f"Unknown mapping, expected one of: {', '.join(BROKER_MAPPINGS)}")
+
+    if file_format is None:
+        filename = (file.filename or "").lower()
+        file_format = "ndjson" if filename.endswith((".ndjson", ".jsonl")) else "csv"
+
+    try:
+        report, first_dates = await import_transactions(
+            session, current_user.id, file.file, file_format, BROKER_MAPPINGS[mapping]
+        )
+    except Exception as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if first_dates:
+        record_write(current_user.id)
+        background_tasks.add_task(price_scheduler.refresh_many, first_dates)
+        background_tasks.add_task(refresh_nav_task, current_user.id)
+        background_tasks.add_task(live_hub.ledger_changed, current_user.id)
+    return report
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
-from routes.auth import get_current_user
+from routes.auth import get_current_identity
 from models import User
 
 router = APIRouter()
@@ -11,5 +11,5 @@ class UserRead(BaseModel):
 
 
 @router.get("/me", response_model=UserRead)
-def read_current_user(current_user: User = Depends(get_current_user)):
+def read_current_user(current_user: User = Depends(get_current_identity)):
     return current_user
@@ -0,0 +1,210 @@
+from datetime import date
+from typing import List, Optional, Tuple
+
+import numpy as np
+from fastapi import HTTPException
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import User
+from services.prices import price_cache
+from services.utils import period_start
+from services.valuation import load_ledger_matrix, position_matrix, price_matrix
+
+TRADING_DAYS = 252
+XIRR_ITERATIONS = 100
+
+
+class PortfolioWindow:
+    """
+    Holdings values and trade cash flows per ticker on each business day of
+    a window (dates x tickers). The first row is the business day before the
+    window: it only carries the starting value.
+    """
+    __slots__ = ("dates", "tickers", "values", "flows", "trade_dates", "trade_amounts")
+
+    def __init__(self, dates: np.ndarray, tickers: List[str], values: np.ndarray, flows: np.ndarray,
+                 trade_dates: np.ndarray, trade_amounts: np.ndarray):
+        self.dates = dates
+        self.tickers = tickers
+        self.values = values
+        self.flows = flows
+        self.trade_dates = trade_dates
+        self.trade_amounts = trade_amounts
+
+
+async def load_portfolio_window(session: AsyncSession, user_id: int, start: date, end: date) -> PortfolioWindow:
+    ledger = await load_ledger_matrix(session, user_id)
+    base = np.busday_offset(np.datetime64(start, "D"), -1, roll="forward")
+    days = np.arange(base, np.datetime64(end, "D") + 1)
+    dates = days[np.is_busday(days)]
+
+    prices = await price_cache.get(session, ledger.tickers)
+    closes = np.nan_to_num(price_matrix(ledger.tickers, prices, dates), nan=0.0)
+    values = position_matrix(ledger, dates) * closes
+
+    # Chaque transaction de la fenêtre compte comme flux le premier jour ouvré >= sa date
+    rows = np.searchsorted(dates, ledger.dates, side="left")
+    in_window = (rows > 0) & (rows < len(dates))
+    flows = np.zeros_like(values)
+    np.add.at(flows, (rows[in_window], ledger.ticker_idx[in_window]), ledger.amounts[in_window])
+
+    return PortfolioWindow(
+        dates, ledger.tickers, values, flows, ledger.dates[in_window], ledger.amounts[in_window]
+    )
+
+
+def daily_returns(window: PortfolioWindow) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Portfolio return of each day, flows invested at the start of the day.
+    Returns (returns, capital at risk), aligned with `window.dates[1:]`.
+    """
+    totals = window.values.sum(axis=1)
+    capital = totals[:-1] + window.flows.sum(axis=1)[1:]
+    safe = np.where(capital > 0, capital, 1.0)
+    returns = np.where(capital > 0, totals[1:] / safe - 1, 0.0)
+    return returns, capital
+
+
+def time_weighted_return(returns: np.ndarray) -> float:
+    return float(np.prod(1 + returns) - 1)
+
+
+def xirr(amounts: np.ndarray, years: np.ndarray) -> Optional[float]:
+    """
+    Annual rate zeroing the net present value of the cash flows (investor
+    side: negative when money goes in). Newton steps, with a bisection
+    fallback when they do not converge.
+    """
+    if not (np.any(amounts > 0) and np.any(amounts < 0)) or not np.any(years > 0):
+        return None
+
+    def npv(rate: float) -> float:
+        return float(np.sum(amounts * (1 + rate) ** -years))
+
+    rate = 0.1
+    for _ in range(XIRR_ITERATIONS):
+        discount = (1 + rate) ** -years
+        value = np.sum(amounts * discount)
+        derivative = np.sum(-years * amounts * discount / (1 + rate))
+        if derivative == 0 or not np.isfinite(derivative):
+            break
+        step = value / derivative
+        rate -= step
+        if rate <= -1 or not np.isfinite(rate):
+            break
+        if abs(step) < 1e-10:
+            return float(rate)
+
+    low, high = -0.9999, 100.0
+    if npv(low) * npv(high) > 0:
+        return None
+    for _ in range(200):
+        middle = (low + high) / 2
+        if npv(low) * npv(middle) <= 0:
+            high = middle
+        else:
+            low = middle
+    return float((low + high) / 2)
+
+
+def max_drawdown(returns: np.ndarray) -> Tuple[float, int, int]:
+    """
+    Largest peak-to-trough loss of the time-weighted wealth index.
+    Returns (drawdown, peak index, trough index) on the index, which starts at 1.
+    """
+    wealth = np.concatenate([[1.0], np.cumprod(1 + returns)])
+    drawdowns = wealth / np.maximum.accumulate(wealth) - 1
+    trough = int(np.argmin(drawdowns))
+    peak = int(np.argmax(wealth[:trough + 1]))
+    return float(drawdowns[trough]), peak, trough
+
+
+def rolling_volatility(returns: np.ndarray, window: int) -> np.ndarray:
+    """
+    Annualized standard deviation of daily returns over each trailing window,
+    from cumulative sums. Element i covers returns[i:i + window].
+    """
+    if len(returns) < window:
+        return np.empty(0)
+    sums = np.concatenate([[0.0], np.cumsum(returns)])
+    squares = np.concatenate([[0.0], np.cumsum(returns ** 2)])
+    total = sums[window:] - sums[:-window]
+    total_sq = squares[window:] - squares[:-window]
+    variance = np.clip((total_sq - total ** 2 / window) / (window - 1), 0, None)
+    return np.sqrt(variance * TRADING_DAYS)
+
+
+def contributions(window: PortfolioWindow, capital: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Profit and return contribution of each ticker: its daily P&L over the
+    portfolio capital of the day, summed over the window.
+    """
+    pnl = np.diff(window.values, axis=0) - window.flows[1:]
+    safe = np.where(capital > 0, capital, 1.0)[:, None]
+    shares = np.where(capital[:, None] > 0, pnl / safe, 0.0)
+    return pnl.sum(axis=0), shares.sum(axis=0)
+
+
+def analysis_bounds(period: str) -> Tuple[date, date]:
+    end = date.today()
+    return period_start(period, end), end
+
+
+async def get_user_performance(period: str, session: AsyncSession, current_user: User) -> dict:
+    start, end = analysis_bounds(period)
+    window = await load_portfolio_window(session, current_user.id, start, end)
+    if len(window.dates) == 0:
+        raise HTTPException(status_code=404, detail="No business day in this period")
+    returns, _ = daily_returns(window)
+    totals = window.values.sum(axis=1)
+
+    # Flux côté investisseur : valeur de départ et achats sortent, ventes et valeur finale rentrent
+    base = window.dates[0]
+    amounts = np.concatenate([[-totals[0]], -window.trade_amounts, [totals[-1]]])
+    days = np.concatenate([[base], window.trade_dates, [window.dates[-1]]])
+    years = (days - base).astype(np.float64) / 365.0
+
+    drawdown, peak, trough = max_drawdown(returns)
+    span_years = (end - start).days / 365.25
+    twr = time_weighted_return(returns)
+    return {
+        "start": start,
+        "end": end,
+        "start_value": float(totals[0]),
+        "end_value": float(totals[-1]),
+        "net_flows": float(window.trade_amounts.sum()),
+        "twr": twr,
+        "twr_annualized": (1 + twr) ** (1 / span_years) - 1 if span_years >= 1 else None,
+        "xirr": xirr(amounts[amounts != 0], years[amounts != 0]),
+        "volatility": float(np.std(returns, ddof=1) * np.sqrt(TRADING_DAYS)) if len(returns) > 1 else None,
+        "max_drawdown": drawdown,
+        "drawdown_peak": window.dates[peak].astype(date) if drawdown < 0 else None,
+        "drawdown_trough": window.dates[trough].astype(date) if drawdown < 0 else None,
+    }
+
+
+async def get_user_rolling_volatility(period: str, window_size: int, session: AsyncSession, current_user: User) -> List[dict]:
+    start, end = analysis_bounds(period)
+    window = await load_portfolio_window(session, current_user.id, start, end)
+    if len(window.dates) == 0:
+        return []
+    returns, _ = daily_returns(window)
+    volatility = rolling_volatility(returns, window_size)
+    # La fenêtre i se termine au rendement i + window_size - 1, soit à la date d'indice i + window_size
+    dates = window.dates[window_size:window_size + len(volatility)].astype(date)
+    return [{"date": d, "value": float(value)} for d, value in zip(dates, volatility)]
+
+
+async def get_user_contributions(period: str, session: AsyncSession, current_user: User) -> List[dict]:
+    start, end = analysis_bounds(period)
+    window = await load_portfolio_window(session, current_user.id, start, end)
+    if len(window.dates) == 0:
+        return []
+    _, capital = daily_returns(window)
+    pnl, shares = contributions(window, capital)
+    involved = np.any(window.values != 0, axis=0) | np.any(window.flows != 0, axis=0)
+    rows = [
+        {"ticker": ticker, "pnl": float(pnl[i]), "contribution": float(shares[i])}
+        for i, ticker in enumerate(window.tickers) if involved[i]
+    ]
+    return sorted(rows, key=lambda row: row["pnl"], reverse=True)
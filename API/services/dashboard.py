@@ -0,0 +1,140 @@
+import logging
+import time
+from datetime import date
+from typing import Dict, List, Optional
+
+import numpy as np
+from fastapi import HTTPException
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from instrumentation import record_timing
+from models import DailyQuantity, User
+from services.positions import cost_bases
+from services.prices import PriceColumns, price_cache
+from services.transactions import history_dates, quantity_snapshots
+from services.valuation import LedgerMatrix, holdings_change_dates, load_ledger_matrix, position_matrix, price_matrix
+
+logger = logging.getLogger("api.log")
+
+
+class DashboardState:
+    """
+    Data shared by the widgets of one dashboard request: the ledger and the
+    price columns of its tickers, each loaded at most once and only if a
+    requested widget needs it. Times are recorded in `timings` (ms): a
+    widget's time excludes the shared loads it triggered.
+    """
+
+    def __init__(self, session: AsyncSession, current_user: User, period: str, date_param: Optional[date]):
+        self.session = session
+        self.current_user = current_user
+        self.period = period
+        self.date_param = date_param
+        self.timings: Dict[str, float] = {}
+        self.loading = 0.0
+        self._ledger: Optional[LedgerMatrix] = None
+        self._prices: Optional[Dict[str, PriceColumns]] = None
+
+    async def ledger(self) -> LedgerMatrix:
+        if self._ledger is None:
+            started = time.perf_counter()
+            self._ledger = await load_ledger_matrix(self.session, self.current_user.id)
+            self.loading += self.record("load_ledger", started)
+        return self._ledger
+
+    async def prices(self) -> Dict[str, PriceColumns]:
+        if self._prices is None:
+            ledger = await self.ledger()
+            started = time.perf_counter()
+            self._prices = await price_cache.get(self.session, ledger.tickers)
+            self.loading += self.record("load_prices", started)
+        return self._prices
+
+    def record(self, name: str, started: float, excluded: float = 0.0) -> float:
+        elapsed = time.perf_counter() - started - excluded
+        self.timings[name] = round(elapsed * 1000, 3)
+        record_timing(name, elapsed)
+        return elapsed
+
+
+async def _total_price(state: DashboardState) -> float:
+    ledger = await state.ledger()
+    prices = await state.prices()
+    target = np.array([state.date_param or date.today()], dtype="datetime64[D]")
+    quantities = position_matrix(ledger, target)[0]
+    closes = price_matrix(ledger.tickers, prices, target)[0]
+    missing = (quantities != 0) & np.isnan(closes)
+    for i in np.flatnonzero(missing):
+        logger.warning("No stored price for %s as of %s", ledger.tickers[i], target[0])
+    return float(np.sum(np.where(missing, 0.0, quantities * np.nan_to_num(closes))))
+
+
+async def _total_invest(state: DashboardState) -> float:
+    # Même calcul que les positions matérialisées, sans relire la table
+    return float(sum(cost.cost for cost in cost_bases(await state.ledger()).values()))
+
+
+async def _tickers(state: DashboardState) -> List[str]:
+    return list((await state.ledger()).tickers)
+
+
+async def _total_transactions(state: DashboardState) -> int:
+    return len(await state.ledger())
+
+
+async def _daily_quantity(state: DashboardState) -> List[DailyQuantity]:
+    return quantity_snapshots(await state.ledger())
+
+
+async def _total_history(state: DashboardState) -> List[dict]:
+    # Mêmes points que /price/total_history, valorisés avec le registre et les cours déjà chargés
+    start, end, interval_dates = history_dates(state.period)
+    ledger = await state.ledger()
+    change_dates = {d for d in holdings_change_dates(ledger).astype(date) if start <= d <= end}
+    target = np.array(sorted(change_dates | interval_dates), dtype="datetime64[D]")
+    if len(ledger):
+        closes = np.nan_to_num(price_matrix(ledger.tickers, await state.prices(), target), nan=0.0)
+        values = (position_matrix(ledger, target) * closes).sum(axis=1)
+    else:
+        values = np.zeros(len(target))
+    return [{"date": d.isoformat(), "value": float(value)} for d, value in zip(target.astype(date), values)]
+
+
+# Même nom que les champs de DashboardBundle
+WIDGETS = {
+    "total_price": _total_price,
+    "total_invest": _total_invest,
+    "tickers": _tickers,
+    "total_transactions": _total_transactions,
+    "daily_quantity": _daily_quantity,
+    "total_history": _total_history,
+}
+
+
+async def get_user_dashboard(
+    widgets: List[str],
+    period: str,
+    date_param: Optional[date],
+    session: AsyncSession,
+    current_user: User
+) -> dict:
+    """
+    Compute the requested widgets from a single ledger read and a single
+    price read. Returns the widget values and the time spent on each one
+    and on the shared loads, in milliseconds.
+    """
+    unknown = [name for name in widgets if name not in WIDGETS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown widgets: {', '.join(unknown)}; expected some of: {', '.join(WIDGETS)}"
+        )
+
+    state = DashboardState(session, current_user, period, date_param)
+    bundle = {}
+    for name in dict.fromkeys(widgets):
+        started, loading = time.perf_counter(), state.loading
+        bundle[name] = await WIDGETS[name](state)
+        state.record(name, started, state.loading - loading)
+    bundle["timings"] = state.timings
+    return bundle
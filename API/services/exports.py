@@ -0,0 +1,131 @@
+import csv
+import io
+import json
+import os
+from datetime import date
+from typing import AsyncIterator, Dict, Iterable, List, Sequence
+
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import Transaction
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "2000"))
+
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+TRANSACTION_COLUMNS = ["id", "type", "ticker", "quantity", "price", "date_of"]
+HISTORY_COLUMNS = ["date", "value"]
+
+
+def parquet_available() -> bool:
+    # pyarrow est optionnel : seul l'export Parquet en dépend
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _plain(value, keep_dates: bool = False):
+    if isinstance(value, date) and not keep_dates:
+        return value.isoformat()
+    if hasattr(value, "value"):
+        return value.value
+    return value
+
+
+def _csv_chunk(rows: Iterable[Sequence], header: List[str] = None) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(header)
+    writer.writerows([_plain(v) for v in row] for row in rows)
+    return buffer.getvalue().encode()
+
+
+def _ndjson_chunk(rows: Iterable[Sequence], columns: List[str]) -> bytes:
+    return "".join(
+        json.dumps(dict(zip(columns, (_plain(v) for v in row)))) + "\n" for row in rows
+    ).encode()
+
+
+class _Drain(io.RawIOBase):
+    """
+    Write-only sink handing back whatever the Parquet writer produced so far.
+    """
+
+    def __init__(self):
+        self.parts: List[bytes] = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts.clear()
+        return data
+
+
+async def encode_rows(chunks: AsyncIterator[List[Sequence]], columns: List[str], file_format: str) -> AsyncIterator[bytes]:
+    """
+    Encode row chunks one at a time; only the current chunk is held in memory.
+    Each chunk becomes one Parquet row group.
+    """
+    if file_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        sink = _Drain()
+        writer = None
+        async for rows in chunks:
+            table = pa.table({
+                name: [_plain(row[i], keep_dates=True) for row in rows] for i, name in enumerate(columns)
+            })
+            if writer is None:
+                writer = pq.ParquetWriter(sink, table.schema)
+            writer.write_table(table)
+            yield sink.take()
+        if writer is not None:
+            writer.close()
+            yield sink.take()
+        return
+
+    header = columns if file_format == "csv" else None
+    async for rows in chunks:
+        if file_format == "csv":
+            yield _csv_chunk(rows, header)
+            header = None
+        else:
+            yield _ndjson_chunk(rows, columns)
+    if header:
+        yield _csv_chunk([], header)
+
+
+async def stream_transaction_rows(engine, user_id: int) -> AsyncIterator[List[Sequence]]:
+    """
+    Chunks of transaction rows read through a server-side cursor. Uses its own
+    session: the request session is closed before the response body is sent.
+    """
+    async with AsyncSession(engine) as session:
+        result = await session.stream(
+            select(*(getattr(Transaction, name) for name in TRANSACTION_COLUMNS))
+            .where(Transaction.user_id == user_id)
+            .order_by(Transaction.date_of, Transaction.id)
+            .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+        )
+        async for partition in result.partitions():
+            yield partition
+
+
+async def iterate_chunks(points: List[Dict]) -> AsyncIterator[List[Sequence]]:
+    for i in range(0, len(points), EXPORT_CHUNK_SIZE):
+        yield [[point[name] for name in HISTORY_COLUMNS] for point in points[i:i + EXPORT_CHUNK_SIZE]]
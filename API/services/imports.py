@@ -0,0 +1,184 @@
+import codecs
+import csv
+import json
+import os
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import ImportReport, ImportRowError, Transaction, TransactionCreate
+from services.nav import mark_nav_dirty
+from services.positions import rebuild_positions
+from services.response_cache import bump_ledger_version
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "1000"))
+
+# Séparateurs de milliers des exports français : espace, insécable, fine insécable
+THOUSANDS_SEPARATORS = (" ", "\u00a0", "\u202f")
+
+Record = Tuple[int, Optional[dict], Optional[str]]
+
+
+@dataclass
+class ImportMapping:
+    """
+    How to read a broker export: column names mapped to `TransactionCreate`
+    fields, values mapped to `TransactionType`, and number/date formats.
+    """
+    columns: Dict[str, str] = field(default_factory=dict)
+    types: Dict[str, str] = field(default_factory=dict)
+    date_format: Optional[str] = None
+    decimal_comma: bool = False
+    delimiter: str = ","
+
+
+BROKER_MAPPINGS = {
+    "default": ImportMapping(),
+    # Relevé d'opérations type courtier français : "Date;Sens;Valeur;Quantité;Cours"
+    "broker_fr": ImportMapping(
+        columns={"Date": "date_of", "Sens": "type", "Valeur": "ticker", "Quantité": "quantity", "Cours": "price"},
+        types={"Achat": "achat", "Vente": "vente", "A": "achat", "V": "vente"},
+        date_format="%d/%m/%Y",
+        decimal_comma=True,
+        delimiter=";",
+    ),
+}
+
+
+def _read_lines(file: BinaryIO, chunk_size: int = 64 * 1024) -> Iterator[str]:
+    """
+    Decode the upload chunk by chunk, so memory does not grow with file size.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def _iter_records(file: BinaryIO, file_format: str, mapping: ImportMapping) -> Iterator[Record]:
+    """
+    Yields (row number, raw record, parse error) for each data row.
+    """
+    lines = _read_lines(file)
+    if file_format == "ndjson":
+        for row_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("expected a JSON object")
+                yield row_number, record, None
+            except ValueError as e:
+                yield row_number, None, str(e)
+    else:
+        reader = csv.DictReader(lines, delimiter=mapping.delimiter)
+        for row_number, record in enumerate(reader, start=1):
+            yield row_number, record, None
+
+
+def _apply_mapping(record: dict, mapping: ImportMapping) -> dict:
+    data = {}
+    for key, value in record.items():
+        if key is None:
+            continue
+        name = mapping.columns.get(key.strip(), key.strip())
+        data[name] = value.strip() if isinstance(value, str) else value
+
+    if isinstance(data.get("type"), str):
+        data["type"] = mapping.types.get(data["type"], data["type"].lower())
+    if mapping.decimal_comma:
+        for name in ("quantity", "price"):
+            if isinstance(data.get(name), str):
+                value = data[name]
+                for separator in THOUSANDS_SEPARATORS:
+                    value = value.replace(separator, "")
+                data[name] = value.replace(",", ".")
+    if mapping.date_format and isinstance(data.get("date_of"), str):
+        data["date_of"] = datetime.strptime(data["date_of"], mapping.date_format).date()
+    return data
+
+
+def _validate_rows(
+    records: Iterator[Record],
+    mapping: ImportMapping,
+    user_id: int,
+    size: int
+) -> Tuple[List[dict], List[Tuple[int, str]], bool]:
+    """
+    Read and validate up to `size` rows: (valid rows ready to insert, errors
+    by row number, whether the file is exhausted). Blocking: decoding, CSV
+    parsing and pydantic validation run here, off the event loop.
+    """
+    rows: List[dict] = []
+    errors: List[Tuple[int, str]] = []
+    for row_number, record, error in records:
+        if error is not None:
+            errors.append((row_number, error))
+        else:
+            try:
+                transaction = TransactionCreate.model_validate(_apply_mapping(record, mapping))
+                rows.append({**transaction.model_dump(), "user_id": user_id})
+            except ValidationError as e:
+                errors.append((row_number, "; ".join(
+                    f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in e.errors()
+                )))
+            except ValueError as e:
+                errors.append((row_number, str(e)))
+        if len(rows) + len(errors) >= size:
+            return rows, errors, False
+    return rows, errors, True
+
+
+async def import_transactions(
+    session: AsyncSession,
+    user_id: int,
+    file: BinaryIO,
+    file_format: str,
+    mapping: ImportMapping
+) -> Tuple[ImportReport, Dict[str, date]]:
+    """
+    Validate rows in batches of IMPORT_BATCH_SIZE on the threadpool and
+    insert the valid ones with executemany, all inside a single database
+    transaction. Invalid rows are reported and skipped. Returns the report
+    and the first imported date per ticker.
+    """
+    report = ImportReport(inserted=0, rejected=0, errors=[])
+    first_dates: Dict[str, date] = {}
+    records = _iter_records(file, file_format, mapping)
+
+    exhausted = False
+    while not exhausted:
+        rows, errors, exhausted = await run_in_threadpool(_validate_rows, records, mapping, user_id, IMPORT_BATCH_SIZE)
+        report.rejected += len(errors)
+        for row_number, message in errors[:max(0, IMPORT_MAX_ERRORS - len(report.errors))]:
+            report.errors.append(ImportRowError(row=row_number, error=message))
+        if not rows:
+            continue
+        for row in rows:
+            if row["date_of"] < first_dates.get(row["ticker"], date.max):
+                first_dates[row["ticker"]] = row["date_of"]
+        await session.exec(insert(Transaction), params=rows)
+        report.inserted += len(rows)
+
+    if report.inserted:
+        await rebuild_positions(session, user_id, commit=False)
+        await bump_ledger_version(session, user_id)
+        await mark_nav_dirty(session, user_id, min(first_dates.values()))
+    await session.commit()
+    return report, first_dates
@@ -0,0 +1,312 @@
+import asyncio
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from fastapi import HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from instrumentation import record_timing
+from profiling import profile_thread
+from services.response_cache import get_cache_watermarks, make_etag
+
+logger = logging.getLogger("api.log")
+
+# Threads de calcul par processus, chacun avec sa boucle et ses engines
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "32"))
+# Jobs d'un utilisateur exécutés en même temps ; les suivants attendent leur tour
+JOB_USER_LIMIT = int(os.getenv("JOB_USER_LIMIT", "2"))
+# Jobs non terminés (en attente ou en cours) d'un utilisateur avant le 429
+JOB_USER_QUEUE = int(os.getenv("JOB_USER_QUEUE", "8"))
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "300"))
+
+Compute = Callable[[AsyncSession], Awaitable[Any]]
+
+
+class JobRejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class Job:
+    """
+    One computation of a heavy read, shared by every identical request
+    (same user, path, query, ledger version and price watermark).
+    """
+    __slots__ = ("id", "key", "user_id", "path", "status", "result", "error", "error_status",
+                 "created_at", "started_at", "finished_at", "expires_at", "done", "_compute", "_url", "_context")
+
+    def __init__(self, key: str, user_id: int, path: str, compute: Compute, engine: AsyncEngine):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.user_id = user_id
+        self.path = path
+        self.status = "queued"
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.error_status = 500
+        self.created_at = datetime.now()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.expires_at = 0.0
+        self.done = asyncio.Event()
+        self._compute = compute
+        # URL plutôt que l'engine : celui-ci appartient à la boucle principale
+        self._url = engine.url.render_as_string(hide_password=False)
+        # Le job tourne dans le contexte de la requête qui l'a soumis (métriques, profilage)
+        self._context = contextvars.copy_context()
+
+    def to_status(self) -> dict:
+        return {
+            "id": self.id,
+            "path": self.path,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "result": jsonable_encoder(self.result) if self.status == "done" else None,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """
+    Local worker pool for expensive reads. Jobs run on `workers` threads, each
+    with its own event loop and engines, so their CPU-bound valuation does
+    not run on the request loop. Identical jobs in flight or finished less
+    than `result_ttl` seconds ago are shared. A user runs at most
+    `user_limit` jobs at once, the others wait their turn; beyond
+    `user_queue` unfinished jobs for the user, or `queue_limit` pending jobs
+    overall, submissions are shed with a Retry-After estimated from the
+    queue depth.
+
+    The threads still share the GIL: pure Python sections of a job contend
+    with the loop, which only gets the interpreter back every switch
+    interval, whereas numpy and database I/O release it.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, queue_limit: int = JOB_QUEUE_LIMIT,
+                 user_limit: int = JOB_USER_LIMIT, user_queue: int = JOB_USER_QUEUE,
+                 result_ttl: float = JOB_RESULT_TTL):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.user_limit = user_limit
+        self.user_queue = user_queue
+        self.result_ttl = result_ttl
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+        self._pending: Deque[Job] = deque()
+        self._jobs: Dict[str, Job] = {}
+        self._by_key: Dict[str, Job] = {}
+        self._finished: "OrderedDict[str, Job]" = OrderedDict()
+        self._unfinished: Dict[int, int] = defaultdict(int)
+        self._running: Dict[int, int] = defaultdict(int)
+        self.running = 0
+        # Moyenne glissante des durées, pour estimer le Retry-After
+        self.average_seconds = 1.0
+        self.submitted = 0
+        self.shared = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def _purge(self):
+        now = time.monotonic()
+        while self._finished:
+            job = next(iter(self._finished.values()))
+            if job.expires_at > now:
+                break
+            del self._finished[job.id]
+            self._jobs.pop(job.id, None)
+            if self._by_key.get(job.key) is job:
+                del self._by_key[job.key]
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil((len(self._pending) / max(1, self.workers) + 1) * self.average_seconds))
+
+    async def submit(self, session: AsyncSession, request: Request, user_id: int, compute: Compute, engine: AsyncEngine) -> Job:
+        """
+        Queue `compute` for the request, or return the identical job already
+        queued, running or finished within the TTL. Raises JobRejected when
+        the user or the queue is at its limit.
+        """
+        self._purge()
+        watermarks = await get_cache_watermarks(session, user_id)
+        if watermarks is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        key = make_etag(user_id, *watermarks, request)
+
+        job = self._by_key.get(key)
+        if job is not None:
+            self.shared += 1
+            return job
+
+        if self._unfinished[user_id] >= self.user_queue:
+            self.rejected += 1
+            raise JobRejected("Too many jobs in progress for this user", self.retry_after())
+        if len(self._pending) >= self.queue_limit:
+            self.rejected += 1
+            raise JobRejected("Job queue is full", self.retry_after())
+
+        path = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+        job = Job(key, user_id, path, compute, engine)
+        self._jobs[job.id] = job
+        self._by_key[key] = job
+        self._unfinished[user_id] += 1
+        self.submitted += 1
+        self._pending.append(job)
+        self._dispatch()
+        return job
+
+    def get(self, job_id: str, user_id: int) -> Optional[Job]:
+        self._purge()
+        job = self._jobs.get(job_id)
+        return job if job is not None and job.user_id == user_id else None
+
+    async def result(self, job: Job) -> Any:
+        """
+        Wait for the job and return its result, re-raising its error. The
+        job's queueing and run times go to the caller's Server-Timing.
+        """
+        await job.done.wait()
+        if job.started_at is not None:
+            record_timing("job_queue", (job.started_at - job.created_at).total_seconds())
+            record_timing("job_run", (job.finished_at - job.started_at).total_seconds())
+        if job.status == "failed":
+            raise HTTPException(status_code=job.error_status, detail=job.error)
+        return job.result
+
+    def _dispatch(self):
+        """
+        Start pending jobs, oldest first, while a worker is free, skipping
+        users who already run `user_limit` jobs.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+        loop = asyncio.get_running_loop()
+        for job in list(self._pending):
+            if self.running >= self.workers:
+                break
+            if self._running[job.user_id] >= self.user_limit:
+                continue
+            self._pending.remove(job)
+            job.status = "running"
+            job.started_at = datetime.now()
+            self.running += 1
+            self._running[job.user_id] += 1
+            future = loop.run_in_executor(self._executor, self._execute, job)
+            future.add_done_callback(lambda future, job=job: self._finish(job, future))
+
+    def _execute(self, job: Job) -> Any:
+        """
+        Worker thread side: run the job on the thread's own loop, in the
+        context of the request that submitted it (metrics, profiling).
+        """
+        local = self._local
+        if not hasattr(local, "loop"):
+            local.loop = asyncio.new_event_loop()
+            local.engines = {}
+        return job._context.run(self._run_on_thread, job)
+
+    def _run_on_thread(self, job: Job) -> Any:
+        from db import create_engine
+
+        local = self._local
+        engine = local.engines.get(job._url)
+        if engine is None:
+            engine = local.engines[job._url] = create_engine(job._url)
+
+        async def compute():
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                return await job._compute(session)
+
+        with profile_thread():
+            return local.loop.run_until_complete(compute())
+
+    def _finish(self, job: Job, future: asyncio.Future):
+        if self._jobs.get(job.id) is not job:
+            # Abandonné à l'arrêt du pool
+            job.done.set()
+            return
+        elapsed = (datetime.now() - job.started_at).total_seconds()
+        try:
+            job.result = future.result()
+            job.status = "done"
+            self.completed += 1
+        except HTTPException as e:
+            job.status, job.error, job.error_status = "failed", str(e.detail), e.status_code
+            self.failed += 1
+        except Exception as e:
+            logger.error("Job %s failed (%s)", job.id, job.path, exc_info=e)
+            job.status, job.error = "failed", str(e)
+            self.failed += 1
+
+        self.average_seconds = 0.8 * self.average_seconds + 0.2 * elapsed
+        self.running -= 1
+        for counts in (self._running, self._unfinished):
+            counts[job.user_id] -= 1
+            if not counts[job.user_id]:
+                del counts[job.user_id]
+        job.finished_at = datetime.now()
+        job._compute = job._context = None
+        if job.status == "failed" and self._by_key.get(job.key) is job:
+            # Un échec n'est pas partagé : la requête suivante recalcule
+            del self._by_key[job.key]
+        job.expires_at = time.monotonic() + self.result_ttl
+        self._finished[job.id] = job
+        job.done.set()
+        self._dispatch()
+
+    def clear(self):
+        """
+        Forget the finished jobs, so that the next identical request runs
+        again instead of sharing their result. Jobs in progress are kept.
+        """
+        for job in self._finished.values():
+            self._jobs.pop(job.id, None)
+            if self._by_key.get(job.key) is job:
+                del self._by_key[job.key]
+        self._finished.clear()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        # Les jobs non terminés ne le seront plus : on ne les partage pas après un redémarrage
+        for job in [job for job in self._jobs.values() if not job.done.is_set()]:
+            del self._jobs[job.id]
+            if self._by_key.get(job.key) is job:
+                del self._by_key[job.key]
+        self._pending.clear()
+        self._unfinished.clear()
+        self._running.clear()
+        self.running = 0
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": len(self._pending),
+            "running": self.running,
+            "results": len(self._finished),
+            "submitted": self.submitted,
+            "shared": self.shared,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "average_seconds": self.average_seconds,
+        }
+
+
+job_queue = JobQueue()
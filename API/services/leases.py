@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import SchedulerLease
+
+logger = logging.getLogger("api.log")
+
+# Durée d'un bail : un worker arrêté brutalement le libère au plus tard après ce délai
+SCHEDULER_LEASE_TTL = float(os.getenv("SCHEDULER_LEASE_TTL", "60"))
+# Identifiant de ce processus dans la table des baux
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+async def acquire_lease(session: AsyncSession, name: str, ttl: float = SCHEDULER_LEASE_TTL,
+                        owner: str = INSTANCE_ID) -> bool:
+    """
+    Take or renew the lease `name` for `ttl` seconds. Succeeds when the
+    lease is free, expired or already ours; a single UPDATE (or the INSERT
+    of a missing row, guarded by the primary key) makes it atomic across
+    workers and hosts.
+    """
+    now = datetime.now()
+    expires_at = now + timedelta(seconds=ttl)
+    leases = SchedulerLease.__table__
+    result = await session.exec(
+        update(leases)
+        .where(leases.c.name == name, or_(leases.c.owner == owner, leases.c.expires_at < now))
+        .values(owner=owner, expires_at=expires_at)
+    )
+    if result.rowcount:
+        await session.commit()
+        return True
+    try:
+        session.add(SchedulerLease(name=name, owner=owner, expires_at=expires_at))
+        await session.commit()
+        return True
+    except IntegrityError:
+        # Bail détenu par un autre worker
+        await session.rollback()
+        return False
+
+
+async def release_lease(session: AsyncSession, name: str, owner: str = INSTANCE_ID):
+    leases = SchedulerLease.__table__
+    await session.exec(
+        update(leases).where(leases.c.name == name, leases.c.owner == owner).values(expires_at=datetime.now())
+    )
+    await session.commit()
+
+
+async def run_with_lease(name: str, task: Callable[[], Awaitable[None]], ttl: float = SCHEDULER_LEASE_TTL):
+    """
+    Run `task` in this process only while it holds the lease `name`, so
+    that one worker out of all those started by the deployment runs it.
+    The lease is renewed every third of `ttl`; on losing it (database
+    unreachable, pause longer than the TTL) the task is cancelled, and
+    another worker picks it up once the lease expires.
+    """
+    from db import engine
+
+    running: Optional[asyncio.Task] = None
+    try:
+        while True:
+            try:
+                async with AsyncSession(engine) as session:
+                    held = await acquire_lease(session, name, ttl)
+            except Exception:
+                logger.exception("Could not renew the %s lease", name)
+                held = False
+
+            if held and running is None:
+                logger.info("Lease %s acquired by %s", name, INSTANCE_ID)
+                running = asyncio.create_task(task())
+            elif not held and running is not None:
+                logger.warning("Lease %s lost by %s, stopping the task", name, INSTANCE_ID)
+                running.cancel()
+                running = None
+            await asyncio.sleep(ttl / 3)
+    finally:
+        if running is not None:
+            running.cancel()
+            try:
+                async with AsyncSession(engine) as session:
+                    await release_lease(session, name)
+            except Exception:
+                logger.exception("Could not release the %s lease", name)
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import date, datetime
+from typing import AsyncIterator, Dict, Iterable, Set
+
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import User
+from services.positions import get_quantities_as_of
+from services.prices import get_closes_as_of
+
+logger = logging.getLogger("api.log")
+
+LIVE_MAX_SUBSCRIPTIONS = int(os.getenv("LIVE_MAX_SUBSCRIPTIONS", "10000"))
+# Commentaire SSE périodique : garde la connexion ouverte derrière les proxies
+LIVE_HEARTBEAT = float(os.getenv("LIVE_HEARTBEAT", "15"))
+# Rattrapage des écritures faites par les autres processus (registre, cours) ; 0 : désactivé
+LIVE_POLL_INTERVAL = float(os.getenv("LIVE_POLL_INTERVAL", "30"))
+
+
+class LiveSubscriptionLimit(Exception):
+    pass
+
+
+class Subscription:
+    """
+    One open stream. Its queue holds at most the latest value: a slow
+    client skips intermediate values instead of slowing the fan-out.
+    """
+    __slots__ = ("user_id", "queue")
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+
+    def push(self, payload: dict):
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(payload)
+
+
+class LiveValuationHub:
+    """
+    Portfolio values pushed to subscribed users. Holdings of subscribed
+    users and the closes of their tickers are kept in memory, with an index
+    ticker -> users: a price update for a ticker recomputes only the users
+    holding it, once each, whatever the number of streams they have open.
+
+    The hub is per process. `ledger_changed` and `prices_changed` are called
+    by the process that made the write or ran the price refresh (only the
+    worker holding the scheduler lease refreshes prices), so they reach
+    only the streams open on that process. The other workers catch up
+    through `poll`, every LIVE_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self, max_subscriptions: int = LIVE_MAX_SUBSCRIPTIONS):
+        self.max_subscriptions = max_subscriptions
+        self._subscriptions: Dict[int, Set[Subscription]] = defaultdict(set)
+        self._holdings: Dict[int, Dict[str, float]] = {}
+        self._holders: Dict[str, Set[int]] = defaultdict(set)
+        self._closes: Dict[str, float] = {}
+        self._values: Dict[int, float] = {}
+        self._versions: Dict[int, int] = {}
+        self.price_events = 0
+        self.pushes = 0
+
+    def check_capacity(self):
+        if sum(len(subs) for subs in self._subscriptions.values()) >= self.max_subscriptions:
+            raise LiveSubscriptionLimit()
+
+    async def subscribe(self, user_id: int) -> Subscription:
+        self.check_capacity()
+        subscription = Subscription(user_id)
+        if user_id not in self._holdings:
+            await self._load(user_id)
+        self._subscriptions[user_id].add(subscription)
+        subscription.push(self._payload(user_id))
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.user_id)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            # Plus aucun flux ouvert : on oublie le portefeuille de l'utilisateur
+            del self._subscriptions[subscription.user_id]
+            self._set_holdings(subscription.user_id, {})
+            del self._holdings[subscription.user_id]
+            self._values.pop(subscription.user_id, None)
+            self._versions.pop(subscription.user_id, None)
+
+    async def ledger_changed(self, user_id: int):
+        """
+        Reload the holdings of a subscribed user after a write to their
+        ledger. Only streams open on this process are updated at once.
+        """
+        if user_id in self._subscriptions:
+            await self._load(user_id)
+            self._publish({user_id})
+
+    async def prices_changed(self, tickers: Iterable[str]):
+        """
+        Read the latest close of the refreshed tickers that somebody holds,
+        then push the new value of every user holding one of them.
+        """
+        held = [ticker for ticker in tickers if self._holders.get(ticker)]
+        if not held:
+            return
+        from db import engine
+
+        async with AsyncSession(engine) as session:
+            closes = await get_closes_as_of(session, held, date.today())
+        changed = {ticker for ticker, close in closes.items() if self._closes.get(ticker) != close}
+        if not changed:
+            return
+        self.price_events += 1
+        self._closes.update({ticker: closes[ticker] for ticker in changed})
+        self._publish(set().union(*(self._holders[ticker] for ticker in changed)))
+
+    async def _load(self, user_id: int):
+        from db import engine
+
+        async with AsyncSession(engine) as session:
+            version = (await session.exec(select(User.ledger_version).where(User.id == user_id))).first()
+            holdings = await get_quantities_as_of(session, user_id, date.today())
+            holdings = {ticker: quantity for ticker, quantity in holdings.items() if quantity}
+            missing = [ticker for ticker in holdings if ticker not in self._closes]
+            self._closes.update(await get_closes_as_of(session, missing, date.today()))
+        self._set_holdings(user_id, holdings)
+        self._versions[user_id] = version
+
+    async def poll(self):
+        """
+        Catch up with writes made by other processes: reload the subscribed
+        users whose ledger version moved, then re-read the closes of the held
+        tickers. Two small queries, and none while no stream is open.
+        """
+        if not self._subscriptions:
+            return
+        from db import engine
+
+        async with AsyncSession(engine) as session:
+            versions = (await session.exec(
+                select(User.id, User.ledger_version).where(User.id.in_(list(self._subscriptions)))
+            )).all()
+        for user_id, version in versions:
+            if user_id in self._subscriptions and self._versions.get(user_id) != version:
+                await self.ledger_changed(user_id)
+        await self.prices_changed(list(self._holders))
+
+    async def run(self, interval: float = LIVE_POLL_INTERVAL):
+        """
+        Call `poll` every `interval` seconds until cancelled.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.poll()
+            except Exception:
+                logger.exception("Live valuation poll failed")
+
+    def _set_holdings(self, user_id: int, holdings: Dict[str, float]):
+        for ticker in holdings:
+            self._holders[ticker].add(user_id)
+        for ticker in self._holdings.get(user_id, {}):
+            if ticker in holdings:
+                continue
+            self._holders[ticker].discard(user_id)
+            if not self._holders[ticker]:
+                # Plus personne ne détient le ticker : son cours ne sert plus
+                del self._holders[ticker]
+                self._closes.pop(ticker, None)
+        self._holdings[user_id] = holdings
+
+    def _publish(self, user_ids: Set[int]):
+        for user_id in user_ids:
+            previous = self._values.get(user_id)
+            payload = self._payload(user_id)
+            if payload["value"] == previous:
+                continue
+            for subscription in self._subscriptions.get(user_id, ()):
+                subscription.push(payload)
+                self.pushes += 1
+
+    def _payload(self, user_id: int) -> dict:
+        holdings = self._holdings.get(user_id, {})
+        value = sum(quantity * self._closes[ticker] for ticker, quantity in holdings.items() if ticker in self._closes)
+        self._values[user_id] = value
+        return {
+            "value": value,
+            "missing": sorted(ticker for ticker in holdings if ticker not in self._closes),
+            "at": datetime.now().isoformat(timespec="seconds"),
+        }
+
+    async def events(self, user_id: int, heartbeat: float = LIVE_HEARTBEAT) -> AsyncIterator[str]:
+        """
+        Server-sent events of a new subscription, until the client
+        disconnects. The subscription is registered by the first iteration
+        and removed when the generator closes, so a response whose body is
+        never sent holds nothing.
+        """
+        try:
+            subscription = await self.subscribe(user_id)
+        except LiveSubscriptionLimit:
+            # Limite atteinte depuis le contrôle de la route
+            yield 'event: error\ndata: {"detail": "Too many live subscriptions"}\n\n'
+            return
+        try:
+            while True:
+                try:
+                    payload = await asyncio.wait_for(subscription.queue.get(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: value\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._subscriptions),
+            "subscriptions": sum(len(subs) for subs in self._subscriptions.values()),
+            "tickers": len(self._holders),
+            "price_events": self.price_events,
+            "pushes": self.pushes,
+        }
+
+
+live_hub = LiveValuationHub()
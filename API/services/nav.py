@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import os
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+from sqlalchemy import case, delete, insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import DailyNav, NavStatus, PositionChange, Transaction, User
+from services.positions import get_quantities_as_of, user_ids_with_transactions
+from services.price_scheduler import price_scheduler
+from services.prices import load_price_series, price_cache
+from services.valuation import (
+    LedgerMatrix, holdings_change_dates, invested_amounts, load_ledger_matrices,
+    load_ledger_matrix, portfolio_values, position_matrix, price_matrix,
+)
+
+logger = logging.getLogger("api.log")
+
+NAV_BATCH_SIZE = int(os.getenv("NAV_BATCH_SIZE", "200"))
+# Heure locale du calcul quotidien, après la clôture d'Euronext (17h30)
+NAV_RUN_AT = time.fromisoformat(os.getenv("NAV_RUN_AT", "18:30"))
+NAV_SCHEDULER = os.getenv("NAV_SCHEDULER", "1") == "1"
+
+
+def nav_end_date(now: Optional[datetime] = None) -> date:
+    """
+    Last day whose closing prices are final.
+    """
+    now = now or datetime.now()
+    return now.date() if now.time() >= NAV_RUN_AT else now.date() - timedelta(days=1)
+
+
+def _earliest_dirty(from_date: date):
+    return case(
+        (NavStatus.dirty_from.is_(None), from_date),
+        (NavStatus.dirty_from > from_date, from_date),
+        else_=NavStatus.dirty_from
+    )
+
+
+async def mark_nav_dirty(session: AsyncSession, user_id: int, from_date: date):
+    """
+    Flag the NAV rows of the user from `from_date` on as stale. Call it inside
+    the transaction that writes to the ledger.
+    """
+    await session.exec(
+        update(NavStatus)
+        .where(NavStatus.user_id == user_id)
+        .values(dirty_from=_earliest_dirty(from_date))
+    )
+
+
+async def mark_prices_dirty(session: AsyncSession, from_dates: Dict[str, date]):
+    """
+    Flag stale the NAV rows valued with closes that were missing or have
+    changed: for every user who traded the ticker, from the first changed
+    bar on. Call it inside the transaction that stores the bars.
+    """
+    for ticker, from_date in from_dates.items():
+        traders = select(Transaction.user_id).where(Transaction.ticker == ticker).distinct()
+        await session.exec(
+            update(NavStatus)
+            .where(NavStatus.user_id.in_(traders), NavStatus.last_date >= from_date)
+            .values(dirty_from=_earliest_dirty(from_date))
+        )
+
+
+def _first_stale_date(status: Optional[NavStatus], ledger: LedgerMatrix, full: bool) -> Optional[date]:
+    if len(ledger) == 0:
+        return None
+    first = ledger.dates[0].astype(date)
+    if full or status is None or status.last_date is None:
+        return first
+    start = status.last_date + timedelta(days=1)
+    if status.dirty_from is not None:
+        start = min(start, status.dirty_from)
+    return max(start, first)
+
+
+async def _nav_status(session: AsyncSession, user_id: int) -> NavStatus:
+    """
+    The NAV status of a user who had none when the batch started, created
+    if still missing.
+    """
+    try:
+        async with session.begin_nested():
+            session.add(NavStatus(user_id=user_id))
+    except IntegrityError:
+        # Créé entre-temps par un autre calcul (un par écriture) : on reprend le sien
+        pass
+    return await session.get(NavStatus, user_id, populate_existing=True)
+
+
+async def _build_batch(session: AsyncSession, user_ids: List[int], end: date, full: bool) -> Dict[int, int]:
+    statuses = {
+        status.user_id: status
+        for status in await session.exec(select(NavStatus).where(NavStatus.user_id.in_(user_ids)))
+    }
+    versions = dict((await session.exec(select(User.id, User.ledger_version).where(User.id.in_(user_ids)))).all())
+    ledgers = await load_ledger_matrices(session, user_ids)
+
+    starts = {}
+    for user_id, ledger in ledgers.items():
+        start = _first_stale_date(statuses.get(user_id), ledger, full)
+        if start is not None and start <= end:
+            starts[user_id] = start
+    if not starts:
+        return {}
+
+    # Une seule lecture des cours pour tout le lot, partagée entre les utilisateurs
+    tickers = sorted({ticker for user_id in starts for ticker in ledgers[user_id].tickers})
+    prices = await price_cache.get(session, tickers)
+
+    written = {}
+    for user_id, start in starts.items():
+        ledger = ledgers[user_id]
+        dates = np.arange(np.datetime64(start, "D"), np.datetime64(end, "D") + 1)
+        closes = np.nan_to_num(price_matrix(ledger.tickers, prices, dates), nan=0.0)
+        values = (position_matrix(ledger, dates) * closes).sum(axis=1)
+        invested = invested_amounts(ledger, dates)
+
+        await session.exec(delete(DailyNav).where(DailyNav.user_id == user_id, DailyNav.date_of >= start))
+        await session.exec(insert(DailyNav), params=[
+            {"user_id": user_id, "date_of": d, "value": float(value), "invested": float(amount)}
+            for d, value, amount in zip(dates.astype(date), values, invested)
+        ])
+        written[user_id] = len(dates)
+
+    # Si le registre a changé pendant le calcul, le statut reste marqué à recalculer
+    current = dict((await session.exec(
+        select(User.id, User.ledger_version).where(User.id.in_(list(starts))).with_for_update()
+    )).all())
+    for user_id in starts:
+        if current.get(user_id) != versions.get(user_id):
+            continue
+        ledger = ledgers[user_id]
+        later = ledger.dates[ledger.dates > np.datetime64(end, "D")]
+        status = statuses.get(user_id) or await _nav_status(session, user_id)
+        status.last_date = end
+        status.dirty_from = later[0].astype(date) if len(later) else None
+        session.add(status)
+
+    await session.commit()
+    return written
+
+
+async def build_daily_nav(
+    session: AsyncSession,
+    user_ids: Optional[List[int]] = None,
+    end: Optional[date] = None,
+    full: bool = False,
+    batch_size: int = NAV_BATCH_SIZE
+) -> Dict[int, int]:
+    """
+    Append each user's end-of-day value and invested amount to `DailyNav` up
+    to `end`, recomputing from the first stale date after back-dated trades.
+    Users are processed in batches with one ledger query and one price query
+    per batch. Returns the number of rows written per user.
+    """
+    end = end or nav_end_date()
+    if user_ids is None:
+        user_ids = await user_ids_with_transactions(session)
+
+    written = {}
+    for i in range(0, len(user_ids), batch_size):
+        written.update(await _build_batch(session, user_ids[i:i + batch_size], end, full))
+    return written
+
+
+async def run_nav_job() -> Dict[int, int]:
+    """
+    Daily job: refresh the closes of the held tickers, then extend every
+    user's NAV series.
+    """
+    from db import engine
+
+    await price_scheduler.refresh_held()
+    async with AsyncSession(engine) as session:
+        written = await build_daily_nav(session)
+    logger.info("Daily NAV: %d users updated, %d rows written", len(written), sum(written.values()))
+    return written
+
+
+async def nav_scheduler():
+    """
+    Run `run_nav_job` every day at NAV_RUN_AT until cancelled.
+    """
+    while True:
+        now = datetime.now()
+        next_run = datetime.combine(now.date(), NAV_RUN_AT)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        try:
+            await run_nav_job()
+        except Exception:
+            logger.exception("Daily NAV job failed")
+
+
+async def refresh_nav_task(user_id: int):
+    """
+    Background recompute of one user's stale NAV suffix after a write.
+    """
+    from db import engine
+
+    async with AsyncSession(engine) as session:
+        await build_daily_nav(session, [user_id])
+
+
+async def _live_values(session: AsyncSession, user_id: int, start: date, end: date, interval_dates: Set[date]) -> Dict[date, float]:
+    ledger = await load_ledger_matrix(session, user_id)
+    change_dates = {d for d in holdings_change_dates(ledger).astype(date) if start <= d <= end}
+    dates = sorted(change_dates | {d for d in interval_dates if start <= d <= end})
+    target_dates, values = await portfolio_values(session, ledger, np.array(dates, dtype="datetime64[D]"))
+    return {d: float(value) for d, value in zip(target_dates.astype(date), values)}
+
+
+async def _tail_values(session: AsyncSession, user_id: int, after: date, end: date, interval_dates: Set[date]) -> Dict[date, float]:
+    """
+    Values after the last clean NAV date, from the materialized change-points:
+    quantities as of `after`, then each change up to `end`.
+    """
+    quantities = await get_quantities_as_of(session, user_id, after)
+    changes = (await session.exec(
+        select(PositionChange.date_of, PositionChange.ticker, PositionChange.quantity)
+        .where(PositionChange.user_id == user_id, PositionChange.date_of > after, PositionChange.date_of <= end)
+        .order_by(PositionChange.date_of)
+    )).all()
+    dates = sorted({d for d in interval_dates if after < d <= end} | {date_of for date_of, _, _ in changes})
+    if not dates:
+        return {}
+
+    prices = await load_price_series(session, set(quantities) | {ticker for _, ticker, _ in changes}, dates[-1], dates[0])
+    values = {}
+    i = 0
+    for d in dates:
+        while i < len(changes) and changes[i][0] <= d:
+            _, ticker, quantity = changes[i]
+            quantities[ticker] = quantity
+            i += 1
+        values[d] = float(sum(
+            quantity * (prices[ticker].as_of(d) or 0.0) for ticker, quantity in quantities.items() if quantity
+        ))
+    return values
+
+
+async def nav_history(session: AsyncSession, user_id: int, start: date, end: date, interval_dates: Set[date]) -> Dict[date, float]:
+    """
+    Portfolio value at the interval dates and at trade dates between `start`
+    and `end`. Dates covered by an up-to-date `DailyNav` are read with one
+    range scan; later or stale dates are valued from the position change-points.
+    """
+    status = await session.get(NavStatus, user_id)
+    if status is None or status.last_date is None:
+        return await _live_values(session, user_id, start, end, interval_dates)
+
+    through = status.last_date
+    if status.dirty_from is not None:
+        through = min(through, status.dirty_from - timedelta(days=1))
+
+    points: Dict[date, float] = {}
+    if start <= through:
+        previous_invested = None
+        for date_of, value, invested in await session.exec(
+            select(DailyNav.date_of, DailyNav.value, DailyNav.invested)
+            .where(DailyNav.user_id == user_id, DailyNav.date_of >= start, DailyNav.date_of <= min(end, through))
+            .order_by(DailyNav.date_of)
+        ):
+            if date_of in interval_dates or invested != previous_invested:
+                points[date_of] = value
+            previous_invested = invested
+        # La série est continue : une date absente précède la première transaction
+        for d in interval_dates:
+            if start <= d <= min(end, through) and d not in points:
+                points[d] = 0.0
+
+    if through < end:
+        points.update(await _tail_values(session, user_id, max(through, start - timedelta(days=1)), end, interval_dates))
+    return dict(sorted(points.items()))
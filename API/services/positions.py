@@ -0,0 +1,279 @@
+from collections import defaultdict
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import Position, PositionChange, Transaction, TransactionType
+from services.valuation import LedgerMatrix, load_ledger_matrix
+
+PositionKey = Tuple[str, date]
+
+
+def _signed(tx_type: TransactionType, quantity: float, price: float) -> Tuple[float, float]:
+    sign = 1 if tx_type == TransactionType.achat else -1
+    return sign * quantity, sign * quantity * price
+
+
+class CostBasis:
+    """
+    Weighted-average cost (PRU) of one position. Purchases add their cost;
+    sales release cost at the current PRU and realize the difference.
+    """
+    __slots__ = ("quantity", "cost", "realized")
+
+    def __init__(self, quantity: float = 0.0, cost: float = 0.0, realized: float = 0.0):
+        self.quantity = quantity
+        self.cost = cost
+        self.realized = realized
+
+    @property
+    def average_cost(self) -> float:
+        return self.cost / self.quantity if self.quantity > 0 else 0.0
+
+    def apply(self, tx_type: TransactionType, quantity: float, price: float):
+        if tx_type == TransactionType.achat:
+            self.quantity += quantity
+            self.cost += quantity * price
+            return
+        average_cost = self.average_cost
+        self.realized += quantity * (price - average_cost)
+        self.quantity -= quantity
+        # Position soldée : on repart d'un coût nul plutôt que d'un résidu d'arrondi
+        self.cost = self.cost - quantity * average_cost if self.quantity > 1e-9 else 0.0
+
+
+async def replay_cost_basis(session: AsyncSession, position: Position):
+    """
+    Recompute the cost basis of a single position from its transactions,
+    for trades inserted before the position's last trade date.
+    """
+    rows = (await session.exec(
+        select(Transaction.type, Transaction.quantity, Transaction.price, Transaction.date_of)
+        .where(Transaction.user_id == position.user_id, Transaction.ticker == position.ticker)
+        .order_by(Transaction.date_of, Transaction.id)
+    )).all()
+
+    state = CostBasis()
+    for tx_type, quantity, price, _ in rows:
+        state.apply(tx_type, quantity, price)
+    position.cost_basis = state.cost
+    position.realized_pnl = state.realized
+    position.last_date = rows[-1][3] if rows else None
+
+
+async def _lock_position(session: AsyncSession, user_id: int, ticker: str) -> Position:
+    """
+    The position row, created if missing, locked until the caller's
+    transaction ends (FOR UPDATE; SQLite serializes writers on its own).
+    """
+    query = (
+        select(Position)
+        .where(Position.user_id == user_id, Position.ticker == ticker)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    position = (await session.exec(query)).first()
+    if position is None:
+        try:
+            async with session.begin_nested():
+                session.add(Position(user_id=user_id, ticker=ticker))
+        except IntegrityError:
+            # Créée entre-temps par une requête concurrente : on verrouille la sienne
+            pass
+        position = (await session.exec(query)).first()
+    return position
+
+
+async def apply_transaction(session: AsyncSession, transaction: Transaction):
+    """
+    Update the materialized positions for a new transaction, inside the
+    caller's database transaction (nothing is committed here). The position
+    row stays locked until that transaction ends, so concurrent trades on
+    the same ticker cannot lose each other's update.
+    """
+    quantity, invested = _signed(transaction.type, transaction.quantity, transaction.price)
+    user_id, ticker, date_of = transaction.user_id, transaction.ticker, transaction.date_of
+
+    position = await _lock_position(session, user_id, ticker)
+    if position.last_date is None or date_of >= position.last_date:
+        state = CostBasis(position.quantity, position.cost_basis, position.realized_pnl)
+        state.apply(transaction.type, transaction.quantity, transaction.price)
+        position.cost_basis, position.realized_pnl, position.last_date = state.cost, state.realized, date_of
+    else:
+        # Antidatée : seul l'historique de ce ticker est rejoué
+        await replay_cost_basis(session, position)
+    # Incrément calculé par la base, pas relu puis réécrit par l'ORM
+    await session.exec(
+        update(Position)
+        .where(Position.user_id == user_id, Position.ticker == ticker)
+        .values(quantity=Position.quantity + quantity, invested=Position.invested + invested)
+    )
+
+    if await session.get(PositionChange, (user_id, ticker, date_of)) is None:
+        previous = (await session.exec(
+            select(PositionChange)
+            .where(
+                PositionChange.user_id == user_id,
+                PositionChange.ticker == ticker,
+                PositionChange.date_of < date_of
+            )
+            .order_by(PositionChange.date_of.desc())
+            .limit(1)
+        )).first()
+        session.add(PositionChange(
+            user_id=user_id,
+            ticker=ticker,
+            date_of=date_of,
+            quantity=previous.quantity if previous else 0,
+            invested=previous.invested if previous else 0
+        ))
+        await session.flush()
+
+    # Une transaction antidatée décale tous les points de changement suivants
+    await session.exec(
+        update(PositionChange)
+        .where(
+            PositionChange.user_id == user_id,
+            PositionChange.ticker == ticker,
+            PositionChange.date_of >= date_of
+        )
+        .values(
+            quantity=PositionChange.quantity + quantity,
+            invested=PositionChange.invested + invested
+        )
+    )
+
+
+def cost_bases(ledger: LedgerMatrix) -> Dict[str, CostBasis]:
+    """
+    Cost basis of every ticker of the ledger, replayed in ledger order.
+    """
+    costs = defaultdict(CostBasis)
+    for i, quantity, price in zip(ledger.ticker_idx.tolist(), ledger.quantities.tolist(), ledger.prices.tolist()):
+        tx_type = TransactionType.achat if quantity >= 0 else TransactionType.vente
+        costs[ledger.tickers[i]].apply(tx_type, abs(quantity), price)
+    return costs
+
+
+async def replay_ledger(session: AsyncSession, user_id: int) -> Tuple[Dict[str, Tuple[float, ...]], Dict[PositionKey, Tuple[float, float]]]:
+    """
+    Recompute positions (quantity, invested, cost basis, realized P&L) and
+    dated change-points from the raw transactions, in one ordered pass.
+    """
+    ledger = await load_ledger_matrix(session, user_id)
+
+    running = defaultdict(lambda: [0.0, 0.0])
+    costs = cost_bases(ledger)
+    changes = {}
+    for date_of, i, quantity, invested in zip(
+        ledger.dates.tolist(), ledger.ticker_idx.tolist(), ledger.quantities.tolist(), ledger.amounts.tolist()
+    ):
+        ticker = ledger.tickers[i]
+        state = running[ticker]
+        state[0] += quantity
+        state[1] += invested
+        changes[(ticker, date_of)] = (state[0], state[1])
+
+    positions = {
+        ticker: (state[0], state[1], costs[ticker].cost, costs[ticker].realized)
+        for ticker, state in running.items()
+    }
+    return positions, changes
+
+
+async def rebuild_positions(session: AsyncSession, user_id: int, commit: bool = True):
+    positions, changes = await replay_ledger(session, user_id)
+    last_dates = {}
+    for ticker, date_of in changes:
+        last_dates[ticker] = max(date_of, last_dates.get(ticker, date_of))
+
+    await session.exec(delete(Position).where(Position.user_id == user_id))
+    await session.exec(delete(PositionChange).where(PositionChange.user_id == user_id))
+    if positions:
+        await session.exec(insert(Position), params=[
+            {
+                "user_id": user_id, "ticker": ticker, "quantity": quantity, "invested": invested,
+                "cost_basis": cost_basis, "realized_pnl": realized_pnl, "last_date": last_dates[ticker],
+            }
+            for ticker, (quantity, invested, cost_basis, realized_pnl) in positions.items()
+        ])
+    if changes:
+        await session.exec(insert(PositionChange), params=[
+            {"user_id": user_id, "ticker": ticker, "date_of": date_of, "quantity": quantity, "invested": invested}
+            for (ticker, date_of), (quantity, invested) in changes.items()
+        ])
+    if commit:
+        await session.commit()
+
+
+async def verify_positions(session: AsyncSession, user_id: int, tolerance: float = 1e-6) -> List[str]:
+    """
+    Compare the materialized positions with a replay of the ledger.
+    Returns a description of every mismatch (empty when consistent).
+    """
+    positions, changes = await replay_ledger(session, user_id)
+
+    stored_positions = {
+        position.ticker: (position.quantity, position.invested, position.cost_basis, position.realized_pnl)
+        for position in await session.exec(select(Position).where(Position.user_id == user_id))
+    }
+    stored_changes = {
+        (change.ticker, change.date_of): (change.quantity, change.invested)
+        for change in await session.exec(select(PositionChange).where(PositionChange.user_id == user_id))
+    }
+
+    def differs(a, b):
+        return a is None or b is None or any(abs(x - y) > tolerance for x, y in zip(a, b))
+
+    errors = []
+    for ticker in sorted(positions.keys() | stored_positions.keys()):
+        expected, stored = positions.get(ticker), stored_positions.get(ticker)
+        if differs(expected, stored):
+            errors.append(f"position {ticker}: expected {expected}, stored {stored}")
+    for key in sorted(changes.keys() | stored_changes.keys()):
+        expected, stored = changes.get(key), stored_changes.get(key)
+        if differs(expected, stored):
+            errors.append(f"change {key[0]} {key[1]}: expected {expected}, stored {stored}")
+    return errors
+
+
+async def get_quantities_as_of(session: AsyncSession, user_id: int, as_of: date) -> Dict[str, float]:
+    """
+    Quantity held per ticker at the end of `as_of`, read from the
+    change-points in a single query (one row per ticker).
+    """
+    last_dates = (
+        select(PositionChange.ticker, func.max(PositionChange.date_of).label("date_of"))
+        .where(PositionChange.user_id == user_id, PositionChange.date_of <= as_of)
+        .group_by(PositionChange.ticker)
+        .subquery()
+    )
+    rows = (await session.exec(
+        select(PositionChange.ticker, PositionChange.quantity)
+        .join(
+            last_dates,
+            (PositionChange.ticker == last_dates.c.ticker) & (PositionChange.date_of == last_dates.c.date_of)
+        )
+        .where(PositionChange.user_id == user_id)
+    )).all()
+    return {ticker: quantity for ticker, quantity in rows}
+
+
+async def get_total_cost_basis(session: AsyncSession, user_id: int) -> float:
+    """
+    Cost of the shares currently held, at their weighted-average unit cost.
+    """
+    total = (await session.exec(
+        select(func.sum(Position.cost_basis)).where(Position.user_id == user_id)
+    )).first()
+    return total or 0.0
+
+
+async def user_ids_with_transactions(session: AsyncSession, user_id: Optional[int] = None) -> List[int]:
+    if user_id is not None:
+        return [user_id]
+    return (await session.exec(select(Transaction.user_id).distinct())).all()
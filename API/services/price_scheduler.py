@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from datetime import date, datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import Position, PriceCoverage, Transaction
+from services.prices import PriceProvider, sync_price_ranges
+
+logger = logging.getLogger("api.log")
+
+PRICE_SCHEDULER = os.getenv("PRICE_SCHEDULER", "1") == "1"
+PRICE_REFRESH_INTERVAL = float(os.getenv("PRICE_REFRESH_INTERVAL", "900"))
+# Débit global vers le fournisseur, tous utilisateurs confondus
+PRICE_RATE_LIMIT = float(os.getenv("PRICE_RATE_LIMIT", "2"))
+PRICE_RATE_BURST = int(os.getenv("PRICE_RATE_BURST", "5"))
+PRICE_BACKOFF_BASE = float(os.getenv("PRICE_BACKOFF_BASE", "30"))
+PRICE_BACKOFF_MAX = float(os.getenv("PRICE_BACKOFF_MAX", "3600"))
+PRICE_BREAKER_THRESHOLD = int(os.getenv("PRICE_BREAKER_THRESHOLD", "5"))
+PRICE_BREAKER_COOLDOWN = float(os.getenv("PRICE_BREAKER_COOLDOWN", "3600"))
+PRICE_STALE_AFTER = float(os.getenv("PRICE_STALE_AFTER", str(3 * PRICE_REFRESH_INTERVAL)))
+
+RefreshResult = Tuple[int, Optional[str]]
+PriceListener = Callable[[List[str]], Awaitable[None]]
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every fetch batch of the process: `rate` tokens
+    per second, at most `burst` available at once.
+    """
+
+    def __init__(self, rate: float = PRICE_RATE_LIMIT, burst: int = PRICE_RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        # Le verrou sert les appelants dans l'ordre d'arrivée
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class TickerHealth:
+    """
+    Consecutive failures of a ticker, when it may be retried, and until when
+    its circuit breaker stays open.
+    """
+    __slots__ = ("failures", "retry_at", "open_until")
+
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0.0
+        self.open_until = 0.0
+
+
+class PriceRefreshScheduler:
+    """
+    Keeps the price store fresh for every held ticker, whoever holds it.
+    Each ticker is fetched at most once at a time (concurrent callers share
+    the in-flight fetch), the tickers of a refresh are fetched in one batch
+    that goes through a global rate limiter, and failing tickers back off
+    exponentially with jitter until their circuit breaker opens for
+    PRICE_BREAKER_COOLDOWN seconds.
+    """
+
+    def __init__(self, provider: Optional[PriceProvider] = None, limiter: Optional[RateLimiter] = None,
+                 interval: float = PRICE_REFRESH_INTERVAL):
+        self.provider = provider
+        self.limiter = limiter or RateLimiter()
+        self.interval = interval
+        self._inflight: Dict[str, Tuple[asyncio.Task, date]] = {}
+        self._health: Dict[str, TickerHealth] = {}
+        self._listeners: List[PriceListener] = []
+        self.fetches = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.skipped = 0
+        self.cycles = 0
+
+    def add_listener(self, listener: PriceListener):
+        """
+        Await `listener(tickers)` after each fetch that stored new bars.
+        """
+        self._listeners.append(listener)
+
+    async def _notify(self, tickers: List[str]):
+        for listener in self._listeners:
+            try:
+                await listener(tickers)
+            except Exception:
+                logger.exception("Price listener failed for %s", ", ".join(tickers))
+
+    def is_open(self, ticker: str) -> bool:
+        health = self._health.get(ticker)
+        return health is not None and health.open_until > time.monotonic()
+
+    async def refresh(self, ticker: str, start: date) -> RefreshResult:
+        """
+        Bring `ticker` up to date from `start`. Returns (bars stored, error).
+        """
+        return (await self.refresh_many({ticker: start}))[ticker]
+
+    async def refresh_many(self, starts: Dict[str, date]) -> Dict[str, RefreshResult]:
+        """
+        Bring the tickers up to date from their start dates. A ticker whose
+        fetch is already in flight from early enough joins it; the others
+        are fetched together in one batch. Returns (bars stored, error)
+        per ticker.
+        """
+        results: Dict[str, RefreshResult] = {}
+        pending = dict(starts)
+        while pending:
+            joined, due = {}, {}
+            for ticker, start in pending.items():
+                inflight = self._inflight.get(ticker)
+                if inflight is not None and inflight[0].done():
+                    # Terminé, mais son callback ne l'a pas encore retiré
+                    del self._inflight[ticker]
+                    inflight = None
+                if inflight is None:
+                    due[ticker] = start
+                else:
+                    joined[ticker] = inflight
+                    self.coalesced += 1
+
+            if due:
+                batch = asyncio.create_task(self._refresh_batch(due))
+                for ticker, start in due.items():
+                    self._inflight[ticker] = (batch, start)
+                batch.add_done_callback(lambda task, tickers=list(due): self._forget(task, tickers))
+                joined.update((ticker, (batch, start)) for ticker, start in due.items())
+
+            tasks = list({task for task, _ in joined.values()})
+            outcomes = dict(zip(tasks, await asyncio.shield(asyncio.gather(*tasks))))
+            pending = {}
+            for ticker, (task, inflight_start) in joined.items():
+                if inflight_start <= starts[ticker]:
+                    results[ticker] = outcomes[task][ticker]
+                else:
+                    # Le fetch rejoint ne remontait pas assez loin : on relance le nôtre
+                    pending[ticker] = starts[ticker]
+        return results
+
+    def _forget(self, task: asyncio.Task, tickers: List[str]):
+        for ticker in tickers:
+            inflight = self._inflight.get(ticker)
+            if inflight is not None and inflight[0] is task:
+                del self._inflight[ticker]
+
+    async def refresh_held(self, user_id: Optional[int] = None) -> Dict[str, RefreshResult]:
+        from db import engine
+
+        async with AsyncSession(engine) as session:
+            starts = await held_ticker_starts(session, user_id)
+        return await self.refresh_many(starts)
+
+    async def _refresh_batch(self, starts: Dict[str, date]) -> Dict[str, RefreshResult]:
+        """
+        Fetch the tickers that are neither backing off nor behind an open
+        circuit with a single `sync_price_ranges` call, for one limiter token.
+        """
+        from db import engine
+
+        results: Dict[str, RefreshResult] = {}
+        due = {}
+        now = time.monotonic()
+        for ticker, start in starts.items():
+            health = self._health.setdefault(ticker, TickerHealth())
+            if health.open_until > now:
+                self.skipped += 1
+                results[ticker] = (0, "circuit open")
+            elif health.retry_at > now and health.failures < PRICE_BREAKER_THRESHOLD:
+                self.skipped += 1
+                results[ticker] = (0, "backing off")
+            else:
+                due[ticker] = start
+        if not due:
+            return results
+
+        # Un jeton par lot : ses requêtes sont déjà bornées par PRICE_FETCH_CONCURRENCY
+        await self.limiter.acquire()
+        self.fetches += len(due)
+        try:
+            async with AsyncSession(engine) as session:
+                report = await sync_price_ranges(session, due, provider=self.provider)
+            stored, errors = report.stored, report.errors
+        except Exception as e:
+            logger.exception("Price refresh failed for %s", ", ".join(due))
+            stored, errors = {}, {ticker: str(e) for ticker in due}
+
+        for ticker in due:
+            results[ticker] = stored.get(ticker, 0), errors.get(ticker)
+            if ticker in errors:
+                self._record_failure(ticker)
+            else:
+                health = self._health[ticker]
+                health.failures = 0
+                health.retry_at = health.open_until = 0.0
+
+        refreshed = [ticker for ticker in due if ticker not in errors and stored.get(ticker)]
+        if refreshed:
+            await self._notify(refreshed)
+        return results
+
+    def _record_failure(self, ticker: str):
+        self.failures += 1
+        health = self._health[ticker]
+        health.failures += 1
+        now = time.monotonic()
+        delay = min(PRICE_BACKOFF_MAX, PRICE_BACKOFF_BASE * 2 ** (health.failures - 1))
+        health.retry_at = now + delay * random.uniform(0.5, 1.5)
+        if health.failures >= PRICE_BREAKER_THRESHOLD:
+            # Demi-ouvert à l'expiration : un seul essai, qui rouvre le circuit s'il échoue
+            health.open_until = now + PRICE_BREAKER_COOLDOWN
+            logger.warning("Price circuit open for %s after %d failures", ticker, health.failures)
+
+    async def run(self):
+        """
+        Refresh every held ticker each `interval` seconds until cancelled.
+        """
+        while True:
+            started = time.monotonic()
+            try:
+                results = await self.refresh_held()
+                self.cycles += 1
+                errors = sum(1 for _, error in results.values() if error)
+                logger.info("Price refresh: %d tickers, %d errors", len(results), errors)
+            except Exception:
+                logger.exception("Price refresh cycle failed")
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def stats(self) -> dict:
+        return {
+            "inflight": len(self._inflight),
+            "open_circuits": sum(1 for ticker in self._health if self.is_open(ticker)),
+            "fetches": self.fetches,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "cycles": self.cycles,
+        }
+
+
+price_scheduler = PriceRefreshScheduler()
+
+
+async def held_ticker_starts(session: AsyncSession, user_id: Optional[int] = None) -> Dict[str, date]:
+    """
+    Distinct tickers currently held (by anyone, or by one user), each with
+    its first trade date across all users.
+    """
+    held = select(Position.ticker).where(Position.quantity > 0)
+    if user_id is not None:
+        held = held.where(Position.user_id == user_id)
+    query = (
+        select(Transaction.ticker, func.min(Transaction.date_of))
+        .where(Transaction.ticker.in_(held.distinct()))
+        .group_by(Transaction.ticker)
+    )
+    return dict((await session.exec(query)).all())
+
+
+async def get_stale_tickers(session: AsyncSession, user_id: int) -> List[str]:
+    """
+    Tickers held by the user whose prices were not refreshed within
+    PRICE_STALE_AFTER seconds, or whose circuit breaker is open.
+    """
+    rows = (await session.exec(
+        select(Position.ticker, PriceCoverage.synced_at)
+        .outerjoin(PriceCoverage, PriceCoverage.ticker == Position.ticker)
+        .where(Position.user_id == user_id, Position.quantity > 0)
+        .order_by(Position.ticker)
+    )).all()
+    limit = datetime.now() - timedelta(seconds=PRICE_STALE_AFTER)
+    return [
+        ticker for ticker, synced_at in rows
+        if synced_at is None or synced_at < limit or price_scheduler.is_open(ticker)
+    ]
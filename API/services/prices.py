@@ -0,0 +1,497 @@
+import csv
+from abc import ABC, abstractmethod
+import logging
+import os
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
+from collections import OrderedDict
+from itertools import groupby
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import String, cast, delete, func, insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from instrumentation import record_price_fetch
+from models import PriceBar, PriceCoverage
+
+logger = logging.getLogger("api.log")
+
+Bar = Tuple[date, float]
+FetchRequest = Tuple[str, date, date]
+
+PRICE_FETCH_CONCURRENCY = int(os.getenv("PRICE_FETCH_CONCURRENCY", "8"))
+PRICE_FETCH_TIMEOUT = float(os.getenv("PRICE_FETCH_TIMEOUT", "10"))
+PRICE_FETCH_RETRIES = int(os.getenv("PRICE_FETCH_RETRIES", "2"))
+PRICE_CACHE_TICKERS = int(os.getenv("PRICE_CACHE_TICKERS", "500"))
+# Jours refetchés à chaque sync : le dernier cours n'est définitif qu'après la clôture
+PRICE_REFETCH_DAYS = int(os.getenv("PRICE_REFETCH_DAYS", "3"))
+
+
+class PriceFetchResult:
+    """
+    Outcome of a batch fetch: bars per request, and an error message for
+    every request that failed after retries. A batch can partially succeed.
+    """
+    __slots__ = ("bars", "errors")
+
+    def __init__(self):
+        self.bars: Dict[FetchRequest, List[Bar]] = {}
+        self.errors: Dict[FetchRequest, str] = {}
+
+
+# -------------------------- Providers --------------------------
+
+class PriceProvider(ABC):
+    """
+    Source of daily closing prices. Only used to fill the local store,
+    valuation code never calls a provider directly.
+    """
+    name = "base"
+
+    def __init__(
+        self,
+        max_workers: int = PRICE_FETCH_CONCURRENCY,
+        timeout: float = PRICE_FETCH_TIMEOUT,
+        retries: int = PRICE_FETCH_RETRIES
+    ):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+
+    @abstractmethod
+    def fetch_history(self, ticker: str, start: date, end: date) -> List[Bar]:
+        """
+        Daily closes of `ticker` between `start` and `end`, both included.
+        """
+
+    def _fetch_with_retries(self, ticker: str, start: date, end: date) -> List[Bar]:
+        for attempt in range(self.retries + 1):
+            try:
+                return self.fetch_history(ticker, start, end)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                time.sleep(0.5 * 2 ** attempt)
+
+    def fetch_many(self, requests: Iterable[FetchRequest]) -> PriceFetchResult:
+        """
+        Fetch every request concurrently on a bounded pool. Requests still
+        running when the batch deadline expires are reported as timed out.
+        """
+        requests = list(requests)
+        result = PriceFetchResult()
+        if not requests:
+            return result
+
+        deadline = self.timeout * (self.retries + 1) * -(-len(requests) // self.max_workers)
+        pool = ThreadPoolExecutor(max_workers=min(self.max_workers, len(requests)))
+        futures = {pool.submit(self._fetch_with_retries, *request): request for request in requests}
+        done, not_done = wait(futures, timeout=deadline)
+        pool.shutdown(wait=False, cancel_futures=True)
+
+        for future in done:
+            request = futures[future]
+            try:
+                result.bars[request] = future.result()
+            except Exception as e:
+                result.errors[request] = str(e) or type(e).__name__
+        for future in not_done:
+            result.errors[futures[future]] = f"timed out after {deadline:.0f}s"
+        return result
+
+
+class YFinanceProvider(PriceProvider):
+    name = "yfinance"
+
+    def fetch_history(self, ticker: str, start: date, end: date) -> List[Bar]:
+        # Import différé : yfinance charge pandas, inutile tant qu'aucun cours n'est demandé
+        import yfinance as yf
+
+        # yfinance traite `end` comme exclusif
+        history = yf.Ticker(ticker).history(
+            start=start,
+            end=end + timedelta(days=1),
+            interval="1d",
+            timeout=self.timeout,
+            raise_errors=True
+        )
+        if history.empty:
+            return []
+        return [
+            (index.date(), float(close))
+            for index, close in history["Close"].items()
+        ]
+
+
+class FixturePriceProvider(PriceProvider):
+    """
+    Offline provider reading `<TICKER>.csv` files (columns `date,close`)
+    from a directory, or serving an in-memory mapping ticker -> bars.
+    """
+    name = "fixture"
+
+    def __init__(self, fixtures_dir: Optional[str] = None, bars: Optional[Dict[str, List[Bar]]] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.fixtures_dir = fixtures_dir
+        self.bars = {ticker: sorted(rows) for ticker, rows in (bars or {}).items()}
+
+    def _load(self, ticker: str) -> List[Bar]:
+        if ticker not in self.bars:
+            rows = []
+            path = os.path.join(self.fixtures_dir or "", f"{ticker}.csv")
+            if self.fixtures_dir and os.path.exists(path):
+                with open(path, newline="") as f:
+                    for row in csv.DictReader(f):
+                        rows.append((date.fromisoformat(row["date"]), float(row["close"])))
+            self.bars[ticker] = sorted(rows)
+        return self.bars[ticker]
+
+    def fetch_history(self, ticker: str, start: date, end: date) -> List[Bar]:
+        return [(d, close) for d, close in self._load(ticker) if start <= d <= end]
+
+
+# Fournisseurs par nom (PRICE_PROVIDER) ; chaque fabrique n'est appelée qu'au premier fetch
+PRICE_PROVIDERS: Dict[str, Callable[[], PriceProvider]] = {
+    "yfinance": YFinanceProvider,
+    "fixture": lambda: FixturePriceProvider(os.getenv("PRICE_FIXTURES_DIR")),
+}
+
+_provider: Optional[PriceProvider] = None
+
+
+def register_price_provider(name: str, factory: Callable[[], PriceProvider]):
+    """
+    Make a provider selectable with PRICE_PROVIDER=<name>. The factory runs
+    on first use, so it can import its market-data client lazily.
+    """
+    PRICE_PROVIDERS[name] = factory
+
+
+def get_price_provider() -> PriceProvider:
+    global _provider
+    if _provider is None:
+        name = os.getenv("PRICE_PROVIDER", "yfinance")
+        if name not in PRICE_PROVIDERS:
+            raise ValueError(f"Unknown PRICE_PROVIDER {name!r}, expected one of: {', '.join(PRICE_PROVIDERS)}")
+        _provider = PRICE_PROVIDERS[name]()
+    return _provider
+
+
+def set_price_provider(provider: Optional[PriceProvider]):
+    global _provider
+    _provider = provider
+
+
+# -------------------------- Store --------------------------
+
+def _missing_ranges(
+    coverage: Optional[PriceCoverage],
+    start: date,
+    end: date,
+    refetch_days: int = PRICE_REFETCH_DAYS
+) -> List[Tuple[date, date]]:
+    """
+    Date ranges to fetch to cover `start` -> `end`: what lies outside the
+    stored coverage, plus its last `refetch_days` days, whose closes may
+    have been stored before they were final.
+    """
+    if coverage is None:
+        return [(start, end)]
+
+    ranges = []
+    if start < coverage.first_date:
+        ranges.append((start, coverage.first_date - timedelta(days=1)))
+    tail_start = coverage.last_date + timedelta(days=1)
+    if refetch_days:
+        tail_start = min(tail_start, max(coverage.first_date, end - timedelta(days=refetch_days)))
+    if end >= tail_start:
+        ranges.append((tail_start, end))
+    return ranges
+
+
+class PriceSyncReport:
+    __slots__ = ("stored", "errors")
+
+    def __init__(self):
+        self.stored: Dict[str, int] = {}
+        self.errors: Dict[str, str] = {}
+
+
+async def sync_price_ranges(
+    session: AsyncSession,
+    starts: Dict[str, date],
+    end: Optional[date] = None,
+    provider: Optional[PriceProvider] = None,
+    refetch_days: int = PRICE_REFETCH_DAYS
+) -> PriceSyncReport:
+    """
+    Fetch, in one concurrent batch, only the date ranges of each ticker
+    (from its start date) not already covered by the local store, plus the
+    recent tail. Failed tickers keep their previous coverage and are listed
+    in the report.
+    """
+    end = end or date.today()
+    provider = provider or get_price_provider()
+    report = PriceSyncReport()
+    if not starts:
+        return report
+
+    coverages = {
+        coverage.ticker: coverage
+        for coverage in await session.exec(select(PriceCoverage).where(PriceCoverage.ticker.in_(list(starts))))
+    }
+    requests = [
+        (ticker, range_start, range_end)
+        for ticker, start in sorted(starts.items())
+        for range_start, range_end in _missing_ranges(coverages.get(ticker), start, end, refetch_days)
+    ]
+
+    # Le fetch est bloquant : il tourne hors de la boucle d'événements
+    started = time.perf_counter()
+    fetched = await run_in_threadpool(provider.fetch_many, requests)
+    if requests:
+        record_price_fetch(len(requests), time.perf_counter() - started)
+
+    for ticker in starts:
+        report.stored[ticker] = 0
+
+    for (ticker, range_start, range_end), message in fetched.errors.items():
+        logger.warning("Price fetch failed for %s (%s -> %s): %s", ticker, range_start, range_end, message)
+        report.errors[ticker] = message
+
+    changed_from: Dict[str, date] = {}
+    for (ticker, range_start, range_end), bars in fetched.bars.items():
+        stored = dict((await session.exec(
+            select(PriceBar.date_of, PriceBar.close)
+            .where(PriceBar.ticker == ticker, PriceBar.date_of >= range_start, PriceBar.date_of <= range_end)
+        )).all())
+        # Première date dont le cours apparaît, change ou disparaît
+        changed = [d for d, close in bars if stored.pop(d, None) != close] + list(stored)
+        if changed:
+            changed_from[ticker] = min(changed_from.get(ticker, date.max), min(changed))
+
+        await session.exec(
+            delete(PriceBar).where(
+                PriceBar.ticker == ticker,
+                PriceBar.date_of >= range_start,
+                PriceBar.date_of <= range_end
+            )
+        )
+        if bars:
+            await session.exec(
+                insert(PriceBar),
+                params=[{"ticker": ticker, "date_of": d, "close": close} for d, close in bars]
+            )
+        report.stored[ticker] += len(bars)
+
+        coverage = coverages.get(ticker)
+        if coverage is None:
+            coverage = coverages[ticker] = PriceCoverage(ticker=ticker, first_date=range_start, last_date=range_end)
+        else:
+            coverage.first_date = min(coverage.first_date, range_start)
+            coverage.last_date = max(coverage.last_date, range_end)
+        coverage.synced_at = datetime.now()
+        session.add(coverage)
+
+    if changed_from:
+        # Import différé : services.nav dépend de ce module
+        from services.nav import mark_prices_dirty
+
+        await mark_prices_dirty(session, changed_from)
+    await session.commit()
+    return report
+
+
+def _last_bars_query(tickers: List[str], as_of: date):
+    last_dates = (
+        select(PriceBar.ticker, func.max(PriceBar.date_of).label("date_of"))
+        .where(PriceBar.ticker.in_(tickers), PriceBar.date_of <= as_of)
+        .group_by(PriceBar.ticker)
+        .subquery()
+    )
+    return (
+        select(PriceBar.ticker, PriceBar.date_of, PriceBar.close)
+        .join(
+            last_dates,
+            (PriceBar.ticker == last_dates.c.ticker) & (PriceBar.date_of == last_dates.c.date_of)
+        )
+    )
+
+
+async def get_closes_as_of(session: AsyncSession, tickers: Iterable[str], as_of: date) -> Dict[str, float]:
+    """
+    Last known close on or before `as_of` for each ticker, in a single query.
+    Tickers without any stored bar are absent from the result.
+    """
+    tickers = list(tickers)
+    if not tickers:
+        return {}
+
+    rows = (await session.exec(_last_bars_query(tickers, as_of))).all()
+    return {ticker: close for ticker, _, close in rows}
+
+
+class PriceSeries:
+    """
+    Close history of one ticker, answering "close as of D" by bisection.
+    """
+    __slots__ = ("dates", "closes")
+
+    def __init__(self, dates: List[date], closes: List[float]):
+        self.dates = dates
+        self.closes = closes
+
+    def as_of(self, target_date: date) -> Optional[float]:
+        i = bisect_right(self.dates, target_date)
+        if i == 0:
+            return None
+        return self.closes[i - 1]
+
+
+async def load_price_series(
+    session: AsyncSession,
+    tickers: Iterable[str],
+    end: Optional[date] = None,
+    start: Optional[date] = None
+) -> Dict[str, PriceSeries]:
+    """
+    Close history of each ticker up to `end`. With `start`, only bars from
+    `start` on are loaded, plus the last bar before it so that every date
+    of the window has a close as of.
+    """
+    tickers = list(tickers)
+    if not tickers:
+        return {}
+
+    series = {ticker: PriceSeries([], []) for ticker in tickers}
+    query = (
+        select(PriceBar.ticker, PriceBar.date_of, PriceBar.close)
+        .where(PriceBar.ticker.in_(tickers))
+        .order_by(PriceBar.ticker, PriceBar.date_of)
+    )
+    if start is not None:
+        for ticker, date_of, close in await session.exec(_last_bars_query(tickers, start - timedelta(days=1))):
+            series[ticker].dates.append(date_of)
+            series[ticker].closes.append(close)
+        query = query.where(PriceBar.date_of >= start)
+    if end is not None:
+        query = query.where(PriceBar.date_of <= end)
+
+    for ticker, date_of, close in await session.exec(query):
+        series[ticker].dates.append(date_of)
+        series[ticker].closes.append(close)
+    return series
+
+
+class PriceColumns:
+    """
+    Full close history of one ticker as numpy arrays (dates as datetime64[D]).
+    """
+    __slots__ = ("dates", "closes")
+
+    def __init__(self, dates: np.ndarray, closes: np.ndarray):
+        self.dates = dates
+        self.closes = closes
+
+
+class PriceColumnCache:
+    """
+    In-process LRU of `PriceColumns` per ticker, shared by every request of
+    the vectorized valuation paths. Emptied as soon as a price sync lands, in
+    this process or another, through the coverage watermark.
+    """
+
+    def __init__(self, max_tickers: int = PRICE_CACHE_TICKERS):
+        self.max_tickers = max_tickers
+        self._entries: "OrderedDict[str, PriceColumns]" = OrderedDict()
+        # Partagé avec les threads du pool de jobs, chacun avec sa propre boucle
+        self._lock = threading.Lock()
+        self.watermark = None
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, session: AsyncSession, tickers: Iterable[str]) -> Dict[str, PriceColumns]:
+        tickers = list(tickers)
+        if not tickers:
+            return {}
+
+        watermark = (await session.exec(select(func.max(PriceCoverage.synced_at)))).first()
+        with self._lock:
+            if watermark != self.watermark:
+                self._entries.clear()
+                self.watermark = watermark
+            # Copie locale avant l'await : une autre requête peut vider ou évincer le cache entre-temps
+            result = {ticker: self._entries[ticker] for ticker in tickers if ticker in self._entries}
+            missing = [ticker for ticker in tickers if ticker not in result]
+            self.hits += len(result)
+            self.misses += len(missing)
+        if missing:
+            result.update(await self._load(session, missing))
+
+        with self._lock:
+            if watermark == self.watermark:
+                # Pas de sync entre-temps : les colonnes lues sont encore à jour
+                for ticker in tickers:
+                    self._entries[ticker] = result[ticker]
+                    self._entries.move_to_end(ticker)
+                while len(self._entries) > self.max_tickers:
+                    self._entries.popitem(last=False)
+        return {ticker: result[ticker] for ticker in tickers}
+
+    async def _load(self, session: AsyncSession, tickers: List[str]) -> Dict[str, PriceColumns]:
+        # Colonnes brutes, sans objets ORM ; numpy convertit les dates ISO en bloc
+        table = PriceBar.__table__
+        rows = (await session.exec(
+            select(table.c.ticker, cast(table.c.date_of, String), table.c.close)
+            .where(table.c.ticker.in_(tickers))
+            .order_by(table.c.ticker, table.c.date_of)
+        )).all()
+        empty = PriceColumns(np.empty(0, dtype="datetime64[D]"), np.empty(0))
+        loaded = {ticker: empty for ticker in tickers}
+        if not rows:
+            return loaded
+
+        names, dates, closes = zip(*rows)
+        dates = np.array(dates, dtype="datetime64[D]")
+        closes = np.array(closes, dtype=np.float64)
+        offset = 0
+        for ticker, group in groupby(names):
+            count = sum(1 for _ in group)
+            loaded[ticker] = PriceColumns(dates[offset:offset + count], closes[offset:offset + count])
+            offset += count
+        return loaded
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.watermark = None
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+price_cache = PriceColumnCache()
+
+
+async def sync_held_prices(
+    session: AsyncSession,
+    provider: Optional[PriceProvider] = None,
+    user_id: Optional[int] = None
+) -> PriceSyncReport:
+    """
+    Bring the store up to date for every traded ticker (optionally only
+    those of one user), from its first trade.
+    """
+    from models import Transaction
+
+    query = select(Transaction.ticker, func.min(Transaction.date_of)).group_by(Transaction.ticker)
+    if user_id is not None:
+        query = query.where(Transaction.user_id == user_id)
+
+    return await sync_price_ranges(session, dict((await session.exec(query)).all()), provider=provider)
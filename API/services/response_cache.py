@@ -0,0 +1,185 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Callable, Optional, Tuple
+
+from fastapi import HTTPException, Request, Response
+from fastapi.routing import APIRoute
+from fastapi.security.utils import get_authorization_scheme_param
+from sqlalchemy import func, update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.responses import StreamingResponse
+
+from db import read_engine
+from models import PriceCoverage, User
+from routes.auth import decode_token
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRY = int(os.getenv("RESPONSE_CACHE_MAX_ENTRY", str(1024 * 1024)))
+# Durée de vie max d'un ETag : les indicateurs de cours périmés dépendent de l'heure
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "300"))
+
+# En-têtes recalculés à chaque réponse, inutiles à conserver
+_SKIPPED_HEADERS = {"content-length", "content-type", "etag", "cache-control"}
+
+
+class ResponseCache:
+    """
+    In-process LRU cache of rendered GET responses, keyed by ETag and bounded
+    both in entries and in total body size.
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, max_bytes: int = RESPONSE_CACHE_BYTES,
+                 max_entry_bytes: int = RESPONSE_CACHE_MAX_ENTRY):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def get(self, etag: str) -> Optional[Tuple[bytes, Optional[str], dict]]:
+        entry = self._entries.get(etag)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(etag)
+        self.hits += 1
+        return entry[1:]
+
+    def put(self, etag: str, user_id: int, body: bytes, media_type: Optional[str], headers: dict):
+        if len(body) > self.max_entry_bytes or self.max_entries <= 0:
+            return
+        self._remove(etag)
+        self._entries[etag] = (user_id, body, media_type, headers)
+        self.bytes += len(body)
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, etag: str):
+        entry = self._entries.pop(etag, None)
+        if entry is not None:
+            self.bytes -= len(entry[1])
+
+    def invalidate_user(self, user_id: int):
+        for etag in [etag for etag, entry in self._entries.items() if entry[0] == user_id]:
+            self._remove(etag)
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "evictions": self.evictions,
+        }
+
+
+response_cache = ResponseCache()
+
+
+async def bump_ledger_version(session: AsyncSession, user_id: int):
+    """
+    Mark every cached read of the user as stale. Call it inside the
+    transaction that writes to the ledger, before the commit.
+    """
+    await session.exec(
+        update(User).where(User.id == user_id).values(ledger_version=User.ledger_version + 1)
+    )
+    response_cache.invalidate_user(user_id)
+
+
+async def get_cache_watermarks(session: AsyncSession, user_id: int) -> Optional[Tuple[int, Optional[str]]]:
+    """
+    Ledger version of the user and time of the last price sync, in a single query.
+    """
+    row = (await session.exec(
+        select(User.ledger_version, select(func.max(PriceCoverage.synced_at)).scalar_subquery())
+        .where(User.id == user_id)
+    )).first()
+    if row is None:
+        return None
+    version, synced_at = row
+    return version, str(synced_at)
+
+
+def make_etag(user_id: int, version: int, price_watermark: str, request: Request) -> str:
+    # Les réponses sans date explicite dépendent du jour courant
+    query = "&".join(sorted(f"{k}={v}" for k, v in request.query_params.multi_items()))
+    epoch = int(time.time() // RESPONSE_CACHE_TTL) if RESPONSE_CACHE_TTL > 0 else 0
+    key = f"{user_id}|{version}|{price_watermark}|{date.today()}|{epoch}|{request.url.path}?{query}"
+    return '"' + hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + '"'
+
+
+def _matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {part.strip().removeprefix("W/") for part in if_none_match.split(",")}
+    return etag in candidates or "*" in candidates
+
+
+def _cache_headers(etag: str) -> dict:
+    # Le navigateur garde la réponse mais la revalide à chaque chargement
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+class LedgerCachedRoute(APIRoute):
+    """
+    GET routes whose response only depends on the user's ledger and on stored
+    prices: answered with an ETag, 304 when it still matches, and served from
+    `response_cache` while neither the ledger nor the prices changed.
+    Streaming exports and event streams are left alone.
+    """
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        if self.methods != {"GET"} or self.path.endswith(("/export", "/stream")):
+            return handler
+
+        async def cached_handler(request: Request) -> Response:
+            scheme, token = get_authorization_scheme_param(request.headers.get("Authorization"))
+            if scheme.lower() != "bearer" or not token:
+                return await handler(request)
+            try:
+                user_id = int(decode_token(token)["sub"])
+            except HTTPException:
+                return await handler(request)
+
+            # Moteur retenu pour toute la requête : l'ETag reflète ce que la route lira
+            async with AsyncSession(read_engine(request)) as session:
+                watermarks = await get_cache_watermarks(session, user_id)
+            if watermarks is None:
+                return await handler(request)
+
+            etag = make_etag(user_id, *watermarks, request)
+            if _matches(request.headers.get("If-None-Match"), etag):
+                response_cache.not_modified += 1
+                return Response(status_code=304, headers=_cache_headers(etag))
+
+            cached = response_cache.get(etag)
+            if cached is not None:
+                body, media_type, headers = cached
+                return Response(body, media_type=media_type, headers={**headers, **_cache_headers(etag)})
+
+            response = await handler(request)
+            if response.status_code != 200 or isinstance(response, StreamingResponse):
+                return response
+            headers = {k: v for k, v in response.headers.items() if k not in _SKIPPED_HEADERS}
+            response_cache.put(etag, user_id, response.body, response.headers.get("content-type"), headers)
+            response.headers.update(_cache_headers(etag))
+            return response
+
+        return cached_handler
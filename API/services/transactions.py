@@ -1,49 +1,73 @@
-from collections import defaultdict
 from datetime import date, timedelta
-from typing import List, Optional
+from typing import List, Optional, Set, Tuple
+import numpy as np
 from fastapi import Depends, HTTPException, Query
-from sqlalchemy import func
-from sqlmodel import Session, select
+from sqlalchemy import func, tuple_
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from db import get_session
-from models import DailyQuantity, Transaction, User
+from models import DailyQuantity, DailyQuantityColumns, Position, Transaction, User
 from routes.auth import get_current_user
 from dateutil.relativedelta import relativedelta
-import yfinance as yf
+from services.positions import get_quantities_as_of, get_total_cost_basis
+from services.price_scheduler import get_stale_tickers
+from services.prices import get_closes_as_of
+from services.nav import nav_history
+from services.valuation import LedgerMatrix, holdings_timeline, load_ledger_matrix, quantity_changes
 from services.utils import *
+import logging
 
+logger = logging.getLogger("api.log")
 
-def get_user_transactions(
-    session: Session = Depends(get_session),
+
+async def get_user_transactions(
+    session: AsyncSession = Depends(get_session),
     current_user: User = Depends(get_current_user),
     limit: int = Query(None, le=100, alias="page_size"),
-    offset: int = Query(0, ge=0, alias="page")
+    offset: int = Query(0, ge=0, alias="page"),
+    cursor: Optional[str] = None
 ) -> List[Transaction]:
-    query = select(Transaction).where(Transaction.user_id == current_user.id)
+    """
+    Transactions ordered by (date_of, id). With a `cursor`, rows strictly after
+    it are returned (keyset pagination) and `offset` is ignored.
+    """
+    query = (
+        select(Transaction)
+        .where(Transaction.user_id == current_user.id)
+        .order_by(Transaction.date_of, Transaction.id)
+    )
 
-    if limit is None:
-        transactions = session.exec(query).all()
-    else:
-        transactions = session.exec(query.offset(offset).limit(limit)).all()
+    if cursor is not None:
+        try:
+            cursor_date, cursor_id = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.where(tuple_(Transaction.date_of, Transaction.id) > tuple_(cursor_date, cursor_id))
+    elif offset:
+        query = query.offset(offset)
+
+    if limit is not None:
+        query = query.limit(limit)
 
-    return transactions
+    return (await session.exec(query)).all()
 
 
-def get_user_total_transactions(
-    session: Session = Depends(get_session),
+async def get_user_total_transactions(
+    session: AsyncSession = Depends(get_session),
     current_user: User = Depends(get_current_user)
 ) -> int:
-    total = session.exec(
+    total = (await session.exec(
         select(func.count(Transaction.id)).where(Transaction.user_id == current_user.id)
-    ).first()
+    )).first()
     return total
 
 
-def get_user_transaction_by_id(
+async def get_user_transaction_by_id(
     transaction_id: int,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     current_user: User = Depends(get_current_user)
 ) -> Transaction:
-    transaction = session.get(Transaction, transaction_id)
+    transaction = await session.get(Transaction, transaction_id)
     if not transaction:
         raise HTTPException(status_code=404, detail="Transaction not found")
     
@@ -53,180 +77,167 @@ def get_user_transaction_by_id(
     return transaction
 
 
-def get_user_all_tickers(
-    session: Session = Depends(get_session),
+async def get_user_all_tickers(
+    session: AsyncSession = Depends(get_session),
     current_user: User = Depends(get_current_user)
 ) -> List[DailyQuantity]:
-    tickers = session.exec(
+    tickers = (await session.exec(
         select(Transaction.ticker)
         .where(Transaction.user_id == current_user.id)
         .distinct()
-    ).all()
+    )).all()
     return tickers
 
 
-def get_user_daily_quantity_by_ticker(
-    session: Session = Depends(get_session),
+async def get_user_quantity_changes(
+    session: AsyncSession,
+    current_user: User,
+    tickers: Optional[List[str]] = None,
+    end: Optional[date] = None
+):
+    """
+    Cumulative quantity of each ticker at each date it changed, from the
+    columnar ledger. Rows are (ticker, date, quantity) ordered by date.
+    """
+    ledger = await load_ledger_matrix(session, current_user.id, tickers, end)
+    dates, ticker_idx, quantities = quantity_changes(ledger)
+    return [
+        (ledger.tickers[i], d, quantity)
+        for d, i, quantity in zip(dates.tolist(), ticker_idx.tolist(), quantities.tolist())
+    ]
+
+
+async def get_user_daily_quantity_by_ticker(
+    session: AsyncSession = Depends(get_session),
+    current_user: User = Depends(get_current_user),
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    tickers: Optional[List[str]] = None
+) -> List[DailyQuantity]:
+    """
+    Holdings snapshot at each date where the visible holdings change.
+    Changes before `start` are folded into a single snapshot dated `start`.
+    """
+    ledger = await load_ledger_matrix(session, current_user.id, tickers, end)
+    return quantity_snapshots(ledger, start)
+
+
+def quantity_snapshots(ledger: LedgerMatrix, start: Optional[date] = None) -> List[DailyQuantity]:
+    dates, visible = holdings_timeline(ledger, start)
+    names = np.array(ledger.tickers, dtype=object)
+    quantities = np.rint(visible).astype(np.int64)
+    # Valeurs déjà typées : pas de validation pydantic par snapshot
+    return [
+        DailyQuantity.model_construct(date=d, tickers=dict(zip(names[row > 0].tolist(), row[row > 0].tolist())))
+        for d, row in zip(dates.tolist(), quantities)
+    ]
+
+
+async def get_user_daily_quantity_columns(
+    session: AsyncSession,
+    current_user: User,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    tickers: Optional[List[str]] = None
+) -> DailyQuantityColumns:
+    """
+    Same timeline as `get_user_daily_quantity_by_ticker`, one quantity list
+    per ticker aligned with `dates` (0 when not held).
+    """
+    ledger = await load_ledger_matrix(session, current_user.id, tickers, end)
+    dates, visible = holdings_timeline(ledger, start)
+    held = np.flatnonzero(np.any(visible > 0, axis=0)) if len(dates) else np.empty(0, dtype=np.int64)
+    return DailyQuantityColumns(
+        dates=dates.tolist(),
+        tickers=[ledger.tickers[i] for i in held],
+        quantities=np.rint(visible[:, held].T).astype(np.int64).tolist()
+    )
+
+
+async def get_user_total_invest_price(
+    session: AsyncSession = Depends(get_session),
     current_user: User = Depends(get_current_user)
 ):
-    transactions = session.exec(
-        select(Transaction)
-        .where(Transaction.user_id == current_user.id)
-        .order_by(Transaction.date_of)
-    ).all()
-
-    if not transactions:
-        return []
-
-    start_date = transactions[0].date_of
-    end_date = date.today()
-
-    current_holdings = defaultdict(float)
-    last_recorded = {}
+    return await get_total_cost_basis(session, current_user.id)
 
-    history = []
 
-    tx_by_day = defaultdict(list)
-    for tx in transactions:
-        tx_by_day[tx.date_of].append(tx)
-
-    current_day = start_date
-    while current_day <= end_date:
-        for tx in tx_by_day.get(current_day, []):
-            if tx.type == "achat":
-                current_holdings[tx.ticker] += tx.quantity
-            elif tx.type == "vente":
-                current_holdings[tx.ticker] -= tx.quantity
-
-        visible_holdings = {
-            ticker: round(qty, 6)
-            for ticker, qty in current_holdings.items()
-            if qty > 0
-        }
-
-        if visible_holdings != last_recorded:
-            history.append(DailyQuantity(
-                date=current_day,
-                tickers=dict(sorted(visible_holdings.items()))
-            ))
-            last_recorded = visible_holdings.copy()
-
-        current_day += timedelta(days=1)
-
-    return history
-
-
-def get_user_total_invest_price(
-    session: Session = Depends(get_session),
+async def get_user_pnl_by_ticker(
+    session: AsyncSession = Depends(get_session),
     current_user: User = Depends(get_current_user)
 ):
-    transactions = session.exec(
-        select(Transaction)
-        .where(Transaction.user_id == current_user.id)
-    ).all()
-
-    total = 0.0
+    """
+    PRU, realized and unrealized P&L of every ticker ever traded, read from the
+    stored positions and the last known closes (three queries: positions,
+    closes and stale tickers).
+    """
+    positions = (await session.exec(
+        select(Position).where(Position.user_id == current_user.id).order_by(Position.ticker)
+    )).all()
+    closes = await get_closes_as_of(session, [p.ticker for p in positions if p.quantity], date.today())
+    stale = set(await get_stale_tickers(session, current_user.id))
+
+    results = []
+    for position in positions:
+        last_close = closes.get(position.ticker)
+        market_value = position.quantity * last_close if last_close is not None else 0.0
+        results.append({
+            "ticker": position.ticker,
+            "quantity": position.quantity,
+            "average_cost": position.cost_basis / position.quantity if position.quantity > 0 else 0.0,
+            "cost_basis": position.cost_basis,
+            "last_close": last_close,
+            "market_value": market_value,
+            "unrealized_pnl": market_value - position.cost_basis if last_close is not None else 0.0,
+            "realized_pnl": position.realized_pnl,
+            "stale": position.ticker in stale,
+        })
+    return results
 
-    for tx in transactions:
-        montant = tx.price * tx.quantity
-        if tx.type == "achat":
-            total += montant
-        elif tx.type == "vente":
-            total -= montant
-        else:
-            print(f"Type de transaction inconnu : {tx.type}")
 
-    return total
+async def get_user_pnl_total(
+    session: AsyncSession = Depends(get_session),
+    current_user: User = Depends(get_current_user)
+):
+    rows = await get_user_pnl_by_ticker(session, current_user)
+    totals = {
+        name: sum(row[name] for row in rows)
+        for name in ("cost_basis", "market_value", "unrealized_pnl", "realized_pnl")
+    }
+    totals["total_pnl"] = totals["unrealized_pnl"] + totals["realized_pnl"]
+    return totals
 
 
-def get_user_total_price_by_date(
+async def get_user_total_price_by_date(
     date_param: Optional[date] = Query(default=None),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     current_user: User = Depends(get_current_user)
 ):
     target_date = date_param or date.today()
-    
-    transactions = session.exec(
-        select(Transaction.ticker, Transaction.quantity, Transaction.type)
-        .where(
-            Transaction.user_id == current_user.id,
-            Transaction.date_of <= target_date
-        )
-    ).all()
-
-    quantities_by_ticker = defaultdict(float)
-    for tx in transactions:
-        if tx.type == "achat":
-            quantities_by_ticker[tx.ticker] += tx.quantity
-        elif tx.type == "vente":
-            quantities_by_ticker[tx.ticker] -= tx.quantity
-
-    total = 0.0
-
-    for ticker, total_quantity in quantities_by_ticker.items():
-        try:
-            yf_ticker = yf.Ticker(ticker)
 
-            history = yf_ticker.history(period="30d", interval="1d")
-            valid_dates = history[history.index.date <= target_date]
+    quantities_by_ticker = await get_quantities_as_of(session, current_user.id, target_date)
 
-            if not valid_dates.empty:
-                price = valid_dates["Close"].iloc[-1]
-            else:
-                continue
+    closes = await get_closes_as_of(session, quantities_by_ticker.keys(), target_date)
 
-            if price is None:
-                continue
-
-            total += price * total_quantity
+    total = 0.0
 
-        except Exception as e:
+    for ticker, total_quantity in quantities_by_ticker.items():
+        price = closes.get(ticker)
+        if price is None:
+            logger.warning("No stored price for %s as of %s", ticker, target_date)
             continue
 
-    return total
+        total += price * total_quantity
 
+    return total
 
-def get_user_pea_history(
-    period: str = Query(default="5a"),
-    session: Session = Depends(get_session),
-    current_user: User = Depends(get_current_user)
-):
-    try:
-        delta = parse_period(period)
-        if delta is None:
-            raise ValueError("Invalid period")
-    except ValueError as e:
-        return {"error": str(e)}
 
+def history_dates(period: str) -> Tuple[date, date, Set[date]]:
+    """
+    Bounds of a history period ending today and its regular sampling dates.
+    Raises 400 on an invalid period (see `period_start`).
+    """
     end_date = date.today()
-    start_date = end_date - delta
-
-    # Obtenir les dates de changement de quantités
-    transactions = session.exec(
-        select(Transaction)
-        .where(Transaction.user_id == current_user.id)
-        .order_by(Transaction.date_of)
-    ).all()
-
-    quantity_change_dates = set()
-    current_holdings = defaultdict(float)
-    last_snapshot = {}
-
-    for tx in transactions:
-        if tx.type == "achat":
-            current_holdings[tx.ticker] += tx.quantity
-        elif tx.type == "vente":
-            current_holdings[tx.ticker] -= tx.quantity
-
-        snapshot = {
-            ticker: round(qty, 6)
-            for ticker, qty in current_holdings.items()
-            if qty > 0
-        }
-
-        if snapshot != last_snapshot:
-            quantity_change_dates.add(tx.date_of)
-            last_snapshot = snapshot.copy()
+    start_date = period_start(period, end_date)
 
     # Générer des dates régulières (tous les 7 jours ou tous les mois)
     interval_dates = set()
@@ -244,43 +255,20 @@ def get_user_pea_history(
         while current <= end_date:
             interval_dates.add(current)
             current += relativedelta(months=1)
+    return start_date, end_date, interval_dates
 
-    # Fusion des deux types de dates
-    all_dates = sorted(quantity_change_dates.union(interval_dates))
-
-    history_data = []
-
-    for target_date in all_dates:
-        transactions_until_date = session.exec(
-            select(Transaction.ticker, Transaction.quantity, Transaction.type)
-            .where(
-                Transaction.user_id == current_user.id,
-                Transaction.date_of <= target_date
-            )
-        ).all()
-
-        quantities_by_ticker = defaultdict(float)
-        for tx in transactions_until_date:
-            if tx.type == "achat":
-                quantities_by_ticker[tx.ticker] += tx.quantity
-            elif tx.type == "vente":
-                quantities_by_ticker[tx.ticker] -= tx.quantity
-
-        total = 0.0
-        for ticker, total_quantity in quantities_by_ticker.items():
-            try:
-                yf_ticker = yf.Ticker(ticker)
-                history = yf_ticker.history(period="30d", interval="1d")
-                valid_prices = history[history.index.date <= target_date]
-                if not valid_prices.empty:
-                    price = valid_prices["Close"].iloc[-1]
-                    total += price * total_quantity
-            except:
-                continue
-
-        history_data.append({
-            "date": target_date.isoformat(),
-            "value": total
-        })
 
-    return history_data
+async def get_user_pea_history(
+    period: str = Query(default="5a"),
+    session: AsyncSession = Depends(get_session),
+    current_user: User = Depends(get_current_user)
+):
+    start_date, end_date, interval_dates = history_dates(period)
+
+    # Lu dans la série quotidienne précalculée, plus les dates de transaction
+    points = await nav_history(session, current_user.id, start_date, end_date, interval_dates)
+
+    return [
+        {"date": target_date.isoformat(), "value": value}
+        for target_date, value in points.items()
+    ]
@@ -1,5 +1,7 @@
 from dateutil.relativedelta import relativedelta
-from datetime import timedelta
+from datetime import date, timedelta
+from fastapi import HTTPException
+import base64
 
 def parse_period(period: str):
     if period.endswith("d"):
@@ -8,5 +10,32 @@ def parse_period(period: str):
         return timedelta(weeks=int(period[:-1]))
     elif period.endswith("m"):
         return relativedelta(months=int(period[:-1]))
-    elif period.endswith("y"):
+    elif period.endswith("y") or period.endswith("a"):
         return relativedelta(years=int(period[:-1]))
+
+def period_start(period: str, end: date) -> date:
+    """
+    First day of a period ending on `end`. Raises 400 on a period that does
+    not parse, overflows or is not positive.
+    """
+    try:
+        delta = parse_period(period)
+        start = end - delta if delta is not None else None
+    except (ValueError, OverflowError):
+        start = None
+    if start is None or start >= end:
+        raise HTTPException(status_code=400, detail="Invalid period")
+    return start
+
+
+def encode_cursor(date_of: date, transaction_id: int) -> str:
+    raw = f"{date_of.isoformat()}|{transaction_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        date_part, id_part = raw.split("|")
+        return date.fromisoformat(date_part), int(id_part)
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
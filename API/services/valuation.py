@@ -0,0 +1,197 @@
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import String, cast
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import Transaction, TransactionType
+from services.prices import PriceColumns, price_cache
+
+
+class LedgerMatrix:
+    """
+    A user's ledger reduced to aligned arrays: one row per transaction,
+    sorted by date then insertion order, with tickers interned to column
+    indexes into `tickers` (sorted). Quantities and amounts (quantity x price)
+    are signed: negative for sales. This is the representation every
+    aggregation over the ledger works on.
+    """
+    __slots__ = ("tickers", "dates", "ticker_idx", "quantities", "prices", "amounts")
+
+    def __init__(self, tickers: List[str], dates: np.ndarray, ticker_idx: np.ndarray, quantities: np.ndarray,
+                 prices: np.ndarray, amounts: np.ndarray):
+        self.tickers = tickers
+        self.dates = dates
+        self.ticker_idx = ticker_idx
+        self.quantities = quantities
+        self.prices = prices
+        self.amounts = amounts
+
+    def __len__(self):
+        return len(self.dates)
+
+
+def _ledger_matrix(dates: np.ndarray, names: np.ndarray, quantities: np.ndarray, prices: np.ndarray) -> LedgerMatrix:
+    tickers, ticker_idx = np.unique(names, return_inverse=True)
+    return LedgerMatrix(tickers.tolist(), dates, ticker_idx.astype(np.int64), quantities, prices, quantities * prices)
+
+
+async def load_ledger_matrices(
+    session: AsyncSession,
+    user_ids: Iterable[int],
+    tickers: Optional[Sequence[str]] = None,
+    end: Optional[date] = None
+) -> Dict[int, LedgerMatrix]:
+    """
+    Ledgers of several users read in a single query, optionally restricted
+    to some tickers and to trades up to `end`. Every requested user is
+    present in the result, with an empty ledger if they have no transactions.
+    """
+    user_ids = list(user_ids)
+    rows = []
+    if user_ids:
+        # Colonnes brutes, sans objets ORM ; numpy convertit les dates ISO et les types en bloc
+        table = Transaction.__table__
+        query = (
+            select(table.c.user_id, cast(table.c.date_of, String), table.c.ticker, cast(table.c.type, String),
+                   table.c.quantity, table.c.price)
+            .where(table.c.user_id.in_(user_ids))
+            .order_by(table.c.user_id, table.c.date_of, table.c.id)
+        )
+        if tickers:
+            query = query.where(table.c.ticker.in_(list(tickers)))
+        if end is not None:
+            query = query.where(table.c.date_of <= end)
+        rows = (await session.exec(query)).all()
+    empty = _ledger_matrix(np.empty(0, dtype="datetime64[D]"), np.empty(0, dtype=str), np.empty(0), np.empty(0))
+    if not rows:
+        return {user_id: empty for user_id in user_ids}
+
+    # Conversion colonne par colonne pour tout le lot, puis découpage par utilisateur (tri par user_id)
+    users, dates, names, types, quantities, prices = zip(*rows)
+    users = np.array(users)
+    dates = np.array(dates, dtype="datetime64[D]")
+    names = np.array(names)
+    quantities = np.where(np.array(types) == TransactionType.achat.value, 1.0, -1.0) * np.array(quantities, dtype=np.float64)
+    prices = np.array(prices, dtype=np.float64)
+
+    bounds = np.flatnonzero(np.diff(users)) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(users)]])
+    ledgers = {
+        int(users[start]): _ledger_matrix(dates[start:end], names[start:end], quantities[start:end], prices[start:end])
+        for start, end in zip(starts, ends)
+    }
+    return {user_id: ledgers.get(user_id, empty) for user_id in user_ids}
+
+
+async def load_ledger_matrix(
+    session: AsyncSession,
+    user_id: int,
+    tickers: Optional[Sequence[str]] = None,
+    end: Optional[date] = None
+) -> LedgerMatrix:
+    return (await load_ledger_matrices(session, [user_id], tickers, end))[user_id]
+
+
+def position_matrix(ledger: LedgerMatrix, target_dates: np.ndarray) -> np.ndarray:
+    """
+    Quantity held of each ticker at the end of each target date
+    (dates x tickers), built with a single cumulative sum.
+    """
+    deltas = np.zeros((len(target_dates) + 1, len(ledger.tickers)))
+    # Chaque transaction compte à partir de la première date cible >= sa date
+    rows = np.searchsorted(target_dates, ledger.dates, side="left")
+    np.add.at(deltas, (rows, ledger.ticker_idx), ledger.quantities)
+    return np.cumsum(deltas, axis=0)[:-1]
+
+
+def invested_amounts(ledger: LedgerMatrix, target_dates: np.ndarray) -> np.ndarray:
+    """
+    Net amount invested (purchases minus sales) at the end of each target date.
+    """
+    cumulative = np.concatenate([[0.0], np.cumsum(ledger.amounts)])
+    return cumulative[np.searchsorted(ledger.dates, target_dates, side="right")]
+
+
+def price_matrix(tickers: Sequence[str], prices: Dict[str, PriceColumns], target_dates: np.ndarray) -> np.ndarray:
+    """
+    Last known close of each ticker as of each target date (dates x tickers).
+    Missing prices are NaN.
+    """
+    matrix = np.full((len(target_dates), len(tickers)), np.nan)
+    for column, ticker in enumerate(tickers):
+        series = prices.get(ticker)
+        if series is None or not len(series.dates):
+            continue
+        positions = np.searchsorted(series.dates, target_dates, side="right") - 1
+        known = positions >= 0
+        matrix[known, column] = series.closes[positions[known]]
+    return matrix
+
+
+def holdings_timeline(ledger: LedgerMatrix, start: Optional[date] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Visible holdings (quantity > 0, rounded to 6 decimals) at each date where
+    they change: (dates, dates x tickers). Trades before `start` are folded
+    into a single snapshot dated `start`.
+    """
+    if len(ledger) == 0:
+        return ledger.dates, np.empty((0, 0))
+
+    tx_dates = np.unique(ledger.dates)
+    if start is not None:
+        start = np.datetime64(start, "D")
+        tx_dates = np.concatenate([[start], tx_dates[tx_dates > start]])
+    visible = np.clip(np.round(position_matrix(ledger, tx_dates), 6), 0, None)
+    previous = np.vstack([np.zeros((1, visible.shape[1])), visible[:-1]])
+    changed = np.any(visible != previous, axis=1)
+    return tx_dates[changed], visible[changed]
+
+
+def holdings_change_dates(ledger: LedgerMatrix) -> np.ndarray:
+    """
+    Dates on which the set of visible holdings (quantity > 0) changes.
+    """
+    return holdings_timeline(ledger)[0]
+
+
+def quantity_changes(ledger: LedgerMatrix) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Cumulative quantity of each ticker at the end of each date it traded:
+    (dates, ticker indexes, quantities) ordered by date then ticker.
+    """
+    if len(ledger) == 0:
+        return ledger.dates, ledger.ticker_idx, ledger.quantities
+
+    # Tri stable par ticker : l'ordre des transactions d'une même journée est conservé
+    order = np.lexsort((ledger.dates, ledger.ticker_idx))
+    idx, dates, quantities = ledger.ticker_idx[order], ledger.dates[order], ledger.quantities[order]
+    # Cumul séquentiel par ticker, sans la dérive d'un cumul global recentré
+    bounds = np.flatnonzero(np.diff(idx)) + 1
+    cumulative = np.concatenate([np.cumsum(part) for part in np.split(quantities, bounds)])
+
+    last = np.concatenate([(idx[1:] != idx[:-1]) | (dates[1:] != dates[:-1]), [True]])
+    idx, dates, cumulative = idx[last], dates[last], cumulative[last]
+    by_date = np.lexsort((idx, dates))
+    return dates[by_date], idx[by_date], cumulative[by_date]
+
+
+async def portfolio_values(
+    session: AsyncSession,
+    ledger: LedgerMatrix,
+    target_dates: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Portfolio value at each target date. Returns (target_dates, values).
+    """
+    if len(ledger) == 0 or len(target_dates) == 0:
+        return target_dates, np.zeros(len(target_dates))
+
+    prices = await price_cache.get(session, ledger.tickers)
+
+    positions = position_matrix(ledger, target_dates)
+    closes = np.nan_to_num(price_matrix(ledger.tickers, prices, target_dates), nan=0.0)
+    return target_dates, (positions * closes).sum(axis=1)
@@ -0,0 +1,92 @@
+import math
+import os
+import shutil
+import tempfile
+import uuid
+from datetime import date, timedelta
+
+import pytest
+
+# Les modules lisent leur configuration à l'import : base jetable, pas de tâches de fond
+TEST_DIR = tempfile.mkdtemp(prefix="peasy-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{TEST_DIR}/test.db"
+os.environ["DB_AUTO_MIGRATE"] = "1"
+os.environ["PRICE_FIXTURES_DIR"] = TEST_DIR
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("PRICE_PROVIDER", "fixture")
+os.environ.setdefault("PRICE_SCHEDULER", "0")
+os.environ.setdefault("NAV_SCHEDULER", "0")
+os.environ.setdefault("LIVE_POLL_INTERVAL", "0")
+os.environ.setdefault("PRICE_RATE_LIMIT", "1000")
+os.environ.setdefault("PRICE_RATE_BURST", "1000")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+FIXTURE_TICKERS = ("AI.PA", "MC.PA", "OR.PA")
+FIXTURE_START = date(2019, 1, 1)
+
+
+def _write_price_fixtures():
+    # Cours synthétiques déterministes, un par jour ouvré jusqu'à aujourd'hui
+    for k, ticker in enumerate(FIXTURE_TICKERS):
+        with open(os.path.join(TEST_DIR, f"{ticker}.csv"), "w") as f:
+            f.write("date,close\n")
+            day, i = FIXTURE_START, 0
+            while day <= date.today():
+                if day.weekday() < 5:
+                    f.write(f"{day.isoformat()},{100 * (k + 1) * (1 + 0.2 * math.sin(i / 40 + k)):.4f}\n")
+                    i += 1
+                day += timedelta(days=1)
+
+
+_write_price_fixtures()
+
+
+@pytest.fixture(scope="session")
+def client():
+    """
+    Test client on the whole app, started once: every test shares its event
+    loop, so async services can be called through `client.portal`.
+    """
+    from fastapi.testclient import TestClient
+    from db import engine
+    import main
+
+    with TestClient(main.app) as test_client:
+        yield test_client
+        # Connexions aiosqlite fermées avant la boucle qui les attend
+        test_client.portal.call(engine.dispose)
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def auth_headers(client):
+    """
+    Authorization header of a freshly registered user.
+    """
+    username = uuid.uuid4().hex[:12]
+    response = client.post("/api/auth/register", json={"username": username, "email": f"{username}@test", "password": "pw"})
+    assert response.status_code == 201, response.text
+    token = client.post("/api/auth/login", data={"username": username, "password": "pw"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+def user_id(auth_headers):
+    from routes.auth import decode_token
+
+    return int(decode_token(auth_headers["Authorization"].removeprefix("Bearer "))["sub"])
+
+
+@pytest.fixture
+def post_transaction(client, auth_headers):
+    """
+    Record a trade for the `auth_headers` user through the API.
+    """
+    def post(tx_type, ticker, quantity, price, date_of):
+        response = client.post("/api/transaction/", headers=auth_headers, json={
+            "type": tx_type, "ticker": ticker, "quantity": quantity, "price": price, "date_of": str(date_of)
+        })
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    return post
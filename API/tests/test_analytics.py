@@ -0,0 +1,74 @@
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+from services.analytics import PortfolioWindow, daily_returns, max_drawdown, time_weighted_return, xirr
+
+
+def window(values, flows) -> PortfolioWindow:
+    dates = np.arange(np.datetime64("2024-01-01"), np.datetime64("2024-01-01") + len(values))
+    return PortfolioWindow(
+        dates, ["AI.PA"], np.array(values, dtype=float)[:, None], np.array(flows, dtype=float)[:, None],
+        np.empty(0, dtype="datetime64[D]"), np.empty(0)
+    )
+
+
+def test_time_weighted_return_compounds_daily_returns():
+    assert time_weighted_return(np.array([0.1, -0.05])) == pytest.approx(0.045)
+
+
+def test_flows_do_not_count_as_performance():
+    # +10 % puis un apport de 100 en début de journée et encore +10 %
+    returns, capital = daily_returns(window([100, 110, 231], [0, 0, 100]))
+    assert returns == pytest.approx([0.1, 0.1])
+    assert capital == pytest.approx([100, 210])
+    assert time_weighted_return(returns) == pytest.approx(0.21)
+
+
+def test_empty_capital_has_zero_return():
+    returns, _ = daily_returns(window([0, 0, 50], [0, 0, 50]))
+    assert returns == pytest.approx([0.0, 0.0])
+
+
+@pytest.mark.parametrize("amounts, years, expected", [
+    ([-1000, 1100], [0, 1], 0.1),
+    ([-1000, 1210], [0, 2], 0.1),
+    ([-1000, 900], [0, 1], -0.1),
+])
+def test_xirr_simple_cases(amounts, years, expected):
+    assert xirr(np.array(amounts, dtype=float), np.array(years, dtype=float)) == pytest.approx(expected, abs=1e-9)
+
+
+def test_xirr_matches_spreadsheet_example():
+    # Exemple de la documentation de XIRR (Excel, LibreOffice) : 37,34 %
+    days = [date(2008, 1, 1), date(2008, 3, 1), date(2008, 10, 30), date(2009, 2, 15), date(2009, 4, 1)]
+    amounts = np.array([-10000, 2750, 4250, 3250, 2750], dtype=float)
+    years = np.array([(d - days[0]).days / 365.0 for d in days])
+    assert xirr(amounts, years) == pytest.approx(0.373362535, abs=1e-6)
+
+
+def test_xirr_needs_flows_both_ways():
+    assert xirr(np.array([-100.0, -50.0]), np.array([0.0, 1.0])) is None
+    assert xirr(np.array([-100.0, 100.0]), np.array([0.0, 0.0])) is None
+
+
+def test_max_drawdown():
+    drawdown, peak, trough = max_drawdown(np.array([0.1, -0.5, 0.2]))
+    assert drawdown == pytest.approx(-0.5)
+    assert (peak, trough) == (1, 2)
+
+
+@pytest.mark.parametrize("route", ["performance", "volatility", "contribution"])
+def test_analytics_routes_reject_non_positive_periods(client, auth_headers, route):
+    for period in ("-5d", "0d"):
+        response = client.get(f"/api/transaction/analytics/{route}", headers=auth_headers, params={"period": period})
+        assert response.status_code == 400
+
+
+@pytest.mark.parametrize("period", ["1d", "5d", "1y"])
+def test_performance_on_short_periods(client, auth_headers, post_transaction, period):
+    post_transaction("achat", "AI.PA", 10, 100, date.today() - timedelta(days=400))
+    response = client.get("/api/transaction/analytics/performance", headers=auth_headers, params={"period": period})
+    assert response.status_code == 200
+    assert response.json()["end_value"] > 0
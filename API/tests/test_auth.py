@@ -0,0 +1,15 @@
+import uuid
+
+from utils import password_pool
+
+
+def test_busy_password_pool_answers_503(client, monkeypatch):
+    monkeypatch.setattr(password_pool, "queue_limit", 0)
+    username = uuid.uuid4().hex[:12]
+    response = client.post("/api/auth/register", json={"username": username, "email": f"{username}@test", "password": "pw"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_login_after_register(client, auth_headers):
+    assert client.get("/api/user/me", headers=auth_headers).status_code == 200
@@ -0,0 +1,25 @@
+from itertools import cycle
+
+from starlette.requests import Request
+
+import db
+
+
+def request():
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": [], "query_string": b""})
+
+
+def test_read_engine_is_chosen_once_per_request(monkeypatch):
+    replicas = ["replica-1", "replica-2"]
+    monkeypatch.setattr(db, "replica_engines", replicas)
+    monkeypatch.setattr(db, "_replicas", cycle(replicas))
+
+    first = request()
+    assert db.read_engine(first) == "replica-1"
+    # Même scope, autre objet Request : comme la dépendance et le job de la route
+    assert db.read_engine(Request(first.scope)) == "replica-1"
+    assert db.read_engine(request()) == "replica-2"
+
+
+def test_read_engine_without_replicas_is_the_primary():
+    assert db.read_engine(request()) is db.engine
@@ -0,0 +1,76 @@
+import io
+from datetime import date
+
+from models import TransactionType
+from services.imports import BROKER_MAPPINGS, _apply_mapping, _iter_records, _validate_rows
+
+
+def validate(content: str, file_format: str = "csv", mapping: str = "default", size: int = 100):
+    records = _iter_records(io.BytesIO(content.encode()), file_format, BROKER_MAPPINGS[mapping])
+    return _validate_rows(records, BROKER_MAPPINGS[mapping], 7, size)
+
+
+def test_valid_csv_rows():
+    rows, errors, exhausted = validate(
+        "type,ticker,quantity,price,date_of\n"
+        "achat,AI.PA,10,150.5,2024-01-02\n"
+        "vente,AI.PA,4,170,2024-03-04\n"
+    )
+    assert errors == []
+    assert exhausted
+    assert rows[0] == {
+        "type": TransactionType.achat, "ticker": "AI.PA", "quantity": 10, "price": 150.5,
+        "date_of": date(2024, 1, 2), "user_id": 7,
+    }
+    assert rows[1]["type"] == TransactionType.vente
+
+
+def test_invalid_rows_are_reported_with_their_number():
+    rows, errors, _ = validate(
+        "type,ticker,quantity,price,date_of\n"
+        "achat,AI.PA,10,150,2024-01-02\n"
+        "don,AI.PA,1,1,2024-01-02\n"
+        "achat,AI.PA,abc,1,2024-01-02\n"
+    )
+    assert len(rows) == 1
+    assert [row for row, _ in errors] == [2, 3]
+    assert errors[0][1].startswith("type:")
+    assert errors[1][1].startswith("quantity:")
+
+
+def test_ndjson_parse_errors():
+    rows, errors, _ = validate(
+        '{"type": "achat", "ticker": "MC.PA", "quantity": 1, "price": 400, "date_of": "2024-01-02"}\n'
+        "not json\n"
+        "[1, 2]\n",
+        file_format="ndjson",
+    )
+    assert len(rows) == 1
+    assert [row for row, _ in errors] == [2, 3]
+
+
+def test_batches_stop_at_size_and_resume():
+    records = _iter_records(io.BytesIO((
+        "type,ticker,quantity,price,date_of\n"
+        "achat,AI.PA,1,1,2024-01-02\n"
+        "bad,AI.PA,1,1,2024-01-02\n"
+        "achat,AI.PA,1,1,2024-01-03\n"
+    ).encode()), "csv", BROKER_MAPPINGS["default"])
+    first = _validate_rows(records, BROKER_MAPPINGS["default"], 1, 2)
+    second = _validate_rows(records, BROKER_MAPPINGS["default"], 1, 2)
+    assert (len(first[0]), len(first[1]), first[2]) == (1, 1, False)
+    assert (len(second[0]), len(second[1]), second[2]) == (1, 0, True)
+
+
+def test_broker_mapping_french_numbers_and_dates():
+    data = _apply_mapping(
+        {"Date": "15/03/2024", "Sens": "A", "Valeur": " AI.PA ", "Quantité": "1\u202f000", "Cours": "1\u00a0234,50"},
+        BROKER_MAPPINGS["broker_fr"],
+    )
+    assert data == {"date_of": date(2024, 3, 15), "type": "achat", "ticker": "AI.PA", "quantity": "1000", "price": "1234.50"}
+
+
+def test_broker_mapping_bad_date_is_rejected():
+    rows, errors, _ = validate("Date;Sens;Valeur;Quantité;Cours\n2024-03-15;Achat;AI.PA;1;1\n", mapping="broker_fr")
+    assert rows == []
+    assert errors[0][0] == 1
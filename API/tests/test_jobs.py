@@ -0,0 +1,67 @@
+from datetime import date
+
+import pytest
+
+from services.jobs import job_queue
+from services.response_cache import response_cache
+
+HISTORY = "/api/transaction/price/total_history"
+
+
+@pytest.fixture
+def trades(post_transaction):
+    post_transaction("achat", "AI.PA", 10, 150, date(2024, 1, 2))
+    post_transaction("achat", "MC.PA", 5, 400, date(2024, 6, 3))
+
+
+def test_respond_async_then_poll(client, auth_headers, trades):
+    response = client.get(HISTORY, headers={**auth_headers, "Prefer": "respond-async"}, params={"period": "1y"})
+    if response.status_code == 202:
+        assert response.headers["Location"] == f"/api/jobs/{response.json()['id']}"
+        status = client.get(response.headers["Location"], headers=auth_headers, params={"wait": 10}).json()
+        assert status["status"] == "done"
+        points = status["result"]
+    else:
+        # Déjà terminé au moment de répondre : le résultat vient directement
+        assert response.status_code == 200
+        points = response.json()
+    assert points == client.get(HISTORY, headers=auth_headers, params={"period": "1y"}).json()
+
+
+def test_identical_requests_share_one_job(client, auth_headers, trades):
+    submitted, shared = job_queue.submitted, job_queue.shared
+    first = client.get(HISTORY, headers=auth_headers, params={"period": "2y"})
+    # Sans le cache de réponses, la seconde requête retrouve le job terminé
+    response_cache.clear()
+    second = client.get(HISTORY, headers=auth_headers, params={"period": "2y"})
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert job_queue.submitted == submitted + 1
+    assert job_queue.shared == shared + 1
+
+
+def test_user_over_its_queue_is_rejected(client, auth_headers, trades, monkeypatch):
+    monkeypatch.setattr(job_queue, "user_queue", 0)
+    rejected = job_queue.rejected
+    response = client.get(HISTORY, headers=auth_headers, params={"period": "3y"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert job_queue.rejected == rejected + 1
+
+
+def test_full_queue_is_rejected(client, auth_headers, trades, monkeypatch):
+    monkeypatch.setattr(job_queue, "queue_limit", 0)
+    response = client.get(HISTORY, headers=auth_headers, params={"period": "4y"})
+    assert response.status_code == 429
+    assert response.json()["detail"] == "Job queue is full"
+    assert "Retry-After" in response.headers
+
+
+
+def test_clear_forgets_finished_results(client, auth_headers, trades):
+    client.get(HISTORY, headers=auth_headers, params={"period": "5y"})
+    response_cache.clear()
+    job_queue.clear()
+    submitted = job_queue.submitted
+    assert client.get(HISTORY, headers=auth_headers, params={"period": "5y"}).status_code == 200
+    assert job_queue.submitted == submitted + 1
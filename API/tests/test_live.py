@@ -0,0 +1,17 @@
+from services.live import live_hub
+
+
+def test_live_subscription_limit_answers_503(client, auth_headers, monkeypatch):
+    monkeypatch.setattr(live_hub, "max_subscriptions", 0)
+    response = client.get("/api/transaction/price/total/stream", headers=auth_headers)
+    assert response.status_code == 503
+
+
+def test_stream_requires_a_token(client):
+    assert client.get("/api/transaction/price/total/stream").status_code == 401
+
+
+def test_access_token_is_not_a_stream_token(client, auth_headers):
+    access_token = auth_headers["Authorization"].removeprefix("Bearer ")
+    response = client.get("/api/transaction/price/total/stream", params={"token": access_token})
+    assert response.status_code == 401
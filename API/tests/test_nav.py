@@ -0,0 +1,65 @@
+from datetime import date, timedelta
+
+import pytest
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import DailyNav, NavStatus
+from services.nav import _live_values, build_daily_nav, nav_history
+from services.transactions import history_dates
+
+
+async def _histories(user_id, period="2y", dirty_from=None):
+    from db import engine
+
+    start, end, interval_dates = history_dates(period)
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        if dirty_from is not None:
+            status = await session.get(NavStatus, user_id)
+            status.dirty_from = dirty_from
+            session.add(status)
+            await session.commit()
+        stored = await nav_history(session, user_id, start, end, interval_dates)
+        live = await _live_values(session, user_id, start, end, interval_dates)
+    return stored, live
+
+
+def _assert_same_history(stored, live):
+    assert list(stored) == list(live)
+    assert list(stored.values()) == pytest.approx(list(live.values()))
+
+
+@pytest.fixture
+def trades(post_transaction):
+    today = date.today()
+    post_transaction("achat", "AI.PA", 10, 150, today - timedelta(days=500))
+    post_transaction("achat", "MC.PA", 5, 400, today - timedelta(days=300))
+    post_transaction("vente", "AI.PA", 4, 170, today - timedelta(days=100))
+    post_transaction("achat", "OR.PA", 3, 300, today - timedelta(days=20))
+
+
+def test_built_nav_matches_live_values(client, user_id, trades):
+    async def build():
+        from db import engine
+
+        async with AsyncSession(engine) as session:
+            await build_daily_nav(session, [user_id], full=True)
+            return await session.get(NavStatus, user_id), await session.get(DailyNav, (user_id, date.today() - timedelta(days=30)))
+
+    status, row = client.portal.call(build)
+    assert status.last_date is not None and status.dirty_from is None
+    assert row is not None and row.value > 0
+
+    _assert_same_history(*client.portal.call(_histories, user_id))
+
+
+def test_stale_suffix_is_valued_from_change_points(client, user_id, trades):
+    # Comme après une transaction antidatée dont le recalcul n'a pas encore tourné
+    dirty_from = date.today() - timedelta(days=200)
+    _assert_same_history(*client.portal.call(_histories, user_id, "2y", dirty_from))
+
+
+def test_history_before_the_first_trade_is_zero(client, user_id, trades):
+    stored, live = client.portal.call(_histories, user_id, "5a")
+    _assert_same_history(stored, live)
+    first_trade = date.today() - timedelta(days=500)
+    assert all(value == 0 for d, value in stored.items() if d < first_trade)
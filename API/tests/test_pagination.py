@@ -0,0 +1,41 @@
+from datetime import date
+
+import pytest
+
+from services.utils import decode_cursor, encode_cursor
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor(date(2024, 2, 29), 12345)
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (date(2024, 2, 29), 12345)
+
+
+@pytest.mark.parametrize("cursor", ["", "not-a-cursor", "////", encode_cursor(date(2024, 1, 1), 1)[:-3]])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_cursor_pages_cover_every_transaction_once(client, auth_headers, post_transaction):
+    # Plusieurs transactions le même jour : l'id départage
+    for i in range(7):
+        post_transaction("achat", "AI.PA", i + 1, 100, date(2024, 1, 2 + i // 3))
+    expected = [tx["id"] for tx in client.get("/api/transaction/", headers=auth_headers).json()]
+
+    seen, params = [], {"page_size": 3}
+    while True:
+        response = client.get("/api/transaction/", headers=auth_headers, params=params)
+        assert response.status_code == 200
+        seen += [tx["id"] for tx in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+        params = {"page_size": 3, "cursor": cursor}
+    assert seen == expected
+    assert len(seen) == 7
+
+
+def test_invalid_cursor_answers_400(client, auth_headers):
+    response = client.get("/api/transaction/", headers=auth_headers, params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
@@ -0,0 +1,58 @@
+from datetime import date, timedelta
+
+import pytest
+from dateutil.relativedelta import relativedelta
+from fastapi import HTTPException
+
+from services.analytics import analysis_bounds
+from services.transactions import history_dates
+from services.utils import parse_period, period_start
+
+
+@pytest.mark.parametrize("period, expected", [
+    ("10d", timedelta(days=10)),
+    ("2w", timedelta(weeks=2)),
+    ("3m", relativedelta(months=3)),
+    ("5y", relativedelta(years=5)),
+    ("5a", relativedelta(years=5)),
+])
+def test_parse_period(period, expected):
+    assert parse_period(period) == expected
+
+
+@pytest.mark.parametrize("period", ["", "abc", "5x"])
+def test_parse_period_unknown_unit(period):
+    assert parse_period(period) is None
+
+
+@pytest.mark.parametrize("period", ["y", "1.5y", "xd"])
+def test_parse_period_bad_number(period):
+    with pytest.raises(ValueError):
+        parse_period(period)
+
+
+@pytest.mark.parametrize("period", ["", "5x", "y", "99999y", "10000000000d", "0d", "-5d", "-1y"])
+def test_invalid_periods_answer_400(period):
+    for bounds in (history_dates, analysis_bounds):
+        with pytest.raises(HTTPException) as error:
+            bounds(period)
+        assert error.value.status_code == 400
+
+
+def test_history_dates_weekly_points():
+    start, end, points = history_dates("3m")
+    assert end == date.today()
+    assert start == end - relativedelta(months=3)
+    assert min(points) == start
+    assert all(start <= d <= end for d in points)
+    assert sorted(points)[1] - start == timedelta(days=7)
+
+
+def test_period_start():
+    assert period_start("2w", date(2024, 3, 15)) == date(2024, 3, 1)
+    assert period_start("1m", date(2024, 3, 31)) == date(2024, 2, 29)
+
+
+def test_negative_history_period_answers_400(client, auth_headers):
+    response = client.get("/api/transaction/price/total_history", headers=auth_headers, params={"period": "-5d"})
+    assert response.status_code == 400
@@ -0,0 +1,100 @@
+import asyncio
+from datetime import date, timedelta
+
+import pytest
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models import Position, Transaction, TransactionType
+from services.positions import CostBasis, apply_transaction, verify_positions
+
+
+def test_purchases_accumulate_cost():
+    state = CostBasis()
+    state.apply(TransactionType.achat, 10, 100)
+    state.apply(TransactionType.achat, 10, 130)
+    assert state.quantity == 20
+    assert state.cost == pytest.approx(2300)
+    assert state.average_cost == pytest.approx(115)
+    assert state.realized == 0
+
+
+def test_sale_releases_cost_at_average_and_realizes_difference():
+    state = CostBasis()
+    state.apply(TransactionType.achat, 10, 100)
+    state.apply(TransactionType.achat, 10, 130)
+    state.apply(TransactionType.vente, 5, 150)
+    assert state.quantity == 15
+    assert state.average_cost == pytest.approx(115)
+    assert state.cost == pytest.approx(1725)
+    assert state.realized == pytest.approx(5 * (150 - 115))
+
+
+def test_closed_position_restarts_from_zero_cost():
+    state = CostBasis()
+    state.apply(TransactionType.achat, 3, 1 / 3)
+    state.apply(TransactionType.vente, 3, 1)
+    assert state.quantity == 0
+    assert state.cost == 0.0
+    assert state.average_cost == 0.0
+    assert state.realized == pytest.approx(2)
+
+    state.apply(TransactionType.achat, 2, 50)
+    assert state.average_cost == pytest.approx(50)
+
+
+def test_sale_at_a_loss():
+    state = CostBasis(quantity=4, cost=400)
+    state.apply(TransactionType.vente, 1, 80)
+    assert state.realized == pytest.approx(-20)
+    assert state.cost == pytest.approx(300)
+
+
+async def _position(user_id, ticker):
+    from db import engine
+
+    async with AsyncSession(engine) as session:
+        position = await session.get(Position, (user_id, ticker))
+        return position, await verify_positions(session, user_id)
+
+
+def test_back_dated_trade_replays_cost_basis(client, user_id, post_transaction):
+    post_transaction("achat", "AI.PA", 10, 100, date(2024, 3, 1))
+    post_transaction("achat", "AI.PA", 10, 200, date(2024, 6, 3))
+    post_transaction("vente", "AI.PA", 5, 180, date(2024, 9, 2))
+    # Antidaté avant tout le reste : le PRU et la plus-value de la vente changent
+    post_transaction("achat", "AI.PA", 10, 50, date(2024, 1, 2))
+
+    expected = CostBasis()
+    for args in [(TransactionType.achat, 10, 50), (TransactionType.achat, 10, 100),
+                 (TransactionType.achat, 10, 200), (TransactionType.vente, 5, 180)]:
+        expected.apply(*args)
+
+    position, errors = client.portal.call(_position, user_id, "AI.PA")
+    assert errors == []
+    assert position.quantity == 25
+    assert position.last_date == date(2024, 9, 2)
+    assert position.cost_basis == pytest.approx(expected.cost)
+    assert position.realized_pnl == pytest.approx(expected.realized)
+
+
+def test_concurrent_trades_do_not_lose_updates(client, user_id):
+    from db import engine
+
+    async def trade(i):
+        async with AsyncSession(engine) as session:
+            transaction = Transaction(
+                type=TransactionType.achat, ticker="MC.PA", quantity=1, price=400 + i,
+                date_of=date(2024, 1, 2) + timedelta(days=30 - i), user_id=user_id
+            )
+            session.add(transaction)
+            await apply_transaction(session, transaction)
+            await session.commit()
+
+    async def trade_all():
+        await asyncio.gather(*(trade(i) for i in range(20)))
+
+    client.portal.call(trade_all)
+    position, errors = client.portal.call(_position, user_id, "MC.PA")
+    assert errors == []
+    assert position.quantity == 20
+    assert position.invested == pytest.approx(sum(400 + i for i in range(20)))
@@ -0,0 +1,66 @@
+import asyncio
+from datetime import date, timedelta
+
+from services.price_scheduler import PriceRefreshScheduler, RateLimiter
+from services.prices import FixturePriceProvider
+
+
+class CountingProvider(FixturePriceProvider):
+    def __init__(self, tickers):
+        start = date.today() - timedelta(days=30)
+        super().__init__(bars={ticker: [(start + timedelta(days=i), 100.0 + i) for i in range(30)] for ticker in tickers})
+        self.batches = []
+
+    def fetch_many(self, requests):
+        requests = list(requests)
+        self.batches.append(requests)
+        return super().fetch_many(requests)
+
+
+def scheduler(tickers):
+    return PriceRefreshScheduler(provider=CountingProvider(tickers), limiter=RateLimiter(rate=1, burst=1))
+
+
+def test_refresh_many_fetches_in_one_batch(client):
+    tickers = [f"BATCH{i}.PA" for i in range(5)]
+    prices = scheduler(tickers)
+    start = date.today() - timedelta(days=30)
+
+    results = client.portal.call(prices.refresh_many, {ticker: start for ticker in tickers})
+    assert {ticker: error for ticker, (_, error) in results.items()} == {ticker: None for ticker in tickers}
+    assert all(stored > 0 for stored, _ in results.values())
+    assert len(prices.provider.batches) == 1
+    # Un seul jeton : le seau (burst 1) est vide, pas en dette
+    assert 0 <= prices.limiter.tokens < 1
+
+
+def test_concurrent_refreshes_share_the_fetch(client):
+    prices = scheduler(["SHARED.PA"])
+    start = date.today() - timedelta(days=20)
+
+    async def refresh_twice():
+        return await asyncio.gather(prices.refresh("SHARED.PA", start), prices.refresh("SHARED.PA", start))
+
+    first, second = client.portal.call(refresh_twice)
+    assert first == second
+    assert len(prices.provider.batches) == 1
+    assert prices.coalesced == 1
+    assert prices._inflight == {}
+
+
+def test_earlier_start_than_a_finished_fetch_is_refetched(client):
+    prices = scheduler(["EARLY.PA"])
+    later = date.today() - timedelta(days=5)
+    earlier = date.today() - timedelta(days=25)
+
+    async def refresh_after_finished_fetch():
+        task = asyncio.ensure_future(asyncio.sleep(0, {"EARLY.PA": (0, None)}))
+        await task
+        # Terminé mais toujours enregistré, comme avant l'exécution de son callback
+        prices._inflight["EARLY.PA"] = (task, later)
+        return await prices.refresh("EARLY.PA", earlier)
+
+    stored, error = client.portal.call(refresh_after_finished_fetch)
+    assert error is None and stored > 0
+    assert [ticker for ticker, _, _ in prices.provider.batches[0]] == ["EARLY.PA"]
+    assert prices._inflight == {}
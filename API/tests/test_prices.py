@@ -0,0 +1,49 @@
+from datetime import date
+
+import pytest
+
+from models import PriceCoverage
+from services.prices import PRICE_REFETCH_DAYS, _missing_ranges
+
+
+def coverage(first: date, last: date) -> PriceCoverage:
+    return PriceCoverage(ticker="AI.PA", first_date=first, last_date=last)
+
+
+def test_no_coverage_fetches_everything():
+    assert _missing_ranges(None, date(2024, 1, 1), date(2024, 6, 30)) == [(date(2024, 1, 1), date(2024, 6, 30))]
+
+
+def test_head_and_tail_outside_coverage():
+    ranges = _missing_ranges(coverage(date(2024, 3, 1), date(2024, 5, 31)), date(2024, 1, 1), date(2024, 6, 30), refetch_days=0)
+    assert ranges == [(date(2024, 1, 1), date(2024, 2, 29)), (date(2024, 6, 1), date(2024, 6, 30))]
+
+
+def test_fully_covered_without_refetch():
+    assert _missing_ranges(coverage(date(2024, 1, 1), date(2024, 6, 30)), date(2024, 2, 1), date(2024, 6, 30), refetch_days=0) == []
+
+
+def test_recent_days_are_refetched_by_default():
+    assert PRICE_REFETCH_DAYS > 0
+    end = date(2024, 6, 30)
+    ranges = _missing_ranges(coverage(date(2024, 1, 1), end), date(2024, 1, 1), end)
+    assert ranges == [(date(2024, 6, 30 - PRICE_REFETCH_DAYS), end)]
+
+
+def test_refetch_extends_a_partial_tail():
+    ranges = _missing_ranges(coverage(date(2024, 1, 1), date(2024, 6, 25)), date(2024, 1, 1), date(2024, 6, 30), refetch_days=3)
+    assert ranges == [(date(2024, 6, 26), date(2024, 6, 30))]
+    ranges = _missing_ranges(coverage(date(2024, 1, 1), date(2024, 6, 29)), date(2024, 1, 1), date(2024, 6, 30), refetch_days=3)
+    assert ranges == [(date(2024, 6, 27), date(2024, 6, 30))]
+
+
+def test_refetch_does_not_start_before_coverage():
+    ranges = _missing_ranges(coverage(date(2024, 6, 29), date(2024, 6, 30)), date(2024, 6, 29), date(2024, 6, 30), refetch_days=10)
+    assert ranges == [(date(2024, 6, 29), date(2024, 6, 30))]
+
+
+@pytest.mark.parametrize("refetch_days", [0, 3])
+def test_end_before_coverage_end(refetch_days):
+    ranges = _missing_ranges(coverage(date(2024, 1, 1), date(2024, 6, 30)), date(2024, 1, 1), date(2024, 3, 1), refetch_days)
+    assert all(start <= end for start, end in ranges)
+    assert all(end <= date(2024, 3, 1) for _, end in ranges)
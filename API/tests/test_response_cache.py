@@ -0,0 +1,44 @@
+from datetime import date
+
+from services.response_cache import response_cache
+
+
+def test_etag_round_trip(client, auth_headers, post_transaction):
+    post_transaction("achat", "AI.PA", 10, 100, date(2024, 3, 1))
+
+    first = client.get("/api/transaction/", headers=auth_headers)
+    etag = first.headers["ETag"]
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == "private, no-cache"
+
+    not_modified = client.get("/api/transaction/", headers={**auth_headers, "If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["ETag"] == etag
+    assert not_modified.content == b""
+
+    # Sans If-None-Match, la réponse vient du cache avec le même ETag
+    hits = response_cache.hits
+    cached = client.get("/api/transaction/", headers=auth_headers)
+    assert cached.json() == first.json()
+    assert cached.headers["ETag"] == etag
+    assert response_cache.hits == hits + 1
+
+
+def test_write_changes_the_etag(client, auth_headers, post_transaction):
+    post_transaction("achat", "AI.PA", 10, 100, date(2024, 3, 1))
+    etag = client.get("/api/transaction/", headers=auth_headers).headers["ETag"]
+
+    post_transaction("vente", "AI.PA", 4, 120, date(2024, 4, 2))
+    response = client.get("/api/transaction/", headers={**auth_headers, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.json()) == 2
+
+
+def test_etag_depends_on_the_query(client, auth_headers, post_transaction):
+    post_transaction("achat", "AI.PA", 10, 100, date(2024, 3, 1))
+    etag = client.get("/api/transaction/", headers=auth_headers).headers["ETag"]
+
+    response = client.get("/api/transaction/", headers={**auth_headers, "If-None-Match": etag}, params={"page_size": 1})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag